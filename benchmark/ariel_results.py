@@ -0,0 +1,58 @@
+# Copyright 2019 IBM Corporation All Rights Reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+''' Measures Ariel result download throughput against a mock console.
+    Each results request has a fixed latency plus a per-record cost,
+    which approximates a remote console serving Range requests.
+    Run from the repository root:
+        python benchmark/ariel_results.py
+'''
+
+import json
+import os
+import sys
+import time
+import responses
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from qpylib.ariel import ArielSearch
+
+RECORD_COUNT = 20000
+PAGE_SIZE = 500
+REQUEST_LATENCY = 0.02
+PER_RECORD_LATENCY = 0.00002
+RESULTS_URL = 'https://console.mock/api/ariel/searches/benchmark/results'
+
+def results_callback(request):
+    start, end = [int(i) for i in request.headers['Range'][len('items='):].split('-')]
+    time.sleep(REQUEST_LATENCY + PER_RECORD_LATENCY * (end - start + 1))
+    events = [{'sourceip': '10.0.0.1', 'qid': i} for i in range(start, end + 1)]
+    return (200, {}, json.dumps({'events': events}))
+
+def timed_run(iterator):
+    start_time = time.perf_counter()
+    count = sum(1 for _ in iterator)
+    elapsed = time.perf_counter() - start_time
+    assert count == RECORD_COUNT
+    return count / elapsed
+
+def main():
+    os.environ['QRADAR_CONSOLE_FQDN'] = 'console.mock'
+    search = ArielSearch()
+    with responses.RequestsMock() as mock:
+        mock.add_callback('GET', RESULTS_URL, callback=results_callback)
+        print('{0} records, page size {1}'.format(RECORD_COUNT, PAGE_SIZE))
+        rate = timed_run(search.iter_results('benchmark', page_size=PAGE_SIZE,
+                                             record_count=RECORD_COUNT))
+        print('iter_results            : {0:>10.0f} records/sec'.format(rate))
+        for workers in (1, 2, 4, 8, 16):
+            rate = timed_run(search.iter_results_parallel('benchmark', page_size=PAGE_SIZE,
+                                                          max_workers=workers,
+                                                          record_count=RECORD_COUNT))
+            print('iter_results_parallel {0:>2}: {1:>10.0f} records/sec'.format(workers, rate))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Copyright 2019 IBM Corporation All Rights Reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+''' Measures the time taken by qpylib.create_log with syslog enabled in a
+    fresh process, with and without a stored syslog pseudo-hostname.
+    Each run starts a new Python interpreter, as a gunicorn worker would.
+    Run from the repository root:
+        python benchmark/create_log_startup.py
+'''
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+RUNS = 5
+
+CHILD_SCRIPT = '''
+import sys, time
+sys.path.insert(0, {repo_root!r})
+from qpylib import qpylib
+start = time.perf_counter()
+qpylib.create_log()
+print(time.perf_counter() - start)
+'''
+
+def run_child(env):
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD_SCRIPT.format(repo_root=REPO_ROOT)], env=env)
+    return float(output.decode().strip())
+
+def main():
+    app_root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(app_root, 'store', 'log'))
+    with open(os.path.join(app_root, 'manifest.json'), 'w') as manifest:
+        json.dump({'name': 'Benchmark', 'log_level': 'INFO'}, manifest)
+    env = dict(os.environ,
+               APP_ROOT=app_root,
+               QRADAR_APP_ID='1001',
+               QRADAR_APP_UUID='d9830bbb-5958-4e42-acc8-0e7ac5182c0a',
+               QRADAR_CONSOLE_IP='127.0.0.1')
+    hostname_file = os.path.join(app_root, 'store', 'syslog_hostname.json')
+
+    cold = []
+    for _ in range(RUNS):
+        if os.path.exists(hostname_file):
+            os.remove(hostname_file)
+        cold.append(run_child(env))
+    warm = [run_child(env) for _ in range(RUNS)]
+
+    print('{0:<40}: {1:>8.1f} ms'.format('create_log, no stored hostname',
+                                         1000 * min(cold)))
+    print('{0:<40}: {1:>8.1f} ms'.format('create_log, stored hostname',
+                                         1000 * min(warm)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# Copyright 2019 IBM Corporation All Rights Reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+''' Measures the cost of qpylib.log calls below the threshold log level.
+    Compares the previous behaviour (sanitize the message, then let the
+    logger discard it) with the current level-first path.
+    Run from the repository root:
+        python benchmark/log_disabled_level.py
+'''
+
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from qpylib import qpylib, log_qpylib
+
+CALLS = 100000
+
+def previous_log(message, level):
+    log_function = log_qpylib.LOG_LEVEL_TO_FUNCTION.get(level.upper())
+    log_function(log_qpylib._sanitize(message)) # pylint: disable=protected-access
+
+def report(label, seconds):
+    print('{0:<40}: {1:>12,.0f} calls/sec'.format(label, CALLS / seconds))
+
+def main():
+    app_root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(app_root, 'store', 'log'))
+    with open(os.path.join(app_root, 'manifest.json'), 'w') as manifest:
+        json.dump({'name': 'Benchmark', 'log_level': 'INFO'}, manifest)
+    os.environ['APP_ROOT'] = app_root
+    qpylib.create_log(syslog_enabled=False)
+
+    for size in (100, 10000):
+        payload = 'x' * size
+        print('DEBUG payload of {0} characters at INFO threshold'.format(size))
+        report('  previous: sanitize then discard',
+               timeit.timeit(lambda: previous_log(payload, 'DEBUG'), number=CALLS))
+        report('  qpylib.log(message)',
+               timeit.timeit(lambda: qpylib.log(payload, 'DEBUG'), number=CALLS))
+        report('  qpylib.log(template, args=...)',
+               timeit.timeit(lambda: qpylib.log('payload=%s', 'DEBUG', args=(payload,)),
+                             number=CALLS))
+
+if __name__ == '__main__':
+    main()
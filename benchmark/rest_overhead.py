@@ -0,0 +1,57 @@
+# Copyright 2019 IBM Corporation All Rights Reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+''' Measures the client-side overhead of qpylib.REST, excluding the network.
+    HTTPAdapter.send is replaced by a function returning a canned response,
+    so only qpylib and requests processing is timed.
+    Run from the repository root:
+        python benchmark/rest_overhead.py
+'''
+
+import os
+import sys
+import timeit
+from unittest.mock import patch
+import requests
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from qpylib import qpylib, rest_qpylib
+
+CALLS = 20000
+
+def canned_send(adapter, request, **kwargs):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = request.url
+    response.request = request
+    response.connection = adapter
+    response._content = b'{}' # pylint: disable=protected-access
+    return response
+
+def report(label, number, seconds):
+    print('{0:<40}: {1:>10,.0f} calls/sec'.format(label, number / seconds))
+
+def main():
+    os.environ['QRADAR_CONSOLE_FQDN'] = 'console.mock'
+    os.environ['QRADAR_CONSOLE_IP'] = '127.0.0.1'
+    os.environ['APP_ROOT'] = '/opt/app-root'
+    os.environ['QRADAR_APP_ID'] = '1005'
+    os.environ['SEC_ADMIN_TOKEN'] = 'benchmark-token'
+    if hasattr(qpylib, 'refresh_app_context'):
+        qpylib.refresh_app_context()
+    report('prepare_request',
+           CALLS, timeit.timeit(lambda: rest_qpylib.prepare_request('api/help/versions', '12.0',
+                                                                     None),
+                                number=CALLS))
+    report('get_app_base_url', CALLS, timeit.timeit(qpylib.get_app_base_url, number=CALLS))
+    with patch.object(HTTPAdapter, 'send', canned_send):
+        report('REST GET, network excluded',
+               CALLS, timeit.timeit(lambda: qpylib.REST('GET', 'api/help/versions'),
+                                    number=CALLS))
+
+if __name__ == '__main__':
+    main()
@@ -2,58 +2,163 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+from collections import namedtuple
 import json
 import os
+import threading
 from flask import request, url_for
+from . import util_qpylib
 
 Q_CACHED_MANIFEST = None
+Q_MANIFEST_LOCK = threading.Lock()
+Q_APP_CONTEXT = None
+
+class Manifest(namedtuple('Manifest', ['json', 'name', 'log_level', 'services', 'endpoints',
+                                       'path', 'mtime', 'reload_on_change'])):
+    ''' Immutable snapshot of the app manifest.
+        Frequently used fields are extracted once, when the manifest is loaded:
+          name: the "name" value, or None if absent.
+          log_level: the "log_level" value, or None if absent.
+          services: tuple of "services" entries.
+          endpoints: tuple of the "endpoints" entries of all services.
+        json holds the full manifest content.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_json(cls, manifest_json, path=None, mtime=None, reload_on_change=False):
+        services = tuple(manifest_json.get('services', ()))
+        endpoints = tuple(endpoint for service in services
+                          for endpoint in service.get('endpoints', ()))
+        return cls(manifest_json, manifest_json.get('name'), manifest_json.get('log_level'),
+                   services, endpoints, path, mtime, reload_on_change)
+
+class AppContext(namedtuple('AppContext', ['app_id', 'app_id_value', 'root_path', 'store_path',
+                                           'log_path', 'console_ip', 'console_fqdn',
+                                           'console_url_prefix', 'rest_proxy',
+                                           'sec_admin_token'])):
+    ''' Immutable snapshot of the app container environment.
+        Values are None if the corresponding environment variable is not set.
+          app_id: QRADAR_APP_ID as an int (0 if not set), or None if it is not numeric,
+            in which case app_id_value holds the raw value.
+          root_path, store_path, log_path: APP_ROOT and its store and store/log directories.
+          console_ip, console_fqdn: QRADAR_CONSOLE_IP and QRADAR_CONSOLE_FQDN.
+          console_url_prefix: https://<console_fqdn>/, the prefix of all console REST URLs.
+          rest_proxy: QRADAR_REST_PROXY.
+          sec_admin_token: SEC_ADMIN_TOKEN.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_env(cls):
+        app_id_value = os.getenv('QRADAR_APP_ID', '0')
+        try:
+            app_id = int(app_id_value)
+        except ValueError:
+            app_id = None
+        root_path = os.getenv('APP_ROOT')
+        store_path = None if root_path is None else os.path.join(root_path, 'store')
+        log_path = None if store_path is None else os.path.join(store_path, 'log')
+        console_fqdn = os.getenv('QRADAR_CONSOLE_FQDN')
+        console_url_prefix = None if console_fqdn is None else 'https://{0}/'.format(console_fqdn)
+        return cls(app_id, app_id_value, root_path, store_path, log_path,
+                   os.getenv('QRADAR_CONSOLE_IP'), console_fqdn, console_url_prefix,
+                   os.getenv('QRADAR_REST_PROXY'), os.getenv('SEC_ADMIN_TOKEN'))
+
+def get_app_context():
+    # Built on first use. Environment changes made after that
+    # are only picked up by refresh_app_context.
+    app_context = Q_APP_CONTEXT
+    if app_context is None:
+        app_context = refresh_app_context()
+    return app_context
+
+def refresh_app_context():
+    global Q_APP_CONTEXT
+    Q_APP_CONTEXT = AppContext.from_env()
+    return Q_APP_CONTEXT
+
+def _required_env_value(value, key):
+    if value is None:
+        raise KeyError('Environment variable {0} is not set'.format(key))
+    return value
 
 def get_app_id():
-    app_id = os.getenv('QRADAR_APP_ID', '0')
-    try:
-        return int(app_id)
-    except ValueError:
-        raise ValueError('Environment variable QRADAR_APP_ID has non-numeric value {0}'.format(app_id))
+    app_context = get_app_context()
+    if app_context.app_id is None:
+        raise ValueError('Environment variable QRADAR_APP_ID has non-numeric value {0}'
+                         .format(app_context.app_id_value))
+    return app_context.app_id
 
 def get_app_name():
-    return get_manifest_field_value('name')
-
-def get_manifest_json():
+    name = get_manifest().name
+    if name is None:
+        return get_manifest_field_value('name')
+    return name
+
+def get_manifest():
+    # Outside SDK mode the manifest never changes, so once loaded
+    # it is returned without locking or checking the file.
+    manifest = Q_CACHED_MANIFEST
+    if manifest is not None and not manifest.reload_on_change:
+        return manifest
+    with Q_MANIFEST_LOCK:
+        return _load_manifest()
+
+def _load_manifest():
+    # Must be called with Q_MANIFEST_LOCK held.
     global Q_CACHED_MANIFEST
-    if Q_CACHED_MANIFEST is None:
-        full_manifest_location = get_root_path('manifest.json')
-        with open(full_manifest_location) as manifest_file:
-            Q_CACHED_MANIFEST = json.load(manifest_file)
+    manifest = Q_CACHED_MANIFEST
+    if manifest is not None and not manifest.reload_on_change:
+        return manifest
+    full_manifest_location = get_root_path('manifest.json')
+    if manifest is not None and manifest.path == full_manifest_location:
+        try:
+            if os.stat(full_manifest_location).st_mtime_ns == manifest.mtime:
+                return manifest
+        except OSError:
+            return manifest
+    with open(full_manifest_location) as manifest_file:
+        manifest_json = json.load(manifest_file)
+        mtime = os.fstat(manifest_file.fileno()).st_mtime_ns
+    Q_CACHED_MANIFEST = Manifest.from_json(manifest_json, full_manifest_location, mtime,
+                                           util_qpylib.is_sdk())
     return Q_CACHED_MANIFEST
 
+def get_manifest_json():
+    return get_manifest().json
+
 def get_manifest_field_value(key, default_value=None):
     manifest = get_manifest_json()
-    if key in manifest.keys():
+    if key in manifest:
         return manifest[key]
     if default_value is not None:
         return default_value
     raise KeyError('{0} is a required manifest field'.format(key))
 
 def get_root_path(*path_entries):
-    return _build_path(*path_entries)
+    return _build_path(get_app_context().root_path, *path_entries)
 
 def get_store_path(*path_entries):
-    return _build_path('store', *path_entries)
+    return _build_path(get_app_context().store_path, *path_entries)
 
 def get_log_path(*path_entries):
-    return _build_path('store', 'log', *path_entries)
+    return _build_path(get_app_context().log_path, *path_entries)
 
-def _build_path(*path_entries):
-    return os.path.join(get_env_var('APP_ROOT'), *path_entries)
+def _build_path(base_path, *path_entries):
+    return os.path.join(_required_env_value(base_path, 'APP_ROOT'), *path_entries)
 
 def get_endpoint_url(endpoint, **values):
     return url_for(endpoint, **values)
 
 def get_console_ip():
-    return get_env_var('QRADAR_CONSOLE_IP')
+    return _required_env_value(get_app_context().console_ip, 'QRADAR_CONSOLE_IP')
 
 def get_console_fqdn():
-    return get_env_var('QRADAR_CONSOLE_FQDN')
+    return _required_env_value(get_app_context().console_fqdn, 'QRADAR_CONSOLE_FQDN')
+
+def get_console_url_prefix():
+    return _required_env_value(get_app_context().console_url_prefix, 'QRADAR_CONSOLE_FQDN')
 
 def get_env_var(key):
     value = os.getenv(key)
@@ -2,7 +2,12 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import random
 import time
+from flask import copy_current_request_context, has_request_context
+import requests
 from . import qpylib
 
 class ArielError(Exception):
@@ -18,6 +23,61 @@ class ArielError(Exception):
     def __str__(self):
         return self.message
 
+def _request_error(message, error, aql):
+    # Reports a failed REST request, e.g. a connection error or timeout,
+    # as an ArielError whose cause is the original exception.
+    ariel_error = ArielError('{0}: {1}'.format(message, error), aql=aql)
+    ariel_error.__cause__ = error
+    return ariel_error
+
+class PollingStrategy():
+    ''' Decides how long ArielSearch.search_sync sleeps between status checks.
+        Subclasses implement next_interval:
+          attempt: number of status checks already followed by a sleep, starting at 0.
+          elapsed: seconds since the search was created.
+          status_json: the latest search status payload from the QRadar API.
+        Returns the number of seconds to sleep before the next status check.
+    '''
+    def next_interval(self, attempt, elapsed, status_json):
+        raise NotImplementedError
+
+class FixedPolling(PollingStrategy):
+    ''' Sleeps for the same interval between every status check. '''
+    def __init__(self, interval):
+        self.interval = interval
+
+    def next_interval(self, attempt, elapsed, status_json):
+        return self.interval
+
+class AdaptivePolling(PollingStrategy):
+    ''' Polls quickly at first, then backs off exponentially up to max_interval.
+        Each interval is randomised by +/- jitter (a fraction) to spread load.
+        When the status payload reports progress, the remaining time is estimated
+        from the progress made so far and the next check is brought forward if
+        the search looks likely to finish sooner than the backoff interval.
+    '''
+    def __init__(self, initial_interval=0.1, max_interval=10, multiplier=2, jitter=0.1):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def next_interval(self, attempt, elapsed, status_json):
+        interval = min(self.max_interval, self.initial_interval * self.multiplier ** attempt)
+        if status_json.get('completed'):
+            interval = self.initial_interval
+        else:
+            estimate = self._estimate_remaining(elapsed, status_json.get('progress'))
+            if estimate is not None:
+                interval = min(interval, max(self.initial_interval, estimate))
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    @staticmethod
+    def _estimate_remaining(elapsed, progress):
+        if not isinstance(progress, (int, float)) or not 0 < progress < 100:
+            return None
+        return elapsed * (100 - progress) / progress
+
 class ArielSearch():
     ''' Convenience functions for executing Ariel searches using the QRadar REST API. '''
 
@@ -44,35 +104,156 @@ class ArielSearch():
         response_json = response.json()
         return (response_json['status'], response_json['search_id'])
 
-    def search_sync(self, query, timeout=60, sleep_interval=10, api_version='latest'):
+    # pylint: disable=too-many-arguments
+    def search_sync(self, query, timeout=60, sleep_interval=None, api_version='latest',
+                    polling=None):
         ''' Initiates a synchronous Ariel search.
               query: AQL query to execute.
               timeout: number of seconds to wait for search to complete.
-              sleep_interval: number of seconds to sleep before retrying status check.
+              sleep_interval: if supplied, number of seconds to sleep between status checks.
               api_version: QRadar API version to use, defaults to latest.
+              polling: PollingStrategy which decides how long to sleep between status checks.
+                If neither polling nor sleep_interval is supplied, AdaptivePolling is used.
+            Sleeps never extend beyond the timeout.
             Returns a tuple containing search ID and record count.
             Raises ArielError if any of these occur:
               search could not be created.
               search was cancelled or resulted in an error.
               search did not complete within the timeout.
         '''
+        if polling is None:
+            polling = AdaptivePolling() if sleep_interval is None else FixedPolling(sleep_interval)
         response = self.search(query, api_version)
-        end_time = time.time() + timeout
+        start_time = time.time()
+        end_time = start_time + timeout
         search_id = response[1]
+        attempt = 0
 
         while True:
-            status, record_count = self.status(search_id, api_version)
+            status_json = self._status_json(search_id, api_version)
+            status = status_json['status']
             if status == 'COMPLETED':
-                return (search_id, record_count)
+                return (search_id, status_json['record_count'])
             if status in ('CANCELED', 'ERROR'):
                 raise ArielError('Ariel search {0} failed: {1}'.format(search_id, status),
                                  aql=query)
-            if time.time() < end_time:
-                time.sleep(sleep_interval)
+            now = time.time()
+            if now < end_time:
+                interval = polling.next_interval(attempt, now - start_time, status_json)
+                time.sleep(max(0, min(interval, end_time - now)))
+                attempt += 1
                 continue
             raise ArielError('Ariel search {0} did not complete within {1}s'
                              .format(search_id, timeout), aql=query)
 
+    # pylint: disable=too-many-locals
+    def search_many(self, queries, max_concurrent=5, timeout=60, api_version='latest',
+                    polling=None):
+        ''' Generator which runs several Ariel searches concurrently.
+              queries: sequence of AQL queries to execute.
+              max_concurrent: maximum number of searches outstanding on the console
+                at any time. Further queries are submitted as earlier ones finish.
+              timeout: number of seconds to wait for each search to complete,
+                measured from its submission.
+              api_version: QRadar API version to use, defaults to latest.
+              polling: PollingStrategy which decides how long each search waits
+                between its status checks, defaults to AdaptivePolling.
+            All outstanding searches are polled from a single loop. Each search keeps
+            its own attempt count and next check time, so only the searches which
+            are due are polled, and the loop sleeps until the earliest next check.
+            As each search finishes, yields a tuple containing
+            (index of query in queries, search ID, record count, error).
+            On success error is None. On failure error is an ArielError and
+            search ID and record count are None if not available. Connection errors
+            and timeouts are reported as ArielErrors for the affected query only.
+            Searches still outstanding when the generator is closed, or stops
+            because of an unexpected error, are cancelled.
+            Raises ValueError if max_concurrent is less than 1.
+        '''
+        if max_concurrent < 1:
+            raise ValueError('Invalid concurrency {0}'.format(max_concurrent))
+        if polling is None:
+            polling = AdaptivePolling()
+        pending = deque(enumerate(queries))
+        # search_id -> [index, query, start_time, attempt, next_check_time]
+        outstanding = {}
+
+        try:
+            while pending or outstanding:
+                while pending and len(outstanding) < max_concurrent:
+                    index, query = pending.popleft()
+                    search_id, error = self._submit_search(query, api_version)
+                    if error is not None:
+                        yield (index, None, None, error)
+                        continue
+                    now = time.time()
+                    outstanding[search_id] = [index, query, now, 0, now]
+
+                for search_id, search in list(outstanding.items()):
+                    index, query, start_time, attempt, next_check_time = search
+                    if next_check_time > time.time():
+                        continue
+                    outcome, interval = self._check_outstanding_search(
+                        search_id, query, start_time, timeout, api_version, polling, attempt)
+                    if outcome is not None:
+                        del outstanding[search_id]
+                        yield (index,) + outcome
+                    else:
+                        search[3] = attempt + 1
+                        search[4] = time.time() + interval
+
+                if outstanding and not (pending and len(outstanding) < max_concurrent):
+                    next_check_time = min(search[4] for search in outstanding.values())
+                    time.sleep(max(0, next_check_time - time.time()))
+        finally:
+            # Reached with searches outstanding only if the caller stopped
+            # early or an unexpected error occurred. Their console slots are
+            # freed on a best-effort basis.
+            self._cancel_searches(outstanding, api_version)
+
+    def _submit_search(self, query, api_version):
+        # Returns (search_id, None) if the search was created, otherwise (None, ArielError).
+        try:
+            return self.search(query, api_version)[1], None
+        except ArielError as error:
+            return None, error
+        except requests.exceptions.RequestException as error:
+            return None, _request_error('Ariel search could not be created', error, query)
+
+    def _cancel_searches(self, search_ids, api_version):
+        for search_id in search_ids:
+            try:
+                self.cancel(search_id, api_version)
+            except (ArielError, requests.exceptions.RequestException):
+                pass
+
+    # pylint: disable=too-many-arguments
+    def _check_outstanding_search(self, search_id, query, start_time, timeout,
+                                  api_version, polling, attempt):
+        # Returns ((search_id, record_count, error), None) if the search has finished,
+        # otherwise (None, seconds until it should be checked again).
+        try:
+            status_json = self._status_json(search_id, api_version)
+        except ArielError as error:
+            error.aql = query
+            return (search_id, None, error), None
+        except requests.exceptions.RequestException as error:
+            return (search_id, None, _request_error('Ariel search {0} could not be retrieved'
+                                                    .format(search_id), error, query)), None
+        status = status_json['status']
+        if status == 'COMPLETED':
+            return (search_id, status_json['record_count'], None), None
+        if status in ('CANCELED', 'ERROR'):
+            return (search_id, None, ArielError('Ariel search {0} failed: {1}'
+                                                .format(search_id, status), aql=query)), None
+        now = time.time()
+        end_time = start_time + timeout
+        if now >= end_time:
+            return (search_id, None, ArielError('Ariel search {0} did not complete within {1}s'
+                                                .format(search_id, timeout), aql=query)), None
+        interval = polling.next_interval(attempt, now - start_time, status_json)
+        return None, max(0, min(interval, end_time - now))
+
     def status(self, search_id, api_version='latest'):
         ''' Retrieves status information for a search.
               search_id: Ariel search ID.
@@ -80,12 +261,7 @@ class ArielSearch():
             Returns a tuple containing search status and record count.
             Raises ArielError if the status information could not be retrieved.
         '''
-        response = qpylib.REST('GET', ArielSearch.SEARCH_ENDPOINT.format(search_id),
-                               headers=self._build_headers(api_version))
-        if response.status_code != 200:
-            raise ArielError('Ariel search {0} could not be retrieved: {1}'
-                             .format(search_id, response.content))
-        response_json = response.json()
+        response_json = self._status_json(search_id, api_version)
         return (response_json['status'], response_json['record_count'])
 
     def results(self, search_id, start=0, end=0, api_version='latest'):
@@ -96,17 +272,79 @@ class ArielSearch():
             Raises ValueError if start/end range is not valid.
             Raises ArielError if results could not be retrieved.
         '''
-        if (start < 0) or (start > end):
-            raise ValueError('Invalid range {0} to {1}'.format(start, end))
-        headers = self._build_headers(api_version)
-        if start > 0 or end > 0:
-            headers['Range'] = 'items={0}-{1}'.format(start, end)
-        response = qpylib.REST('GET', ArielSearch.RESULTS_ENDPOINT.format(search_id),
-                               headers=headers)
-        if response.status_code != 200:
-            raise ArielError('Results for Ariel search {0} could not be retrieved: {1}'
-                             .format(search_id, response.content))
-        return response.json()
+        return self._fetch_results(search_id, api_version,
+                                   item_range=self._item_range(start, end))
+
+    # pylint: disable=too-many-arguments
+    def stream_results(self, search_id, start=0, end=0, api_version='latest',
+                       chunk_size=64 * 1024):
+        ''' Generator which yields the records of an Ariel search one at a time,
+            parsing the results response as it is received, so memory use is
+            proportional to one record regardless of the number of records.
+              search_id: Ariel search ID.
+              start, end: range of records to return.
+              api_version: QRadar API version to use, defaults to latest.
+              chunk_size: number of bytes of the response to read at a time.
+            Raises ValueError if start/end range is not valid,
+            or if the response is not valid JSON.
+            Raises ArielError if results could not be retrieved.
+        '''
+        response = self._results_response(search_id, api_version,
+                                          self._item_range(start, end), stream=True)
+        # Ariel results are keyed by record type, e.g. {"events": [...]}.
+        yield from qpylib.iter_json_items(response, key=lambda name: True,
+                                          chunk_size=chunk_size)
+
+    def iter_results(self, search_id, page_size=1000, record_count=None, api_version='latest'):
+        ''' Generator which yields the records of a completed Ariel search one at a time.
+            Records are fetched in consecutive pages using the Range header, so memory
+            use is bounded by page_size regardless of the total number of records.
+              search_id: Ariel search ID.
+              page_size: number of records to fetch per request.
+              record_count: total number of records, as returned by search_sync.
+                If not supplied, it is retrieved using status().
+              api_version: QRadar API version to use, defaults to latest.
+            Raises ValueError if page_size is less than 1.
+            Raises ArielError if a page of results could not be retrieved.
+        '''
+        for item_range in self._result_ranges(search_id, page_size, record_count, api_version):
+            page = self._fetch_results(search_id, api_version, item_range=item_range)
+            yield from self._page_records(page)
+
+    # pylint: disable=too-many-arguments
+    def iter_results_parallel(self, search_id, page_size=1000, max_workers=4,
+                              record_count=None, api_version='latest'):
+        ''' Generator which yields the records of a completed Ariel search one at a time,
+            in order, while fetching pages concurrently on a thread pool.
+            [0, record_count) is split into Range pages of page_size records.
+            At most 2 * max_workers pages are fetched ahead of the consumer,
+            so memory use stays bounded.
+              search_id: Ariel search ID.
+              page_size: number of records to fetch per request.
+              max_workers: number of pages to fetch at the same time.
+              record_count: total number of records, as returned by search_sync.
+                If not supplied, it is retrieved using status().
+              api_version: QRadar API version to use, defaults to latest.
+            Raises ValueError if page_size or max_workers is less than 1.
+            Raises ArielError if a page of results could not be retrieved.
+        '''
+        if max_workers < 1:
+            raise ValueError('Invalid worker count {0}'.format(max_workers))
+        item_ranges = self._result_ranges(search_id, page_size, record_count, api_version)
+        with ThreadPoolExecutor(max_workers=max_workers,
+                                thread_name_prefix='qpylib-ariel-results') as executor:
+            pending = deque()
+            try:
+                for item_range in item_ranges:
+                    pending.append(executor.submit(self._fetch_results_function(),
+                                                   search_id, api_version, item_range))
+                    if len(pending) >= 2 * max_workers:
+                        yield from self._page_records(pending.popleft().result())
+                while pending:
+                    yield from self._page_records(pending.popleft().result())
+            finally:
+                for future in pending:
+                    future.cancel()
 
     def delete(self, search_id, api_version='latest'):
         ''' Deletes a previous Ariel search.
@@ -137,6 +375,62 @@ class ArielSearch():
                              .format(search_id, response.status_code))
         return response.json()['status']
 
+    def _status_json(self, search_id, api_version):
+        response = qpylib.REST('GET', ArielSearch.SEARCH_ENDPOINT.format(search_id),
+                               headers=self._build_headers(api_version))
+        if response.status_code != 200:
+            raise ArielError('Ariel search {0} could not be retrieved: {1}'
+                             .format(search_id, response.content))
+        return response.json()
+
+    def _result_ranges(self, search_id, page_size, record_count, api_version):
+        if page_size < 1:
+            raise ValueError('Invalid page size {0}'.format(page_size))
+        if record_count is None:
+            _, record_count = self.status(search_id, api_version)
+        return [(start, min(start + page_size, record_count) - 1)
+                for start in range(0, record_count, page_size)]
+
+    def _fetch_results_function(self):
+        # Worker threads need their own copy of the Flask request context
+        # so that qpylib.REST can still pick up the SEC and CSRF cookies.
+        if has_request_context():
+            return copy_current_request_context(self._fetch_results)
+        return self._fetch_results
+
+    def _fetch_results(self, search_id, api_version, item_range=None):
+        return self._results_response(search_id, api_version, item_range).json()
+
+    def _results_response(self, search_id, api_version, item_range=None, **kwargs):
+        headers = self._build_headers(api_version)
+        if item_range is not None:
+            headers['Range'] = 'items={0}-{1}'.format(*item_range)
+        response = qpylib.REST('GET', ArielSearch.RESULTS_ENDPOINT.format(search_id),
+                               headers=headers, **kwargs)
+        if response.status_code != 200:
+            raise ArielError('Results for Ariel search {0} could not be retrieved: {1}'
+                             .format(search_id, response.content))
+        return response
+
+    @staticmethod
+    def _item_range(start, end):
+        if (start < 0) or (start > end):
+            raise ValueError('Invalid range {0} to {1}'.format(start, end))
+        if start > 0 or end > 0:
+            return (start, end)
+        return None
+
+    @staticmethod
+    def _page_records(page):
+        # Ariel results are keyed by record type, e.g. {"events": [...]}.
+        if isinstance(page, list):
+            return page
+        records = []
+        for value in page.values():
+            if isinstance(value, list):
+                records.extend(value)
+        return records
+
     @staticmethod
     def _build_headers(api_version):
         headers = {'Accept': 'application/json'}
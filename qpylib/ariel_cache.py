@@ -0,0 +1,197 @@
+# Copyright 2019 IBM Corporation All Rights Reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from collections import OrderedDict
+from concurrent.futures import Future
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from . import app_qpylib, rest_qpylib
+from .ariel import ArielSearch
+
+# Matches a quoted AQL string literal, or a run of whitespace outside of one.
+AQL_TOKEN_PATTERN = re.compile(r'''('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|\s+''')
+
+def normalize_aql(query):
+    ''' Collapses whitespace outside quoted literals and strips a trailing
+        semicolon, so that trivially different query texts share cache entries.
+    '''
+    normalized = AQL_TOKEN_PATTERN.sub(lambda match: match.group(1) or ' ', query)
+    return normalized.strip().rstrip(';').rstrip()
+
+class MemoryCacheBackend():
+    ''' Thread-safe, size-bounded LRU store for cached Ariel data. '''
+    def __init__(self, max_entries=128):
+        if max_entries < 1:
+            raise ValueError('max_entries must be at least 1')
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        ''' Returns the unexpired value stored for key, or None. '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value, expires):
+        ''' Stores value for key until the time.time() value expires. '''
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class DiskCacheBackend():
+    ''' Size-bounded LRU store which keeps cached Ariel data as JSON files,
+        so that entries survive app worker restarts.
+        Files are held in directory get_store_path(directory_name).
+        Values must be JSON-serializable.
+    '''
+    def __init__(self, max_entries=128, directory_name='ariel_cache'):
+        if max_entries < 1:
+            raise ValueError('max_entries must be at least 1')
+        self.max_entries = max_entries
+        self.directory = app_qpylib.get_store_path(directory_name)
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        ''' Returns the unexpired value stored for key, or None. '''
+        path = self._entry_path(key)
+        try:
+            with open(path) as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+        if entry['expires'] <= time.time():
+            self._remove(path)
+            return None
+        try:
+            # Access time is tracked via mtime, which drives LRU eviction.
+            os.utime(path)
+        except OSError:
+            pass
+        return entry['value']
+
+    def put(self, key, value, expires):
+        ''' Stores value for key until the time.time() value expires. '''
+        path = self._entry_path(key)
+        temp_path = '{0}.{1}.{2}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'w') as entry_file:
+            json.dump({'expires': expires, 'value': value}, entry_file)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._evict()
+
+    def clear(self):
+        for file_name in os.listdir(self.directory):
+            self._remove(os.path.join(self.directory, file_name))
+
+    def _entry_path(self, key):
+        digest = hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.json')
+
+    def _evict(self):
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, file_name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+        if len(entries) > self.max_entries:
+            entries.sort()
+            for _, path in entries[:len(entries) - self.max_entries]:
+                self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+class CachedArielSearch(ArielSearch):
+    ''' ArielSearch with a result cache in front of search_sync and results.
+
+        search_sync outcomes are keyed on the normalized AQL text plus API version,
+        results on search ID, range and API version. Every key also includes a digest
+        of the caller's SEC and QRadarCSRF values, because results reflect the
+        permissions of the user who ran the search. Entries expire after ttl seconds.
+        Concurrent identical calls by the same user are coalesced: one caller performs
+        the console request and the others wait for and share its outcome,
+        including errors. Errors are never cached.
+
+        backend defaults to a MemoryCacheBackend holding max_entries entries.
+        Use DiskCacheBackend to share entries across processes and restarts.
+    '''
+    def __init__(self, ttl=30, max_entries=128, backend=None):
+        self.ttl = ttl
+        self.backend = backend if backend is not None else MemoryCacheBackend(max_entries)
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+    # pylint: disable=too-many-arguments
+    def search_sync(self, query, timeout=60, sleep_interval=None, api_version='latest',
+                    polling=None):
+        ''' As ArielSearch.search_sync, but returns a cached outcome for
+            an equivalent query if one is available.
+        '''
+        key = ('search', rest_qpylib.caller_identity(), normalize_aql(query), api_version)
+        outcome = self._cached_call(key, lambda: list(ArielSearch.search_sync(
+            self, query, timeout, sleep_interval, api_version, polling)))
+        return tuple(outcome)
+
+    def results(self, search_id, start=0, end=0, api_version='latest'):
+        ''' As ArielSearch.results, but returns cached results if available. '''
+        key = ('results', rest_qpylib.caller_identity(), search_id, start, end, api_version)
+        return self._cached_call(key, lambda: ArielSearch.results(
+            self, search_id, start, end, api_version))
+
+    def clear(self):
+        ''' Discards all cached entries. '''
+        self.backend.clear()
+
+    def _cached_call(self, key, fetch):
+        value = self.backend.get(key)
+        if value is not None:
+            return value
+
+        with self._in_flight_lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            value = fetch()
+            self.backend.put(key, value, time.time() + self.ttl)
+            future.set_result(value)
+            return value
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
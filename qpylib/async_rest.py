@@ -0,0 +1,81 @@
+# Copyright 2019 IBM Corporation All Rights Reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+import weakref
+from . import qpylib, rest_qpylib
+
+class AsyncREST():
+    ''' asyncio client for the QRadar REST API.
+
+        Requests are built exactly as qpylib.REST builds them: the same URL,
+        header (Version, Host, SEC, QRadarCSRF), proxy and default timeout handling.
+        Headers are resolved on the calling coroutine, so Flask request cookies
+        are picked up when called from an async view.
+
+        The HTTP exchange itself runs on a private thread pool using the pooled
+        keep-alive sessions shared with qpylib.REST. At most max_concurrency
+        requests are in flight at once; further requests wait on a semaphore.
+        A client may be used from several event loops in turn.
+
+        Example:
+            async with AsyncREST(max_concurrency=20) as client:
+                responses = await asyncio.gather(
+                    *[client.request('GET', 'api/siem/offenses/{0}'.format(i)) for i in ids])
+    '''
+    def __init__(self, max_concurrency=10):
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency must be at least 1')
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency,
+                                            thread_name_prefix='qpylib-async-rest')
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._semaphores_lock = threading.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # pylint: disable=too-many-arguments
+    async def request(self, rest_action, request_url, version=None, headers=None, data=None,
+                      params=None, json_body=None, verify=True, timeout=None, retry=None,
+                      cache_ttl=None, **kwargs):
+        ''' Invokes a rest_action request to request_url without blocking the event loop.
+            Parameters are the same as for qpylib.REST, including retry and cache_ttl.
+            If timeout is not supplied, qpylib.QREST_TIMEOUT is used.
+            Returns a requests.Response object.
+            Raises ValueError if rest_action is not one of GET, PUT, POST, DELETE,
+            or if cache_ttl is negative.
+        '''
+        if rest_action.upper() not in ('GET', 'PUT', 'POST', 'DELETE'):
+            raise ValueError('Unsupported REST action was requested')
+        if timeout is None:
+            timeout = qpylib.QREST_TIMEOUT
+        # The URL, headers and proxies are prepared here, on the calling coroutine.
+        send = functools.partial(rest_qpylib.send_prepared, rest_action,
+                                 *rest_qpylib.prepare_request(request_url, version, headers),
+                                 data, params, json_body, verify, timeout, retry, cache_ttl,
+                                 **kwargs)
+        async with self._get_semaphore():
+            return await asyncio.get_running_loop().run_in_executor(self._executor, send)
+
+    def close(self):
+        ''' Releases the worker threads. Requests already in flight are allowed to finish. '''
+        self._executor.shutdown(wait=False)
+
+    def _get_semaphore(self):
+        # asyncio primitives are bound to one event loop, so each loop that uses
+        # this client, e.g. successive asyncio.run calls, gets its own semaphore.
+        loop = asyncio.get_running_loop()
+        with self._semaphores_lock:
+            semaphore = self._semaphores.get(loop)
+            if semaphore is None:
+                semaphore = asyncio.Semaphore(self.max_concurrency)
+                self._semaphores[loop] = semaphore
+            return semaphore
@@ -4,9 +4,13 @@
 
 # pylint: disable=broad-except
 
+import fcntl
 import json
 import os
+import stat
+import threading
 from qpylib import qpylib
+from qpylib.encryption import cryptoutil
 from qpylib.encryption.enginev2 import Enginev2
 from qpylib.encryption.enginev3 import Enginev3
 from qpylib.encryption.enginev4 import Enginev4
@@ -48,12 +52,8 @@ class Encryption():
         if not self.name or not self.user_id:
             raise EncryptionError('Supplied name and user cannot be empty')
 
-        self.app_uuid = os.environ.get('QRADAR_APP_UUID')
-
-        if not self.app_uuid:
-            raise EncryptionError('Environment variable QRADAR_APP_UUID is missing')
-
-        self.config_store_path = qpylib.get_store_path('{0}_e.db'.format(self.user_id))
+        self.app_uuid = _get_app_uuid()
+        self.config_store_path = _config_store_path(self.user_id)
 
         if os.path.isfile(self.config_store_path):
             self.config = self._read_config()
@@ -105,23 +105,26 @@ class Encryption():
 
         return secret
 
+    @staticmethod
+    def clear_key_cache():
+        ''' Discards all derived keys cached in memory by the encryption engines.
+            Subsequent encrypt/decrypt calls derive their keys again.
+        '''
+        cryptoutil.KEY_CACHE.clear()
+
+    @staticmethod
+    def set_key_cache_size(max_entries):
+        ''' Sets the maximum number of derived keys cached in memory.
+            0 disables caching. Defaults to 64.
+        '''
+        cryptoutil.KEY_CACHE.resize(max_entries)
+
     @staticmethod
     def latest_engine_class():
         return Encryption.engines[Encryption.latest_engine_version]
 
     def _choose_engine(self):
-        # If no version is present in the config we default to engine v2.
-        try:
-            engine_version = self.config[self.name]['version']
-        except KeyError:
-            engine_version = 2
-
-        try:
-            engine = Encryption.engines[engine_version]
-        except KeyError:
-            raise EncryptionError('Config for name {0} contains invalid engine version {1}'
-                                  .format(self.name, engine_version))
-        return engine(self.config[self.name], self.app_uuid)
+        return _create_engine(self.name, self.config[self.name], self.app_uuid)
 
     def _reset_config_if_required(self):
         # Keep current config if it has an engine version that is the latest,
@@ -136,17 +139,222 @@ class Encryption():
             self.config[self.name] = self.latest_engine_class().generate_config()
 
     def _read_config(self):
-        try:
-            with open(self.config_store_path) as config_file:
-                return json.load(config_file)
-        except Exception as error:
-            raise EncryptionError('Unable to load config store {0}: {1}'
-                                  .format(self.config_store_path, error))
+        return _read_config_file(self.config_store_path)
 
     def _save_config(self):
+        self.config = _update_config_file(self.config_store_path,
+                                          {self.name: self.config[self.name]})
+
+class EncryptionStore():
+    ''' Batch encryption and decryption of multiple items held in one user's store file.
+
+        The store file is read once when the instance is created and written
+        at most once per batch.
+        New items in a batch share one freshly generated engine config,
+        so a batch of any size costs a single key derivation.
+        Items are fully compatible with those managed by Encryption.
+    '''
+    def __init__(self, user):
+        ''' user: a user identifier, as supplied to Encryption. '''
+        self.user_id = '' if user is None else str(user).strip()
+        if not self.user_id:
+            raise EncryptionError('Supplied user cannot be empty')
+        self.app_uuid = _get_app_uuid()
+        self.config_store_path = _config_store_path(self.user_id)
+        if os.path.isfile(self.config_store_path):
+            self.config = _read_config_file(self.config_store_path)
+        else:
+            self.config = {}
+
+    def encrypt_many(self, items):
+        ''' Encrypts multiple items using the latest engine version.
+              items: dict mapping each name to its clear text value.
+            Stores all encrypted values with a single write to the store file.
+            If any item fails to encrypt, the store file is left unchanged.
+            Returns a dict mapping each name to its encrypted value.
+        '''
+        updated_config = _encrypt_items(items, self.config, self.app_uuid)
+        if updated_config:
+            self.config = _update_config_file(self.config_store_path, updated_config)
+        return {name: item_config['secret'] for name, item_config in updated_config.items()}
+
+    def decrypt_many(self, names):
+        ''' Decrypts multiple items, using the appropriate engine version for each.
+              names: iterable of item names.
+            Any items originally encrypted using an older engine version are
+            re-encrypted using the latest engine with a single store file write,
+            unless another writer has replaced them since the store file was read.
+            Returns a dict mapping each name to its decrypted value.
+        '''
+        decrypted_items = {}
+        legacy_items = {}
+        for name in names:
+            name = _check_name(name)
+            if name not in self.config:
+                raise EncryptionError('No config found for name {0}'.format(name))
+            if 'secret' not in self.config[name]:
+                raise EncryptionError('No secret found for name {0}'.format(name))
+            decrypted_items[name] = _decrypt_item(name, self.config[name], self.app_uuid)
+            if _is_legacy_item(self.config[name]):
+                legacy_items[name] = (self.config[name], decrypted_items[name])
+
+        if legacy_items:
+            def unchanged_items(config):
+                return _encrypt_items({name: clear_text
+                                       for name, (item_config, clear_text) in legacy_items.items()
+                                       if config.get(name) == item_config},
+                                      config, self.app_uuid)
+            self.config = _modify_config_file(self.config_store_path, unchanged_items)
+        return decrypted_items
+
+    def upgrade_legacy_items(self):
+        ''' Re-encrypts all items in the store file which were encrypted using
+            an older engine version. The store file is read, decrypted and written
+            while holding its lock, so concurrent updates are never overwritten.
+            Returns the number of items re-encrypted.
+        '''
+        upgraded = []
+        def legacy_items(config):
+            clear_items = {name: _decrypt_item(name, item_config, self.app_uuid)
+                           for name, item_config in config.items()
+                           if 'secret' in item_config and _is_legacy_item(item_config)}
+            upgraded[:] = clear_items
+            return _encrypt_items(clear_items, config, self.app_uuid)
+        self.config = _modify_config_file(self.config_store_path, legacy_items)
+        return len(upgraded)
+
+    def names(self):
+        ''' Returns the names of all items in the store file. '''
+        return list(self.config)
+
+def _get_app_uuid():
+    app_uuid = os.environ.get('QRADAR_APP_UUID')
+    if not app_uuid:
+        raise EncryptionError('Environment variable QRADAR_APP_UUID is missing')
+    return app_uuid
+
+def _config_store_path(user_id):
+    return qpylib.get_store_path('{0}_e.db'.format(user_id))
+
+def _check_name(name):
+    name = '' if name is None else str(name).strip()
+    if not name:
+        raise EncryptionError('Supplied name cannot be empty')
+    return name
+
+def _create_engine(name, item_config, app_uuid):
+    # If no version is present in the config we default to engine v2.
+    try:
+        engine_version = item_config['version']
+    except KeyError:
+        engine_version = 2
+
+    try:
+        engine = Encryption.engines[engine_version]
+    except KeyError:
+        raise EncryptionError('Config for name {0} contains invalid engine version {1}'
+                              .format(name, engine_version))
+    return engine(item_config, app_uuid)
+
+def _encrypt_items(items, config, app_uuid):
+    # Encrypts items (name -> clear text) using the latest engine version and returns
+    # their new item configs. Items already at the latest version keep their config,
+    # other items share one freshly generated config, costing a single key derivation.
+    engine_class = Encryption.latest_engine_class()
+    shared_config = None
+    updated_config = {}
+    for name, clear_text in items.items():
+        name = _check_name(name)
+        item_config = config.get(name, {})
+        if item_config.get('version') == Encryption.latest_engine_version:
+            item_config = dict(item_config)
+        else:
+            if shared_config is None:
+                shared_config = engine_class.generate_config()
+            item_config = dict(shared_config)
         try:
-            with open(self.config_store_path, 'w') as config_file:
-                config_file.write(json.dumps(self.config))
+            item_config['secret'] = engine_class(item_config, app_uuid).encrypt(clear_text)
         except Exception as error:
-            raise EncryptionError('Unable to save config to {0}: {1}'
-                                  .format(self.config_store_path, error))
+            raise EncryptionError('Failed to encrypt secret for name {0}: {1}'
+                                  .format(name, type(error).__name__))
+        updated_config[name] = item_config
+    return updated_config
+
+def _decrypt_item(name, item_config, app_uuid):
+    engine = _create_engine(name, item_config, app_uuid)
+    try:
+        return engine.decrypt()
+    except Exception as error:
+        raise EncryptionError('Failed to decrypt secret for name {0}: {1}'
+                              .format(name, type(error).__name__))
+
+def _is_legacy_item(item_config):
+    # If no version is present in the config the item uses engine v2.
+    return item_config.get('version', 2) != Encryption.latest_engine_version
+
+def _update_config_file(config_store_path, updates):
+    # Merges updates (name -> item config) into the store file and returns the merged config.
+    return _modify_config_file(config_store_path, lambda config: updates)
+
+def _modify_config_file(config_store_path, get_updates):
+    # Calls get_updates with the current store file content and merges the
+    # returned updates (name -> item config) into the store file, if there are any.
+    # Returns the merged config.
+    # An exclusive advisory lock on a companion .lock file serialises writers across
+    # processes and threads, and is held while get_updates runs, so that it sees
+    # the latest content; the store file itself is replaced via rename, so
+    # readers never need the lock and never see a partially written file.
+    temp_path = '{0}.{1}.{2}.tmp'.format(config_store_path, os.getpid(), threading.get_ident())
+    try:
+        with open(config_store_path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.path.isfile(config_store_path):
+                    config = _read_config_file(config_store_path)
+                else:
+                    config = {}
+                updates = get_updates(config)
+                if updates:
+                    _write_config_file(config_store_path, temp_path, dict(config, **updates))
+                    config.update(updates)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    except EncryptionError:
+        raise
+    except Exception as error:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise EncryptionError('Unable to save config to {0}: {1}'
+                              .format(config_store_path, error))
+    return config
+
+def _write_config_file(config_store_path, temp_path, config):
+    # The store file is replaced rather than written to, which only
+    # needs directory access, so a read-only store must be refused here.
+    # The replacement keeps the permissions of the file it replaces, and
+    # gets them before any content is written.
+    store_exists = os.path.isfile(config_store_path)
+    if store_exists and not _is_writable(config_store_path):
+        raise PermissionError('store file is not writable')
+    with open(temp_path, 'w') as config_file:
+        if store_exists:
+            os.fchmod(config_file.fileno(),
+                      stat.S_IMODE(os.stat(config_store_path).st_mode))
+        config_file.write(json.dumps(config))
+        config_file.flush()
+        os.fsync(config_file.fileno())
+    os.replace(temp_path, config_store_path)
+
+def _is_writable(path):
+    # Permission bits are checked as well as os.access, which always
+    # succeeds for root, so that a store marked read-only stays unchanged.
+    return (os.access(path, os.W_OK)
+            and os.stat(path).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH) != 0)
+
+def _read_config_file(config_store_path):
+    try:
+        with open(config_store_path) as config_file:
+            return json.load(config_file)
+    except Exception as error:
+        raise EncryptionError('Unable to load config store {0}: {1}'
+                              .format(config_store_path, error))
@@ -0,0 +1,106 @@
+# Copyright 2019 IBM Corporation All Rights Reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+''' Upgrades all encrypted items in the app's store files to the latest engine version.
+
+    Encryption.decrypt() re-encrypts items from older engine versions on first
+    access, which adds key derivations and a store file rewrite to that request.
+    Running the migration at app startup, or from the command line:
+        python -m qpylib.encdec_migration [--workers N]
+    moves that cost off the request path.
+'''
+
+# pylint: disable=broad-except
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import os
+import threading
+import time
+from qpylib import qpylib
+from qpylib.encdec import EncryptionStore
+
+STORE_FILE_SUFFIX = '_e.db'
+
+def migrate_legacy_secrets(max_workers=None, progress_callback=None):
+    ''' Scans every *_e.db store file under the app store path and re-encrypts
+        any items that were encrypted using an older engine version.
+        Store files are processed in parallel on a process pool.
+          max_workers: number of worker processes, defaults to the CPU count.
+          progress_callback: if supplied, called in this process after each
+            store file with (files_done, files_total, items_migrated, elapsed_seconds).
+        Returns a dict with these keys:
+          files: number of store files scanned.
+          migrated: number of items re-encrypted.
+          errors: dict mapping store file path to error message for failed files.
+          elapsed: seconds taken.
+          items_per_second: migration throughput.
+    '''
+    start_time = time.time()
+    store_paths = find_store_files()
+    migrated = 0
+    errors = {}
+    files_done = 0
+    if store_paths:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_migrate_store_file, path): path for path in store_paths}
+            for future in as_completed(futures):
+                try:
+                    migrated += future.result()
+                except Exception as error:
+                    errors[futures[future]] = str(error)
+                files_done += 1
+                if progress_callback:
+                    progress_callback(files_done, len(store_paths), migrated,
+                                      time.time() - start_time)
+    elapsed = time.time() - start_time
+    return {'files': len(store_paths),
+            'migrated': migrated,
+            'errors': errors,
+            'elapsed': elapsed,
+            'items_per_second': migrated / elapsed if elapsed > 0 else 0.0}
+
+def start_background_migration(max_workers=None, progress_callback=None, done_callback=None):
+    ''' Runs migrate_legacy_secrets on a daemon thread so that app startup is not delayed.
+        If supplied, done_callback is called with the summary dict when migration ends.
+        Returns the started threading.Thread.
+    '''
+    def _run():
+        summary = migrate_legacy_secrets(max_workers, progress_callback)
+        if done_callback:
+            done_callback(summary)
+    thread = threading.Thread(target=_run, name='qpylib-encdec-migration', daemon=True)
+    thread.start()
+    return thread
+
+def find_store_files():
+    ''' Returns the paths of all encryption store files under the app store path. '''
+    return sorted(glob.glob(qpylib.get_store_path('*' + STORE_FILE_SUFFIX)))
+
+def _migrate_store_file(store_path):
+    # Runs in a worker process. Returns the number of items re-encrypted.
+    user_id = os.path.basename(store_path)[:-len(STORE_FILE_SUFFIX)]
+    return EncryptionStore(user_id).upgrade_legacy_items()
+
+def _print_progress(files_done, files_total, items_migrated, elapsed):
+    print('{0}/{1} store files, {2} items migrated, {3:.1f}s'
+          .format(files_done, files_total, items_migrated, elapsed))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Re-encrypt legacy items in app store files using the latest engine version.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: CPU count)')
+    args = parser.parse_args(argv)
+    summary = migrate_legacy_secrets(args.workers, _print_progress)
+    print('Migrated {0} items in {1} store files in {2:.1f}s ({3:.1f} items/s)'
+          .format(summary['migrated'], summary['files'], summary['elapsed'],
+                  summary['items_per_second']))
+    for store_path, error in summary['errors'].items():
+        print('Failed to migrate {0}: {1}'.format(store_path, error))
+    return 1 if summary['errors'] else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
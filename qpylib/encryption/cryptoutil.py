@@ -2,6 +2,9 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+from collections import OrderedDict
+import hashlib
+import threading
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
@@ -13,3 +16,60 @@ def derive_key(key_material, salt, iterations=100000, length=32):
                      iterations=iterations,
                      backend=default_backend())
     return kdf.derive(key_material)
+
+class DerivedKeyCache():
+    ''' Thread-safe, size-bounded LRU cache of derived encryption keys.
+        Saves repeating an expensive key derivation (e.g. 100,000 PBKDF2
+        iterations) every time the same secret is encrypted or decrypted.
+        Entries are keyed on engine version, salt, iterations, key length and
+        a SHA-256 digest of the key material, so the raw key material is never
+        retained. Keys are held in process memory only and never persisted.
+        A max_entries value of 0 disables caching.
+    '''
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    # pylint: disable=too-many-arguments
+    def get_or_derive(self, version, key_material, salt, iterations, length, derive):
+        ''' Returns the cached key for the given parameters, calling
+            derive() to compute and cache it if it is not present.
+        '''
+        if isinstance(key_material, str):
+            key_material = key_material.encode('utf-8')
+        cache_key = (version, salt, iterations, length, hashlib.sha256(key_material).digest())
+        with self._lock:
+            key = self._keys.get(cache_key)
+            if key is not None:
+                self._keys.move_to_end(cache_key)
+                return key
+        key = derive()
+        with self._lock:
+            if self.max_entries > 0:
+                self._keys[cache_key] = key
+                self._keys.move_to_end(cache_key)
+                self._trim()
+        return key
+
+    def resize(self, max_entries):
+        ''' Changes the maximum number of cached keys, discarding the oldest if necessary. '''
+        if max_entries < 0:
+            raise ValueError('max_entries cannot be negative')
+        with self._lock:
+            self.max_entries = max_entries
+            self._trim()
+
+    def clear(self):
+        ''' Discards all cached keys. '''
+        with self._lock:
+            self._keys.clear()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _trim(self):
+        while len(self._keys) > self.max_entries:
+            self._keys.popitem(last=False)
+
+KEY_CACHE = DerivedKeyCache()
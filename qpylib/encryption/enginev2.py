@@ -5,6 +5,7 @@
 from binascii import a2b_hex
 from Crypto.Cipher import AES
 from Crypto.Protocol import KDF
+from . import cryptoutil
 
 class Enginev2():
     ''' Enginev2 is derived from the Encryption class as contained in the
@@ -39,10 +40,12 @@ class Enginev2():
         return self._unpad_string(clear_text_padded_string)
 
     def _derive_key(self):
-        return KDF.PBKDF2(self.app_uuid + self.config['UUID'],
-                          self.config['salt'].encode('utf-8'),
-                          dkLen=16,
-                          count=self.config['iterations'])
+        key_material = self.app_uuid + self.config['UUID']
+        salt = self.config['salt'].encode('utf-8')
+        iterations = self.config['iterations']
+        return cryptoutil.KEY_CACHE.get_or_derive(
+            self.version, key_material, salt, iterations, 16,
+            lambda: KDF.PBKDF2(key_material, salt, dkLen=16, count=iterations))
 
     @staticmethod
     def _unpad_string(value):
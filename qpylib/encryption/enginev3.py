@@ -6,6 +6,7 @@ from binascii import a2b_hex
 from Crypto.Cipher import AES
 from Crypto.Protocol import KDF
 from Crypto.Util.Padding import unpad
+from . import cryptoutil
 
 class Enginev3():
     ''' Enginev3 uses a modified version of Enginev2's AES/CFB encryption.
@@ -31,7 +32,9 @@ class Enginev3():
         return decrypted_bytes.decode('utf-8')
 
     def _derive_key(self):
-        return KDF.PBKDF2(self.app_uuid + self.config['UUID'],
-                          self.config['salt'].encode('utf-8'),
-                          dkLen=32,
-                          count=self.config['iterations'])
+        key_material = self.app_uuid + self.config['UUID']
+        salt = self.config['salt'].encode('utf-8')
+        iterations = self.config['iterations']
+        return cryptoutil.KEY_CACHE.get_or_derive(
+            self.version, key_material, salt, iterations, 32,
+            lambda: KDF.PBKDF2(key_material, salt, dkLen=32, count=iterations))
@@ -28,9 +28,12 @@ class Enginev4():
         return decrypted_bytes.decode('utf-8')
 
     def _derive_key(self):
-        key = cryptoutil.derive_key(self.app_uuid.encode('utf-8'),
-                                    self.config['salt'].encode('utf-8'),
-                                    self.config['iterations'])
+        key_material = self.app_uuid.encode('utf-8')
+        salt = self.config['salt'].encode('utf-8')
+        iterations = self.config['iterations']
+        key = cryptoutil.KEY_CACHE.get_or_derive(
+            self.version, key_material, salt, iterations, 32,
+            lambda: cryptoutil.derive_key(key_material, salt, iterations))
         return base64.urlsafe_b64encode(key)
 
     @staticmethod
@@ -2,6 +2,7 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import codecs
 import json
 from . import app_qpylib
 
@@ -11,22 +12,12 @@ KEY_TYPE = '@type'
 KEY_ID = '@id'
 
 def register_jsonld_endpoints():
-    try:
-        services = app_qpylib.get_manifest_json()['services']
-    except KeyError:
-        return
-
-    for service in services:
+    for endpoint in app_qpylib.get_manifest().endpoints:
+        _extract_and_register_jsonld_context(endpoint, 'request_mime_type', 'request_body_type')
         try:
-            endpoints = service['endpoints']
+            _extract_and_register_jsonld_context(endpoint['response'], 'mime_type', 'body_type')
         except KeyError:
-            continue
-        for endpoint in endpoints:
-            _extract_and_register_jsonld_context(endpoint, 'request_mime_type', 'request_body_type')
-            try:
-                _extract_and_register_jsonld_context(endpoint['response'], 'mime_type', 'body_type')
-            except KeyError:
-                pass
+            pass
 
 def _extract_and_register_jsonld_context(endpoint_direction, mime_id, body_id):
     try:
@@ -94,3 +85,135 @@ def to_json_dict(python_obj, classkey=None):
             data[classkey] = python_obj.__class__.__name__
         return data
     return python_obj
+
+JSON_DECODER = json.JSONDecoder()
+JSON_WHITESPACE = ' \t\n\r'
+JSON_DELIMITERS = JSON_WHITESPACE + ',:]}'
+
+def iter_json_items(response, key=None, chunk_size=64 * 1024):
+    # Parses the body of a streamed response as it arrives, so that only one
+    # element is held in memory at a time. The response is closed when done.
+    if key is None or callable(key):
+        expand = key
+    else:
+        def expand(name):
+            return name == key
+    stream = _JsonStream(response.iter_content(chunk_size), response.encoding)
+    try:
+        yield from stream.items(expand)
+    finally:
+        response.close()
+
+class _JsonStream():
+    ''' Incremental parser for a JSON array or object delivered in chunks.
+        Each element is decoded by json.JSONDecoder once it is complete.
+    '''
+    def __init__(self, chunks, encoding):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder(encoding or 'utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def items(self, expand):
+        ''' Yields the elements of a top-level array, or (name, value) pairs
+            for the members of a top-level object.
+            If expand is not None, it is called with each member name, and the
+            elements of arrays whose member names it accepts are yielded instead.
+            Other members are skipped.
+        '''
+        char = self._next_char()
+        if char == '[':
+            yield from self._array_items()
+        elif char == '{':
+            for name in self._member_names():
+                if expand is None:
+                    yield name, self._value()
+                elif expand(name) and self._peek_char() == '[':
+                    self._next_char()
+                    yield from self._array_items()
+                else:
+                    self._value()
+        else:
+            raise ValueError('JSON body is not an array or object')
+        self._check_end()
+
+    def _array_items(self):
+        for _ in self._elements(']'):
+            yield self._value()
+
+    def _member_names(self):
+        for _ in self._elements('}'):
+            name = self._value()
+            if not isinstance(name, str) or self._next_char() != ':':
+                raise ValueError('Invalid JSON object member')
+            yield name
+
+    def _elements(self, closing):
+        # Yields once per element, leaving the stream positioned at its start.
+        if self._peek_char() == closing:
+            self._next_char()
+            return
+        while True:
+            yield
+            char = self._next_char()
+            if char == closing:
+                return
+            if char != ',':
+                raise ValueError('Expected , or {0} in JSON body but found {1}'
+                                 .format(closing, char))
+
+    def _value(self):
+        self._peek_char()
+        needed = 0
+        while True:
+            if self._eof or len(self._buffer) - self._pos >= needed:
+                try:
+                    value, end = JSON_DECODER.raw_decode(self._buffer, self._pos)
+                except json.JSONDecodeError as error:
+                    if self._eof:
+                        raise ValueError('Invalid JSON body: {0}'.format(error))
+                else:
+                    # A value which is not followed by a delimiter, e.g. 1 of 1.5,
+                    # may continue in the next chunk.
+                    if self._eof or (end < len(self._buffer)
+                                     and self._buffer[end] in JSON_DELIMITERS):
+                        self._pos = end
+                        return value
+                # Wait until the unparsed text has doubled before decoding again,
+                # so that a large element is decoded a logarithmic number of times.
+                needed = 2 * (len(self._buffer) - self._pos)
+            self._fill()
+
+    def _peek_char(self):
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in JSON_WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if self._eof:
+                raise ValueError('Unexpected end of JSON body')
+            self._fill()
+
+    def _next_char(self):
+        char = self._peek_char()
+        self._pos += 1
+        return char
+
+    def _check_end(self):
+        try:
+            char = self._peek_char()
+        except ValueError:
+            return
+        raise ValueError('Unexpected {0} after end of JSON body'.format(char))
+
+    def _fill(self):
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._eof = True
+            text = self._decoder.decode(b'', final=True)
+        else:
+            text = self._decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
@@ -2,9 +2,21 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import atexit
+from collections import deque, OrderedDict
+import copy
+import gzip
+import hashlib
+import json
 import logging
-from logging.handlers import RotatingFileHandler, SysLogHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, SysLogHandler, \
+                             TimedRotatingFileHandler
+import os
+import queue
 import re
+import socket
+import threading
+import time
 from qpylib.encryption.cryptoutil import derive_key
 from . import app_qpylib, util_qpylib
 
@@ -37,20 +49,104 @@ APP_FILE_LOG_FORMAT = '%(asctime)s [%(threadName)s] [%(levelname)s] [APP_ID:APPI
 SYSLOG_LOG_FORMAT = '1 %(asctime)s HOSTNAME APPNAME PROCID - - [NOT:%(ncode)s] %(message)s'
 SYSLOG_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
 
+# Local file log formats, see create_log.
+# The JSON format writes one JSON object per line, e.g.
+# {"app_id": "1005", "hostname": "d15fbd9fdd86b30e", "app_name": "MyExampleApp",
+#  "timestamp": "2020-08-19T12:48:11.423+0100", "thread": "Thread-4", "level": "INFO",
+#  "ncode": "0000006000", "message": "hello", "fields": {"offense_id": 42}}
+# hostname and app_name are the same values used in Syslog records and are
+# omitted if they cannot be determined. fields is present only if supplied to log().
+LOG_FORMAT_TEXT = 'text'
+LOG_FORMAT_JSON = 'json'
+
+# Syslog transports, see create_log.
+SYSLOG_TRANSPORT_UDP = 'udp'
+SYSLOG_TRANSPORT_TCP = 'tcp'
+
+# Policies for a full log queue, see create_log.
+QUEUE_FULL_BLOCK = 'block'
+QUEUE_FULL_DROP_OLDEST = 'drop_oldest'
+QUEUE_FULL_DROP = 'drop'
+
+LOG_LEVEL_TO_NUMBER = {
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR,
+    'EXCEPTION': logging.ERROR,
+    'CRITICAL': logging.CRITICAL
+}
+
+# Local file log rotation, configurable via the manifest "log_rotation" object, e.g.
+# "log_rotation": {"when": "midnight", "backup_count": 14, "compress": true}
+# when: "size" rotates when the file reaches max_bytes. Any other value is a
+#   TimedRotatingFileHandler "when" value (S, M, H, D, midnight, W0-W6),
+#   and the file rotates every interval units of that value.
+# backup_count: number of rotated files to keep.
+# compress: if true, rotated files are gzipped on a background thread.
+LOG_ROTATION_SIZE = 'size'
+LOG_ROTATION_TIMED = ('S', 'M', 'H', 'D', 'MIDNIGHT', 'W0', 'W1', 'W2', 'W3', 'W4', 'W5', 'W6')
+DEFAULT_LOG_ROTATION = {
+    'when': LOG_ROTATION_SIZE,
+    'interval': 1,
+    'max_bytes': 2*1024*1024,
+    'backup_count': 5,
+    'compress': False
+}
+
+# Pseudo-hostnames for Syslog, see _create_pseudo_hostname.
+PSEUDO_HOSTNAME_FILE = 'syslog_hostname.json'
+PSEUDO_HOSTNAMES = {}
+
 # Globals related to logging.Logger instance.
 QLOGGER = None
 LOG_LEVEL_TO_FUNCTION = None
+QUEUE_LISTENER = None
 
-def create_log(syslog_enabled=True):
+# pylint: disable=too-many-arguments
+def create_log(syslog_enabled=True, queued=False, queue_size=10000,
+               queue_full_policy=QUEUE_FULL_BLOCK, syslog_transport=SYSLOG_TRANSPORT_UDP,
+               log_format=LOG_FORMAT_TEXT, duplicate_window=0, duplicate_limit=1,
+               syslog_ssl_context=None):
     global QLOGGER
     if QLOGGER:
         return
-    QLOGGER = logging.getLogger('com.ibm.applicationLogger')
+    if syslog_transport not in (SYSLOG_TRANSPORT_UDP, SYSLOG_TRANSPORT_TCP):
+        raise ValueError("Unknown syslog transport: '{0}'".format(syslog_transport))
+    if syslog_ssl_context is not None and syslog_transport != SYSLOG_TRANSPORT_TCP:
+        raise ValueError("syslog_ssl_context requires syslog transport '{0}'"
+                         .format(SYSLOG_TRANSPORT_TCP))
+    if log_format not in (LOG_FORMAT_TEXT, LOG_FORMAT_JSON):
+        raise ValueError("Unknown log format: '{0}'".format(log_format))
+    log_rotation = _log_rotation_settings()
+    if queued:
+        queue_handler = _create_queue_handler(queue_size, queue_full_policy)
+    logger = logging.getLogger('com.ibm.applicationLogger')
+    if duplicate_window:
+        repeat_filter = RepeatedMessageFilter(logger, duplicate_window, duplicate_limit)
+    QLOGGER = logger
     QLOGGER.setLevel(_default_log_level())
+    if duplicate_window:
+        # Added first, so that suppressed records skip all other processing.
+        QLOGGER.addFilter(repeat_filter)
     QLOGGER.addFilter(NotificationCodeFilter())
 
-    for handler in _generate_handlers(syslog_enabled):
-        QLOGGER.addHandler(handler)
+    handlers = _generate_handlers(syslog_enabled, syslog_transport, log_format, log_rotation,
+                                  syslog_ssl_context)
+    if queued:
+        # Handlers run on the listener thread, so callers only pay for a queue put.
+        global QUEUE_LISTENER
+        QUEUE_LISTENER = QueueListener(queue_handler.queue, *handlers,
+                                       respect_handler_level=True)
+        QUEUE_LISTENER.start()
+        atexit.register(stop_log_queue)
+        QLOGGER.addHandler(queue_handler)
+    else:
+        for handler in handlers:
+            QLOGGER.addHandler(handler)
+    if duplicate_window:
+        # Registered after stop_log_queue, so it runs first at exit.
+        atexit.register(repeat_filter.flush)
 
     global LOG_LEVEL_TO_FUNCTION
     LOG_LEVEL_TO_FUNCTION = {
@@ -62,34 +158,150 @@ def create_log(syslog_enabled=True):
         'CRITICAL': QLOGGER.critical
     }
 
-def log(message, level):
+def log(message, level, args=None, fields=None):
     if not LOG_LEVEL_TO_FUNCTION:
         raise RuntimeError('You cannot use log before logging has been initialised')
-    log_function = LOG_LEVEL_TO_FUNCTION.get(level.upper())
+    level_name = level.upper()
+    log_function = LOG_LEVEL_TO_FUNCTION.get(level_name)
     if not log_function:
         raise ValueError("Unknown level: '{0}'".format(level))
-    log_function(_sanitize(message))
+    # Check the threshold before doing any work on the message.
+    if not QLOGGER.isEnabledFor(LOG_LEVEL_TO_NUMBER[level_name]):
+        return
+    if fields:
+        log_function(SanitizedMessage(message, args), extra={'qfields': fields})
+    else:
+        log_function(SanitizedMessage(message, args))
 
 def set_log_level(level='INFO'):
     if not QLOGGER:
         raise RuntimeError('You cannot use set_log_level before logging has been initialised')
     QLOGGER.setLevel(level.upper())
 
+def stop_log_queue():
+    # Processes all queued records, then stops the listener thread.
+    global QUEUE_LISTENER
+    if QUEUE_LISTENER:
+        QUEUE_LISTENER.stop()
+        QUEUE_LISTENER = None
+
+def get_dropped_log_count():
+    if QLOGGER:
+        for handler in QLOGGER.handlers:
+            if isinstance(handler, BoundedQueueHandler):
+                return handler.dropped_count
+    return 0
+
+def _create_queue_handler(queue_size, queue_full_policy):
+    if queue_full_policy not in (QUEUE_FULL_BLOCK, QUEUE_FULL_DROP_OLDEST, QUEUE_FULL_DROP):
+        raise ValueError("Unknown queue full policy: '{0}'".format(queue_full_policy))
+    if queue_size < 1:
+        raise ValueError('Log queue size must be at least 1')
+    return BoundedQueueHandler(queue.Queue(maxsize=queue_size), queue_full_policy)
+
 def _default_log_level():
-    return app_qpylib.get_manifest_field_value('log_level', 'INFO').upper()
+    log_level = app_qpylib.get_manifest().log_level
+    return 'INFO' if log_level is None else log_level.upper()
 
 def _log_file_location():
     return app_qpylib.get_log_path('app.log')
 
+def _manifest_log_rotation():
+    return app_qpylib.get_manifest_field_value('log_rotation', {})
+
+def _log_rotation_settings():
+    log_rotation = _manifest_log_rotation()
+    if not isinstance(log_rotation, dict):
+        raise ValueError('Manifest log_rotation must be an object')
+    unknown_keys = set(log_rotation) - set(DEFAULT_LOG_ROTATION)
+    if unknown_keys:
+        raise ValueError('Unknown manifest log_rotation fields: {0}'
+                         .format(', '.join(sorted(unknown_keys))))
+    settings = dict(DEFAULT_LOG_ROTATION, **log_rotation)
+    when = str(settings['when'])
+    if when != LOG_ROTATION_SIZE and when.upper() not in LOG_ROTATION_TIMED:
+        raise ValueError("Unknown log rotation when: '{0}'".format(when))
+    minimums = {'interval': 1, 'max_bytes': 1, 'backup_count': 0}
+    for key, minimum in minimums.items():
+        value = settings[key]
+        if isinstance(value, bool) or not isinstance(value, int) or value < minimum:
+            raise ValueError('Log rotation {0} must be an integer of at least {1}'
+                             .format(key, minimum))
+    if not isinstance(settings['compress'], bool):
+        raise ValueError('Log rotation compress must be true or false')
+    return settings
+
 def _sanitize(message):
     # Use repr to suppress \t, \n, \r, and strip the surrounding quotes added by repr.
     return repr(message)[1:-1]
 
-def _generate_handlers(syslog_enabled):
+class SanitizedMessage():
+    ''' Log record message which defers %-style formatting and sanitization
+        until a handler actually emits the record.
+    '''
+    __slots__ = ('message', 'args')
+
+    def __init__(self, message, args=None):
+        self.message = message
+        self.args = args
+
+    def __str__(self):
+        return _sanitize(self.unsanitized())
+
+    def unsanitized(self):
+        ''' Returns the formatted message without control character suppression. '''
+        if self.args is None:
+            return self.message
+        args = self.args if isinstance(self.args, (tuple, dict)) else (self.args,)
+        return str(self.message) % args
+
+class JsonFormatter(logging.Formatter):
+    ''' Formats each record as a single-line JSON object.
+        constant_fields are serialized once, when the formatter is created,
+        and spliced into every record.
+        Control characters in the message are escaped by JSON encoding
+        rather than by the text-format sanitization.
+    '''
+    def __init__(self, constant_fields):
+        super().__init__()
+        self._constant_json = json.dumps(constant_fields)[1:-1]
+
+    def format(self, record):
+        if isinstance(record.msg, SanitizedMessage) and not record.args:
+            message = str(record.msg.unsanitized())
+        else:
+            message = record.getMessage()
+        record_fields = {
+            'timestamp': self.formatTime(record),
+            'thread': record.threadName,
+            'level': record.levelname,
+            'ncode': getattr(record, 'ncode', NotificationCodeFilter.Q_INFO_CODE),
+            'message': message
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            record_fields['exception'] = record.exc_text
+        fields = getattr(record, 'qfields', None)
+        if fields:
+            record_fields['fields'] = fields
+        record_json = json.dumps(record_fields, default=str)
+        if not self._constant_json:
+            return record_json
+        return '{' + self._constant_json + ', ' + record_json[1:]
+
+    def formatTime(self, record, datefmt=None):
+        created = self.converter(record.created)
+        return '{0}.{1:03d}{2}'.format(time.strftime('%Y-%m-%dT%H:%M:%S', created),
+                                       int(record.msecs), time.strftime('%z', created))
+
+def _generate_handlers(syslog_enabled, syslog_transport=SYSLOG_TRANSPORT_UDP,
+                       log_format=LOG_FORMAT_TEXT, log_rotation=None,
+                       syslog_ssl_context=None):
     handlers = []
 
     app_id = str(app_qpylib.get_app_id())
-    handlers.append(_create_file_handler(app_id))
+    handlers.append(_create_file_handler(app_id, log_format, log_rotation))
 
     if syslog_enabled:
         address = None
@@ -100,19 +312,129 @@ def _generate_handlers(syslog_enabled):
         except KeyError:
             pass
         if address and qradar_app_uuid:
-            handlers.append(_create_syslog_handler(address, app_id, qradar_app_uuid))
+            handlers.append(_create_syslog_handler(address, app_id, qradar_app_uuid,
+                                                   syslog_transport, syslog_ssl_context))
 
     return handlers
 
-def _create_file_handler(app_id):
-    handler = RotatingFileHandler(_log_file_location(), maxBytes=2*1024*1024, backupCount=5)
-    log_format = APP_FILE_LOG_FORMAT.replace('APPID', app_id)
-    handler.setFormatter(logging.Formatter(log_format))
+def _create_file_handler(app_id, log_format=LOG_FORMAT_TEXT, log_rotation=None):
+    handler = _create_rotating_file_handler(log_rotation or DEFAULT_LOG_ROTATION)
+    if log_format == LOG_FORMAT_JSON:
+        handler.setFormatter(JsonFormatter(_json_constant_fields(app_id)))
+    else:
+        handler.setFormatter(logging.Formatter(APP_FILE_LOG_FORMAT.replace('APPID', app_id)))
     return handler
 
-def _create_syslog_handler(syslog_address, app_id, qradar_app_uuid):
+def _create_rotating_file_handler(log_rotation):
+    if log_rotation['when'] == LOG_ROTATION_SIZE:
+        handler_class = GzipRotatingFileHandler if log_rotation['compress'] else RotatingFileHandler
+        return handler_class(_log_file_location(), maxBytes=log_rotation['max_bytes'],
+                             backupCount=log_rotation['backup_count'])
+    handler_class = GzipTimedRotatingFileHandler if log_rotation['compress'] \
+                    else TimedRotatingFileHandler
+    return handler_class(_log_file_location(), when=log_rotation['when'],
+                         interval=log_rotation['interval'],
+                         backupCount=log_rotation['backup_count'])
+
+def _gzip_file(source, destination):
+    # Writes to a temporary file first so that destination is never partially written.
+    # On failure the uncompressed source is left in place rather than lost.
+    temp_destination = destination + '.tmp'
+    try:
+        with open(source, 'rb') as source_file, gzip.open(temp_destination, 'wb') as gzip_file:
+            while True:
+                chunk = source_file.read(1024*1024)
+                if not chunk:
+                    break
+                gzip_file.write(chunk)
+        os.replace(temp_destination, destination)
+        os.remove(source)
+    except OSError:
+        if os.path.exists(temp_destination):
+            os.remove(temp_destination)
+
+class _GzipRotationMixin():
+    ''' Rollover behaviour shared by the gzip rotating file handlers.
+        A rollover only renames the current log file out of the way;
+        gzip compression then runs on a background thread.
+    '''
+    _compression_thread = None
+
+    def rotation_filename(self, default_name):
+        return default_name + '.gz'
+
+    def rotate(self, source, dest):
+        if not os.path.exists(source):
+            return
+        # The pending name starts with '.' so that it never matches the backup
+        # naming scheme, and is never renamed or deleted as a backup file.
+        directory, name = os.path.split(dest)
+        pending = os.path.join(directory, '.{0}.pending'.format(name))
+        os.rename(source, pending)
+        self._compression_thread = threading.Thread(target=self._compress, args=(pending, dest),
+                                                    name='qpylib-log-compression')
+        self._compression_thread.start()
+
+    def _compress(self, source, destination):
+        _gzip_file(source, destination)
+
+    def doRollover(self): # pylint: disable=invalid-name
+        # Backups are renamed during rollover, so the previous compression must be complete.
+        self.wait_for_compression()
+        super().doRollover()
+
+    def close(self):
+        super().close()
+        self.wait_for_compression()
+
+    def wait_for_compression(self):
+        ''' Blocks until any background compression of a rotated file is complete. '''
+        compression_thread = self._compression_thread
+        if compression_thread:
+            compression_thread.join()
+            self._compression_thread = None
+
+class GzipRotatingFileHandler(_GzipRotationMixin, RotatingFileHandler):
+    ''' RotatingFileHandler which gzips rotated files on a background thread.
+        Rotated files are named app.log.1.gz, app.log.2.gz and so on.
+    '''
+
+class GzipTimedRotatingFileHandler(_GzipRotationMixin, TimedRotatingFileHandler):
+    ''' TimedRotatingFileHandler which gzips rotated files on a background thread.
+        Rotated files are named with a date/time suffix, e.g. app.log.2020-08-19.gz.
+    '''
+    def getFilesToDelete(self): # pylint: disable=invalid-name
+        # doRollover calls this while the file it just rotated may still be
+        # compressing under its pending name, where it would not be counted.
+        # Old backups are deleted by _compress instead, once it has finished.
+        return []
+
+    def _compress(self, source, destination):
+        super()._compress(source, destination)
+        if self.backupCount > 0:
+            for backup in super().getFilesToDelete():
+                os.remove(backup)
+
+def _json_constant_fields(app_id):
+    constant_fields = {'app_id': app_id}
+    try:
+        qradar_app_uuid = app_qpylib.get_env_var('QRADAR_APP_UUID')
+        constant_fields['hostname'] = _create_pseudo_hostname(app_id, qradar_app_uuid)
+    except KeyError:
+        pass
+    try:
+        constant_fields['app_name'] = _create_sanitized_app_name()
+    except (KeyError, OSError):
+        pass
+    return constant_fields
+
+def _create_syslog_handler(syslog_address, app_id, qradar_app_uuid,
+                           syslog_transport=SYSLOG_TRANSPORT_UDP, syslog_ssl_context=None):
     log_format = _create_syslog_log_format(app_id, qradar_app_uuid)
-    handler = SysLogHandler(address=syslog_address)
+    if syslog_transport == SYSLOG_TRANSPORT_TCP:
+        handler = BatchedTCPSyslogHandler(syslog_address, ssl_context=syslog_ssl_context)
+    else:
+        handler = SysLogHandler(address=syslog_address)
     handler.setFormatter(logging.Formatter(log_format, SYSLOG_TIME_FORMAT))
     return handler
 
@@ -130,6 +452,22 @@ def _create_syslog_log_format(app_id, qradar_app_uuid):
                             .replace('PROCID', app_id)
 
 def _create_pseudo_hostname(app_id, qradar_app_uuid):
+    # Deriving the value is expensive, so it is cached in memory
+    # and in the store directory, where it survives container and worker restarts.
+    # The store file is keyed on a digest of app ID and UUID, never the UUID itself.
+    cache_key = hashlib.sha256('{0}:{1}'.format(app_id, qradar_app_uuid)
+                               .encode('utf-8')).hexdigest()
+    pseudo_hostname = PSEUDO_HOSTNAMES.get(cache_key)
+    if pseudo_hostname:
+        return pseudo_hostname
+    pseudo_hostname = _read_stored_pseudo_hostname(cache_key)
+    if not pseudo_hostname:
+        pseudo_hostname = _derive_pseudo_hostname(app_id, qradar_app_uuid)
+        _store_pseudo_hostname(cache_key, pseudo_hostname)
+    PSEUDO_HOSTNAMES[cache_key] = pseudo_hostname
+    return pseudo_hostname
+
+def _derive_pseudo_hostname(app_id, qradar_app_uuid):
     # This uses a key derivation function rather than a straightforward hash
     # function so that the unique value generated has 16 characters (hex).
     # Anything longer would occupy too much space in each log record.
@@ -138,6 +476,30 @@ def _create_pseudo_hostname(app_id, qradar_app_uuid):
                      length=8)
     return key.hex()
 
+def _pseudo_hostname_location():
+    return app_qpylib.get_store_path(PSEUDO_HOSTNAME_FILE)
+
+def _read_stored_pseudo_hostname(cache_key):
+    try:
+        with open(_pseudo_hostname_location()) as hostname_file:
+            stored = json.load(hostname_file)
+        if stored['key'] == cache_key and re.fullmatch('[0-9a-f]{16}', stored['hostname']):
+            return stored['hostname']
+    except (KeyError, OSError, TypeError, ValueError):
+        pass
+    return None
+
+def _store_pseudo_hostname(cache_key, pseudo_hostname):
+    try:
+        location = _pseudo_hostname_location()
+        temp_location = '{0}.{1}.tmp'.format(location, os.getpid())
+        with open(temp_location, 'w') as hostname_file:
+            json.dump({'key': cache_key, 'hostname': pseudo_hostname}, hostname_file)
+        os.replace(temp_location, location)
+    except (KeyError, OSError):
+        # Caching is an optimisation only; the store may not be writable.
+        pass
+
 def _create_sanitized_app_name():
     ''' Extracts app name from manifest, strips unwanted characters,
         and truncates to max length 48, as per RFC5424.
@@ -166,3 +528,278 @@ class NotificationCodeFilter(logging.Filter):
         'ERROR': Q_ERROR_CODE,
         'CRITICAL': Q_ERROR_CODE
     }
+
+class RepeatedMessageFilter(logging.Filter):
+    ''' Filter which rate-limits identical messages.
+        Records with the same level and message template (the message before
+        any args are applied) are allowed through up to limit times per window
+        seconds. Further records in the window are suppressed and counted.
+        When a window with suppressed records has ended, a summary record
+        "Message repeated N times in the last W seconds: <template>" is logged
+        at the same level. This happens when the next record of any kind is
+        logged, or when flush() is called.
+        Windows are held in order of expiry, so each record costs O(1)
+        amortized time.
+    '''
+    def __init__(self, logger, window, limit=1):
+        super().__init__()
+        if window <= 0:
+            raise ValueError('Duplicate log window must be greater than 0')
+        if limit < 1:
+            raise ValueError('Duplicate log limit must be at least 1')
+        self.logger = logger
+        self.window = window
+        self.limit = limit
+        self._clock = time.monotonic
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if getattr(record, 'qsummary', False):
+            return True
+        key = (record.levelno, _message_template(record))
+        now = self._clock()
+        with self._lock:
+            summaries = self._end_windows(lambda started: now - started >= self.window)
+            window = self._windows.get(key)
+            if window is None:
+                self._windows[key] = _RepeatWindow(now, record)
+                allowed = True
+            else:
+                window.count += 1
+                allowed = window.count <= self.limit
+        self._log_summaries(summaries)
+        return allowed
+
+    def flush(self):
+        ''' Ends all current windows, logging summaries of any suppressed records. '''
+        with self._lock:
+            summaries = self._end_windows(lambda started: True)
+        self._log_summaries(summaries)
+
+    def _end_windows(self, has_ended):
+        # Must be called with the lock held.
+        summaries = []
+        while self._windows:
+            key, window = next(iter(self._windows.items()))
+            if not has_ended(window.started):
+                break
+            del self._windows[key]
+            if window.count > self.limit:
+                summaries.append(window.summary(key[1], window.count - self.limit, self.window))
+        return summaries
+
+    def _log_summaries(self, summaries):
+        # Called without the lock, as handlers may be slow and the
+        # summary records pass back through this filter.
+        for summary in summaries:
+            if self.logger.isEnabledFor(summary.levelno):
+                self.logger.handle(summary)
+
+class _RepeatWindow():
+    __slots__ = ('started', 'count', 'name', 'levelno', 'pathname', 'lineno', 'func')
+
+    def __init__(self, started, record):
+        self.started = started
+        self.count = 1
+        self.name = record.name
+        self.levelno = record.levelno
+        self.pathname = record.pathname
+        self.lineno = record.lineno
+        self.func = record.funcName
+
+    def summary(self, template, repeat_count, window):
+        message = SanitizedMessage('Message repeated %d times in the last %g seconds: %s',
+                                   (repeat_count, window, template))
+        record = logging.LogRecord(self.name, self.levelno, self.pathname, self.lineno,
+                                   message, None, None, self.func)
+        record.qsummary = True
+        return record
+
+def _message_template(record):
+    message = record.msg
+    if isinstance(message, SanitizedMessage):
+        message = message.message
+    return str(message)
+
+class BoundedQueueHandler(QueueHandler):
+    ''' QueueHandler for a bounded queue, which applies full_policy when the queue is full:
+          QUEUE_FULL_BLOCK: wait until the listener thread makes space.
+          QUEUE_FULL_DROP_OLDEST: discard the oldest queued record to make space.
+          QUEUE_FULL_DROP: discard the new record.
+        dropped_count holds the number of records discarded.
+    '''
+    def __init__(self, record_queue, full_policy=QUEUE_FULL_BLOCK):
+        super().__init__(record_queue)
+        self.full_policy = full_policy
+        self.dropped_count = 0
+        self._drop_lock = threading.Lock()
+
+    def prepare(self, record):
+        # Merges args into the message on the calling thread, as QueueHandler does,
+        # but leaves sanitization and final formatting to the handlers.
+        record = copy.copy(record)
+        if isinstance(record.msg, SanitizedMessage):
+            record.msg = SanitizedMessage(record.msg.unsanitized())
+        else:
+            record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.full_policy == QUEUE_FULL_BLOCK:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+        with self._drop_lock:
+            self.dropped_count += 1
+            if self.full_policy == QUEUE_FULL_DROP_OLDEST:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    self.queue.put_nowait(record)
+                except queue.Full:
+                    pass
+
+# pylint: disable=too-many-instance-attributes
+class BatchedTCPSyslogHandler(logging.Handler):
+    ''' Syslog handler which buffers records and sends them in batches over a
+        persistent TCP connection, framed using RFC 6587 octet counting.
+        A background thread sends the buffer when it holds batch_size records,
+        or every flush_interval seconds. If sending fails, the connection is
+        re-established with exponential backoff from min_backoff up to
+        max_backoff seconds, and records stay buffered meanwhile.
+        At most max_buffer records are held; beyond that the oldest records
+        are discarded and counted in dropped_count.
+        If ssl_context (an ssl.SSLContext) is supplied, the connection uses TLS,
+        and the server certificate is checked against the host in address.
+    '''
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, address, batch_size=100, flush_interval=1.0, max_buffer=10000,
+                 facility=SysLogHandler.LOG_USER, timeout=5, min_backoff=0.5, max_backoff=30,
+                 ssl_context=None):
+        super().__init__()
+        self.address = address
+        self.ssl_context = ssl_context
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.facility = facility
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.dropped_count = 0
+        self._buffer = deque()
+        self._buffer_ready = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._socket = None
+        self._backoff = 0
+        self._next_connect_time = 0
+        self._closed = False
+        self._sender = threading.Thread(target=self._send_loop,
+                                        name='qpylib-syslog-sender', daemon=True)
+        self._sender.start()
+
+    def emit(self, record):
+        try:
+            frame = self._frame(record)
+        except Exception: # pylint: disable=broad-except
+            self.handleError(record)
+            return
+        with self._buffer_ready:
+            if len(self._buffer) >= self.max_buffer:
+                self._buffer.popleft()
+                self.dropped_count += 1
+            self._buffer.append(frame)
+            if len(self._buffer) >= self.batch_size:
+                self._buffer_ready.notify()
+
+    def flush(self):
+        ''' Sends all buffered records now, if the connection is available. '''
+        self._send_buffer(ignore_backoff=True)
+
+    def close(self):
+        with self._buffer_ready:
+            self._closed = True
+            self._buffer_ready.notify()
+        self._sender.join(self.timeout)
+        self.flush()
+        self._disconnect()
+        super().close()
+
+    def _frame(self, record):
+        priority = SysLogHandler.priority_names[
+            SysLogHandler.priority_map.get(record.levelname, 'warning')]
+        message = '<{0}>{1}'.format((self.facility << 3) | priority,
+                                    self.format(record)).encode('utf-8')
+        return str(len(message)).encode('ascii') + b' ' + message
+
+    def _send_loop(self):
+        while True:
+            with self._buffer_ready:
+                if not self._closed and len(self._buffer) < self.batch_size:
+                    self._buffer_ready.wait(self.flush_interval)
+                # While reconnecting is backed off, a full buffer must not wake
+                # the sender, otherwise it would spin until the backoff ends.
+                backoff = self._next_connect_time - time.monotonic()
+                while not self._closed and backoff > 0:
+                    self._buffer_ready.wait(backoff)
+                    backoff = self._next_connect_time - time.monotonic()
+                if self._closed:
+                    return
+            self._send_buffer()
+
+    def _send_buffer(self, ignore_backoff=False):
+        with self._send_lock:
+            if not ignore_backoff and time.monotonic() < self._next_connect_time:
+                return
+            with self._buffer_ready:
+                frames = list(self._buffer)
+                self._buffer.clear()
+            if not frames:
+                return
+            try:
+                if self._socket is None:
+                    self._socket = self._connect()
+                self._socket.sendall(b''.join(frames))
+                self._backoff = 0
+            except OSError:
+                self._disconnect()
+                self._backoff = min(self.max_backoff, max(self.min_backoff, self._backoff * 2))
+                self._next_connect_time = time.monotonic() + self._backoff
+                self._requeue(frames)
+
+    def _connect(self):
+        connection = socket.create_connection(self.address, self.timeout)
+        if self.ssl_context is None:
+            return connection
+        try:
+            return self.ssl_context.wrap_socket(connection, server_hostname=self.address[0])
+        except OSError:
+            connection.close()
+            raise
+
+    def _requeue(self, frames):
+        # Puts unsent frames back ahead of any records emitted while sending.
+        with self._buffer_ready:
+            self._buffer.extendleft(reversed(frames))
+            while len(self._buffer) > self.max_buffer:
+                self._buffer.popleft()
+                self.dropped_count += 1
+
+    def _disconnect(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+            self._socket = None
@@ -8,27 +8,70 @@ from . import json_qpylib
 from . import log_qpylib
 from . import offense_qpylib
 from . import rest_qpylib
+from . import rest_cache
 # This is needed to allow accessing util_qpylib from the parent qpylib module
 from . import util_qpylib # pylint: disable=unused-import
 
 # ==== Logging ====
 
-def create_log(syslog_enabled=True):
+# pylint: disable=too-many-arguments
+def create_log(syslog_enabled=True, queued=False, queue_size=10000, queue_full_policy='block',
+               syslog_transport='udp', log_format='text', duplicate_window=0, duplicate_limit=1,
+               syslog_ssl_context=None):
     ''' Initialises logging.
         Threshold log level is set to the value of the "log_level" field
         in the app manifest.json, or INFO if that field is absent.
         Creates a file log handler which directs logs to store/log/app.log.
+        By default app.log rotates at 2MB, keeping 5 backups. The optional
+        "log_rotation" object in the app manifest overrides this, e.g.
+            "log_rotation": {"when": "midnight", "backup_count": 14, "compress": true}
+        when is "size" (rotate at max_bytes) or a time unit S, M, H, D,
+        midnight or W0-W6 (rotate every interval units). If compress is true,
+        rotated files are gzipped on a background thread.
+        log_format is text (the default) or json, which writes one JSON object
+        per line containing timestamp, thread, level, ncode, app details,
+        message and any fields supplied to log().
         Creates a Syslog handler, but only if syslog_enabled is True and
         environment variables QRADAR_CONSOLE_IP and QRADAR_APP_UUID are
         both set.
+        syslog_transport is udp (one datagram per record) or tcp (records are
+        buffered and sent in batches over a persistent connection).
+        If syslog_ssl_context (an ssl.SSLContext) is supplied, the tcp
+        connection uses TLS. It requires syslog_transport tcp.
+        If queued is True, log() only places records on a queue holding up to
+        queue_size records, and the handlers run on a background thread.
+        queue_full_policy decides what happens when the queue is full:
+        block (wait for space), drop_oldest or drop (discard the new record).
+        If duplicate_window is greater than 0, records with the same level and
+        message template are limited to duplicate_limit per duplicate_window
+        seconds. Suppressed records are counted, and summarised with a
+        "Message repeated N times" record at the same level once the window ends.
         Must be called before any call to log() or set_log_level().
-        Raises ValueError if the manifest threshold log level is invalid.
+        Raises ValueError if the manifest threshold log level or log_rotation is invalid,
+        or if queue_size, queue_full_policy, syslog_transport, log_format,
+        duplicate_window or duplicate_limit is invalid, or if syslog_ssl_context
+        is supplied without syslog_transport tcp.
     '''
-    log_qpylib.create_log(syslog_enabled)
+    log_qpylib.create_log(syslog_enabled, queued, queue_size, queue_full_policy,
+                          syslog_transport, log_format, duplicate_window, duplicate_limit,
+                          syslog_ssl_context)
 
-def log(message, level='INFO'):
+def get_dropped_log_count():
+    ''' Returns the number of log records discarded because the log queue was full.
+        Always 0 unless create_log() was called with queued=True and a drop policy.
+    '''
+    return log_qpylib.get_dropped_log_count()
+
+def log(message, level='INFO', args=None, fields=None):
     ''' Logs a message at the given level, which defaults to INFO.
-        Within the message string, any control characters such as tab
+        If args is supplied, message is a %-style format string and args is
+        a tuple, dict or single value to format it with, e.g.
+            qpylib.log('Offense %s has %d events', 'DEBUG', args=(offense_id, count))
+        Formatting is deferred until the message is actually written,
+        so messages below the threshold log level cost almost nothing.
+        fields is an optional dict of extra structured data, which is
+        included in log output when create_log() used log_format json.
+        Within the formatted message, any control characters such as tab
         and newline will be suppressed.
         Level values: DEBUG, INFO, WARNING, ERROR, EXCEPTION, CRITICAL.
         EXCEPTION is ERROR plus extra exception details.
@@ -36,7 +79,7 @@ def log(message, level='INFO'):
         by a call to qpylib.create_log().
         Raises ValueError if level is invalid.
     '''
-    log_qpylib.log(message, level)
+    log_qpylib.log(message, level, args, fields)
 
 def set_log_level(level):
     ''' Sets the threshold log level.
@@ -65,6 +108,15 @@ def get_manifest_json():
     ''' Returns the content of the app manifest as a Python object. '''
     return app_qpylib.get_manifest_json()
 
+def get_manifest():
+    ''' Returns an immutable snapshot of the app manifest, with attributes
+        json (the full content), name, log_level, services and endpoints
+        (the endpoints of all services).
+        The manifest is read once. In SDK mode (QRADAR_APPFW_SDK=true)
+        it is read again whenever the file's modification time changes.
+    '''
+    return app_qpylib.get_manifest()
+
 def get_manifest_field_value(key, default_value=None):
     ''' Returns the value of "key" from the app manifest.
         If "key" is not in the manifest and default_value
@@ -108,19 +160,177 @@ def get_console_fqdn():
     '''
     return app_qpylib.get_console_fqdn()
 
+def get_app_context():
+    ''' Returns an immutable snapshot of the app container environment, with
+        attributes app_id, root_path, store_path, log_path, console_ip,
+        console_fqdn, console_url_prefix, rest_proxy and sec_admin_token.
+        Attributes are None if the environment variable they come from is not set.
+        The snapshot is taken on first use, and is used by all qpylib functions
+        that read those environment variables.
+    '''
+    return app_qpylib.get_app_context()
+
+def refresh_app_context():
+    ''' Takes a new snapshot of the app container environment and returns it.
+        Call this after changing any of the environment variables
+        QRADAR_APP_ID, APP_ROOT, QRADAR_CONSOLE_IP, QRADAR_CONSOLE_FQDN,
+        QRADAR_REST_PROXY or SEC_ADMIN_TOKEN.
+    '''
+    return app_qpylib.refresh_app_context()
+
 # ==== REST ====
 
 QREST_TIMEOUT = rest_qpylib.resolve_default_timeout()
 
 # pylint: disable=invalid-name, too-many-arguments
 def REST(rest_action, request_url, version=None, headers=None, data=None,
-         params=None, json_body=None, verify=True, timeout=QREST_TIMEOUT, **kwargs):
+         params=None, json_body=None, verify=True, timeout=QREST_TIMEOUT, retry=None,
+         cache_ttl=None, **kwargs):
     ''' Invokes a rest_action request to request_url using the Python requests module.
         Returns a requests.Response object.
-        Raises ValueError if rest_action is not one of GET, PUT, POST, DELETE.
+        retry overrides the retry policy set by configure_rest_retries for this call.
+        It is either a number of retries, e.g. 0 to disable retries,
+        or a qpylib.rest_qpylib.RetryPolicy.
+        cache_ttl enables the response cache for a GET call without a body:
+          0 revalidates a cached response on every call using its ETag or
+          Last-Modified header, and returns it if the console answers 304.
+          A positive value returns a cached response without contacting the
+          console for cache_ttl seconds, then revalidates it if possible,
+          otherwise fetches it again.
+        Cached responses have from_cache set to True. Responses are cached
+        separately for each user's SEC token or session, and per header set.
+        Calls with auth, cookies or cert arguments are never cached.
+        Raises ValueError if rest_action is not one of GET, PUT, POST, DELETE,
+        or if cache_ttl is negative.
     '''
     return rest_qpylib.rest(rest_action, request_url, version, headers, data,
-                            params, json_body, verify, timeout, **kwargs)
+                            params, json_body, verify, timeout, retry, cache_ttl, **kwargs)
+
+def configure_rest_retries(max_retries=3, backoff_factor=0.5, max_backoff=30, jitter=0.1,
+                           status_codes=(429, 502, 503, 504), max_retry_after=120):
+    ''' Sets the retry policy used by REST. Retries are disabled by default.
+        max_retries: maximum number of retries per call. 0 disables retries.
+        backoff_factor: the delay before retry n (counting from 0) is
+          backoff_factor * 2**n seconds, capped at max_backoff seconds
+          and randomised by +/- jitter (a fraction).
+        status_codes: response status codes which are retried.
+        max_retry_after: a Retry-After response header is used as the delay,
+          unless it exceeds max_retry_after seconds, in which case the
+          response is returned without retrying.
+        GET, PUT and DELETE are retried after a retryable response, a connection
+        error or a timeout. POST is only retried after a 429 response
+        or a connect timeout, when the request cannot have been processed.
+        Raises ValueError if max_retries is negative.
+    '''
+    rest_qpylib.configure_retry_policy(rest_qpylib.RetryPolicy(
+        max_retries, backoff_factor, max_backoff, jitter, status_codes, max_retry_after))
+
+def get_rest_retry_counts():
+    ''' Returns a dict of REST retry counters since startup or the last reset:
+        retries: total number of retries performed.
+        retried_calls: number of REST calls which retried at least once.
+        exhausted_calls: number of REST calls which were still failing
+          after their maximum number of retries.
+    '''
+    return rest_qpylib.get_retry_counts()
+
+def reset_rest_retry_counts():
+    ''' Sets all REST retry counters to 0. '''
+    rest_qpylib.reset_retry_counts()
+
+def configure_rest_circuit_breaker(failure_threshold=5, reset_timeout=30,
+                                   half_open_max_calls=1, prefix_segments=2):
+    ''' Enables per-endpoint circuit breakers for REST, replacing any existing ones.
+        Endpoints are grouped by the first prefix_segments segments of
+        request_url, e.g. api/ariel. After failure_threshold consecutive failures
+        (connection errors, timeouts, 5xx or 429 responses) for a group,
+        REST calls to it fail immediately with rest_qpylib.CircuitOpenError,
+        a subclass of requests.exceptions.ConnectionError.
+        After reset_timeout seconds, up to half_open_max_calls trial calls
+        are allowed; a success closes the breaker, a failure opens it again.
+        A failure_threshold of 0 disables circuit breakers, which is the default.
+        Raises ValueError if prefix_segments is less than 1.
+    '''
+    if failure_threshold == 0:
+        rest_qpylib.configure_circuit_breakers(None)
+    else:
+        rest_qpylib.configure_circuit_breakers(rest_qpylib.CircuitBreakers(
+            failure_threshold, reset_timeout, half_open_max_calls, prefix_segments))
+
+def get_rest_circuit_states():
+    ''' Returns a dict mapping each REST endpoint prefix to the state
+        of its circuit breaker: closed, open or half_open.
+        Empty unless configure_rest_circuit_breaker was called.
+    '''
+    circuit_breakers = rest_qpylib.CIRCUIT_BREAKERS
+    return circuit_breakers.states() if circuit_breakers else {}
+
+def configure_rest_concurrency_limit(max_in_flight, acquire_timeout=5):
+    ''' Limits the number of REST calls in flight across all threads to max_in_flight.
+        A call waits up to acquire_timeout seconds for a free slot, then fails
+        with rest_qpylib.ConcurrencyLimitError, a subclass of
+        requests.exceptions.ConnectionError.
+        A max_in_flight of 0 removes the limit, which is the default.
+        Raises ValueError if max_in_flight is negative.
+    '''
+    if max_in_flight == 0:
+        rest_qpylib.configure_in_flight_limiter(None)
+    else:
+        rest_qpylib.configure_in_flight_limiter(
+            rest_qpylib.InFlightLimiter(max_in_flight, acquire_timeout))
+
+def configure_rest_response_cache(max_entries=256, max_bytes=16 * 1024 * 1024):
+    ''' Replaces the REST response cache used by calls with a cache_ttl,
+        discarding all cached responses.
+        The cache holds at most max_entries responses, and at most max_bytes
+        bytes of response content and headers, evicting the least recently
+        used responses first.
+        Raises ValueError if max_entries or max_bytes is less than 1.
+    '''
+    rest_cache.configure_response_cache(max_entries, max_bytes)
+
+def clear_rest_response_cache():
+    ''' Discards all responses held in the REST response cache. '''
+    rest_cache.RESPONSE_CACHE.clear()
+
+def get_rest_response_cache_counts():
+    ''' Returns a dict of REST response cache counters:
+        hits: responses returned from the cache without a request.
+        revalidated: cached responses returned after a 304 Not Modified.
+        misses: responses fetched in full.
+        entries and bytes: current number and size of cached responses.
+    '''
+    return rest_cache.RESPONSE_CACHE.counts()
+
+def configure_rest_session_pool(size=10, pool_connections=10, pool_maxsize=10, keep_alive=True):
+    ''' Replaces the pool of keep-alive HTTP sessions used by REST.
+        size: maximum number of idle sessions kept for reuse.
+        pool_connections: number of per-host connection pools per session.
+        pool_maxsize: maximum number of connections per host per session.
+        keep_alive: if False, connections are closed after each request.
+        Raises ValueError if size is less than 1.
+    '''
+    rest_qpylib.configure_session_pool(size, pool_connections, pool_maxsize, keep_alive)
+
+def reset_rest_session_pool():
+    ''' Discards all pooled REST sessions without closing their connections.
+        This happens automatically in a child process after os.fork(),
+        so that e.g. gunicorn workers never share sockets with their parent.
+    '''
+    rest_qpylib.reset_session_pool()
+
+def configure_rest_host_cache(ttl=300):
+    ''' Sets how long, in seconds, REST caches the address of localhost
+        used as the default Host header. 0 resolves it on every call.
+        Raises ValueError if ttl is negative.
+    '''
+    rest_qpylib.configure_localhost_resolver(ttl)
+
+def refresh_rest_host_cache():
+    ''' Resolves localhost again for the default REST Host header,
+        and returns the new address.
+    '''
+    return rest_qpylib.refresh_localhost_address()
 
 # ==== JSON ====
 
@@ -130,6 +340,22 @@ def to_json_dict(python_obj, classkey=None):
     """
     return json_qpylib.to_json_dict(python_obj, classkey)
 
+def iter_json_items(response, key=None, chunk_size=64 * 1024):
+    ''' Generator which parses the JSON body of a REST response incrementally,
+        reading it in chunks of chunk_size bytes. Call REST with stream=True
+        so that the body is not read in full before this function is called;
+        memory use is then proportional to one element, not the whole body.
+        For a top-level array, yields each element.
+        For a top-level object, yields a (name, value) tuple for each member,
+        unless key is supplied: then yields the elements of the array member
+        named key and skips all other members. key may also be a function,
+        called with each member name, which returns True for members to expand.
+        The response is closed once the body has been parsed or the generator
+        is closed.
+        Raises ValueError if the body is not a valid JSON array or object.
+    '''
+    return json_qpylib.iter_json_items(response, key, chunk_size)
+
 def register_jsonld_endpoints():
     ''' Registers JSON-LD endpoints from the app manifest. '''
     json_qpylib.register_jsonld_endpoints()
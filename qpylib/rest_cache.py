@@ -0,0 +1,196 @@
+# Copyright 2019 IBM Corporation All Rights Reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+import requests
+from requests.structures import CaseInsensitiveDict
+
+CONDITIONAL_HEADERS = {'ETag': 'If-None-Match', 'Last-Modified': 'If-Modified-Since'}
+
+class CachedResponse(): # pylint: disable=too-many-instance-attributes
+    ''' A cached 200 response to a GET request, with the validators
+        used to revalidate it.
+    '''
+    __slots__ = ('status_code', 'reason', 'headers', 'content',
+                 'url', 'encoding', 'stored_at', 'size')
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.reason = response.reason
+        self.headers = CaseInsensitiveDict(response.headers)
+        self.content = response.content
+        self.url = response.url
+        self.encoding = response.encoding
+        self.stored_at = time.monotonic()
+        self.size = len(self.content) + sum(len(name) + len(value)
+                                            for name, value in self.headers.items())
+
+    def has_validators(self):
+        return any(name in self.headers for name in CONDITIONAL_HEADERS)
+
+    def conditional_headers(self):
+        ''' Returns the If-None-Match and If-Modified-Since headers
+            which revalidate this response.
+        '''
+        return {condition: self.headers[validator]
+                for validator, condition in CONDITIONAL_HEADERS.items()
+                if validator in self.headers}
+
+    def is_fresh(self, ttl):
+        return time.monotonic() - self.stored_at < ttl
+
+    def revalidated(self, not_modified):
+        ''' Returns a copy of this entry, renewed by a 304 response,
+            whose headers replace any cached headers of the same name.
+        '''
+        entry = CachedResponse.__new__(CachedResponse)
+        for name in CachedResponse.__slots__:
+            setattr(entry, name, getattr(self, name))
+        entry.headers = self.headers.copy()
+        entry.headers.update(not_modified.headers)
+        entry.stored_at = time.monotonic()
+        return entry
+
+    def to_response(self):
+        ''' Returns a new requests.Response holding this entry's content.
+            Its from_cache attribute is True.
+        '''
+        response = requests.Response()
+        response.status_code = self.status_code
+        response.reason = self.reason
+        response.headers = self.headers.copy()
+        # pylint: disable=protected-access
+        response._content = self.content
+        response.url = self.url
+        response.encoding = self.encoding
+        response.from_cache = True
+        return response
+
+class ResponseCache():
+    ''' Thread-safe LRU cache of GET responses, bounded by the number of entries
+        and by the total size in bytes of their content and headers.
+        Entries larger than max_bytes are not cached.
+    '''
+    def __init__(self, max_entries=256, max_bytes=16 * 1024 * 1024):
+        if max_entries < 1:
+            raise ValueError('max_entries must be at least 1')
+        if max_bytes < 1:
+            raise ValueError('max_bytes must be at least 1')
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._counts = {'hits': 0, 'revalidated': 0, 'misses': 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._discard(key)
+            if entry.size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self._size += entry.size
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def count(self, outcome):
+        with self._lock:
+            self._counts[outcome] += 1
+
+    def counts(self):
+        ''' Returns a dict of lookup outcomes since the cache was created:
+            hits: responses returned from the cache without a request.
+            revalidated: responses returned from the cache after a 304.
+            misses: responses fetched in full.
+        '''
+        with self._lock:
+            return dict(self._counts, entries=len(self._entries), bytes=self._size)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry.size
+
+RESPONSE_CACHE = ResponseCache()
+
+def configure_response_cache(max_entries=256, max_bytes=16 * 1024 * 1024):
+    # pylint: disable=global-statement
+    global RESPONSE_CACHE
+    RESPONSE_CACHE = ResponseCache(max_entries, max_bytes)
+
+# requests arguments which can carry an identity other than the SEC and CSRF headers.
+IDENTITY_ARGUMENTS = ('auth', 'cookies', 'cert')
+
+def is_cacheable(rest_action, data, json_body, kwargs):
+    return (rest_action.upper() == 'GET' and data is None and json_body is None
+            and not kwargs.get('stream')
+            and not any(kwargs.get(name) for name in IDENTITY_ARGUMENTS))
+
+def cache_key(full_url, headers, params):
+    ''' Returns a digest of everything which selects a response: the URL
+        including its query parameters, and all request headers.
+        The headers include the SEC token or session cookie and the
+        QRadarCSRF token, so each user's responses are cached separately.
+    '''
+    url = requests.models.PreparedRequest()
+    url.prepare_url(full_url, params)
+    selector = json.dumps([url.url, sorted((str(name).lower(), str(value))
+                                           for name, value in headers.items())])
+    return hashlib.sha256(selector.encode('utf-8')).hexdigest()
+
+def cached_get(send, full_url, headers, params, ttl):
+    ''' Returns a response for a GET request via the response cache.
+        send(headers) performs the request.
+        A cached response younger than ttl seconds is returned without a request.
+        Otherwise a cached response with an ETag or Last-Modified header is
+        revalidated with If-None-Match or If-Modified-Since, and returned
+        if the console answers 304 Not Modified.
+        A 200 response is cached if it has validators or ttl is positive,
+        unless its Cache-Control header contains no-store.
+    '''
+    cache = RESPONSE_CACHE
+    key = cache_key(full_url, headers, params)
+    entry = cache.get(key)
+    if entry is not None and entry.is_fresh(ttl):
+        cache.count('hits')
+        return entry.to_response()
+    if entry is not None and entry.has_validators():
+        headers = dict(headers, **entry.conditional_headers())
+    response = send(headers)
+    if entry is not None and response.status_code == 304:
+        response.close()
+        entry = entry.revalidated(response)
+        cache.put(key, entry)
+        cache.count('revalidated')
+        return entry.to_response()
+    cache.count('misses')
+    if response.status_code == 200 and _is_storable(response):
+        entry = CachedResponse(response)
+        if ttl > 0 or entry.has_validators():
+            cache.put(key, entry)
+    return response
+
+def _is_storable(response):
+    cache_control = response.headers.get('Cache-Control', '').lower()
+    return 'no-store' not in cache_control and response.headers.get('Vary') != '*'
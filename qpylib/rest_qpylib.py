@@ -2,11 +2,25 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+from contextlib import contextmanager, nullcontext
+import copy
+from email.utils import parsedate_to_datetime
+import hashlib
+from http.cookiejar import DefaultCookiePolicy
+import json
 import os
+import queue
+import random
 from socket import gethostbyname
+import threading
+import time
+from urllib.parse import urlsplit
 from flask import request, has_request_context
 import requests
-from . import app_qpylib
+from requests.adapters import HTTPAdapter
+from requests.sessions import merge_setting
+from requests.utils import get_environ_proxies
+from . import app_qpylib, rest_cache
 
 QRADAR_CSRF = 'QRadarCSRF'
 SEC_HEADER = 'SEC'
@@ -14,61 +28,615 @@ SEC_ADMIN_TOKEN = 'SEC_ADMIN_TOKEN'
 
 # pylint: disable=too-many-arguments
 def rest(rest_action, request_url, version, headers, data,
-         params, json_body, verify, timeout, **kwargs):
-    rest_func = _choose_rest_function(rest_action)
-    full_url = _generate_full_url(request_url)
-    rest_headers = _add_headers(headers, version)
-    proxies = _add_proxies()
-    return rest_func(full_url, headers=rest_headers, data=data, params=params,
-                     json=json_body, verify=verify, timeout=timeout, proxies=proxies, **kwargs)
+         params, json_body, verify, timeout, retry=None, cache_ttl=None, **kwargs):
+    full_url, rest_headers, proxies = prepare_request(request_url, version, headers)
+    return send_prepared(rest_action, full_url, rest_headers, proxies, data, params,
+                         json_body, verify, timeout, retry, cache_ttl, **kwargs)
+
+def send_prepared(rest_action, full_url, headers, proxies, data, params,
+                  json_body, verify, timeout, retry=None, cache_ttl=None, **kwargs):
+    # Sends a request built by prepare_request, via the response cache if cache_ttl is set.
+    # Does not touch the Flask request context, so it is safe to call from worker threads.
+    if cache_ttl is not None and rest_cache.is_cacheable(rest_action, data, json_body, kwargs):
+        return _cached_get(full_url, headers, proxies, cache_ttl, retry=retry,
+                           params=params, verify=verify, timeout=timeout, **kwargs)
+    return send_request(rest_action, full_url, headers, proxies, retry=retry, data=data,
+                        params=params, json=json_body, verify=verify, timeout=timeout, **kwargs)
+
+def _cached_get(full_url, headers, proxies, cache_ttl, retry=None, params=None, **kwargs):
+    if cache_ttl < 0:
+        raise ValueError('cache_ttl cannot be negative')
+    def send(cache_headers):
+        return send_request('GET', full_url, cache_headers, proxies, retry=retry,
+                            params=params, **kwargs)
+    return rest_cache.cached_get(send, full_url, headers, params, cache_ttl)
+
+def prepare_request(request_url, version, headers):
+    # Returns the full URL, headers and proxies for a console request.
+    # Must be called on the thread that owns the Flask request context.
+    return _generate_full_url(request_url), _add_headers(headers, version), _add_proxies()
+
+def send_request(rest_action, full_url, headers, proxies, retry=None, **kwargs):
+    # Sends a fully prepared request using a pooled session, within the circuit
+    # breaker if configured, retrying according to the retry policy
+    # (see _resolve_retry_policy). Each attempt holds an in-flight slot if a limit
+    # is configured; backoff sleeps between attempts do not.
+    # Does not touch the Flask request context, so it is safe to call from worker threads.
+    circuit_breakers = CIRCUIT_BREAKERS
+    if circuit_breakers is None:
+        return _send_with_retries(rest_action, full_url, headers, proxies, retry, **kwargs)
+    breaker = circuit_breakers.breaker_for(full_url)
+    breaker.before_call()
+    try:
+        response = _send_with_retries(rest_action, full_url, headers, proxies, retry, **kwargs)
+    except ConcurrencyLimitError:
+        # The request never reached the console.
+        breaker.record_ignored()
+        raise
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        breaker.record_failure()
+        raise
+    except BaseException:
+        breaker.record_ignored()
+        raise
+    if response.status_code >= 500 or response.status_code == 429:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
+
+def _send_with_retries(rest_action, full_url, headers, proxies, retry, **kwargs):
+    policy = _resolve_retry_policy(retry)
+    method = rest_action.upper()
+    attempt = 0
+    while True:
+        response, error = _send_once(rest_action, full_url, headers, proxies, **kwargs)
+        delay = _retry_delay(policy, method, attempt, response, error)
+        if delay is None:
+            break
+        if response is not None:
+            response.close()
+        time.sleep(delay)
+        attempt += 1
+        _count_retry(attempt)
+    if error is not None:
+        raise error
+    return response
+
+def _send_once(rest_action, full_url, headers, proxies, **kwargs):
+    # Raises ConcurrencyLimitError if no in-flight slot becomes free in time;
+    # that is never retried, since the console was not contacted.
+    limiter = IN_FLIGHT_LIMITER
+    with limiter.slot() if limiter else nullcontext():
+        with SESSION_POOL.session() as session:
+            rest_func = _choose_rest_function(session, rest_action)
+            try:
+                return rest_func(full_url, headers=headers, proxies=proxies, **kwargs), None
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                return None, error
 
 def resolve_default_timeout():
+    # Runs when qpylib is imported, so it reads the environment directly rather
+    # than building the app context, which would then ignore variables set later.
     # pylint: disable=broad-exception-caught
     try:
-        with open(app_qpylib.get_store_path('rest-timeout-override')) as override_file:
+        store_path = app_qpylib.AppContext.from_env().store_path
+        with open(os.path.join(store_path, 'rest-timeout-override')) as override_file:
             return int(override_file.readline().strip())
     except Exception:
         return 60
 
 def _add_headers(headers, version=None):
-    if headers is None:
-        headers = {}
+    # Starts from a copy of a prebuilt template, so the caller's headers are never modified.
+    if headers and headers.get('Host') is not None:
+        template = _header_template(None)
+    else:
+        template = _header_template(LOCALHOST_RESOLVER.address())
+    rest_headers = template.copy()
 
-    if version is not None:
-        headers['Version'] = version
+    if headers:
+        for key, value in headers.items():
+            if key != 'Host' or value is not None:
+                rest_headers[key] = value
 
-    if headers.get('Host') is None:
-        headers['Host'] = gethostbyname('localhost')
+    if version is not None:
+        rest_headers['Version'] = version
 
     if has_request_context():
         if QRADAR_CSRF in request.cookies.keys():
-            headers[QRADAR_CSRF] = request.cookies.get(QRADAR_CSRF)
+            rest_headers[QRADAR_CSRF] = request.cookies.get(QRADAR_CSRF)
         if SEC_HEADER in request.cookies.keys() \
-            and SEC_HEADER not in headers.keys():
-            headers[SEC_HEADER] = request.cookies.get(SEC_HEADER)
+            and SEC_HEADER not in rest_headers.keys():
+            rest_headers[SEC_HEADER] = request.cookies.get(SEC_HEADER)
+
+    # SEC_ADMIN_TOKEN takes precedence over any supplied SEC header.
+    if SEC_HEADER in template:
+        rest_headers[SEC_HEADER] = template[SEC_HEADER]
+
+    return rest_headers
+
+def caller_identity():
+    # Returns a digest of the SEC and QRadarCSRF values which REST would send
+    # from this thread, identifying the user whose permissions a response reflects.
+    # Must be called on the thread that owns the Flask request context.
+    rest_headers = _add_headers(None)
+    identity = json.dumps([rest_headers.get(SEC_HEADER), rest_headers.get(QRADAR_CSRF)])
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+def _header_template(host):
+    # Templates hold the headers which are the same for every request:
+    # Host (unless supplied by the caller) and SEC from SEC_ADMIN_TOKEN.
+    sec_admin_token = app_qpylib.get_app_context().sec_admin_token
+    key = (host, sec_admin_token)
+    template = HEADER_TEMPLATES.get(key)
+    if template is None:
+        template = {}
+        if host is not None:
+            template['Host'] = host
+        if sec_admin_token is not None:
+            template[SEC_HEADER] = sec_admin_token
+        if len(HEADER_TEMPLATES) >= 8:
+            HEADER_TEMPLATES.clear()
+        HEADER_TEMPLATES[key] = template
+    return template
+
+class HostResolver():
+    ''' Thread-safe cache of the address of a host name.
+        The address is resolved on first use, and again once it is
+        older than ttl seconds or when refresh() is called.
+    '''
+    def __init__(self, hostname, ttl=300):
+        self.hostname = hostname
+        self.ttl = ttl
+        self._resolved = None
+        self._lock = threading.Lock()
+
+    def address(self):
+        ''' Returns the cached address, resolving the host name if required. '''
+        resolved = self._resolved
+        if resolved is not None and time.monotonic() < resolved[1]:
+            return resolved[0]
+        with self._lock:
+            # Another thread may have resolved the address while this one waited.
+            resolved = self._resolved
+            if resolved is not None and time.monotonic() < resolved[1]:
+                return resolved[0]
+            return self._resolve()
+
+    def refresh(self):
+        ''' Resolves the host name again and returns its address. '''
+        with self._lock:
+            return self._resolve()
+
+    def _resolve(self):
+        address = gethostbyname(self.hostname)
+        self._resolved = (address, time.monotonic() + self.ttl)
+        return address
 
-    sec_admin_token = os.getenv(SEC_ADMIN_TOKEN)
-    if sec_admin_token is not None:
-        headers[SEC_HEADER] = sec_admin_token
+LOCALHOST_RESOLVER = HostResolver('localhost')
+HEADER_TEMPLATES = {}
 
-    return headers
+def configure_localhost_resolver(ttl=300):
+    global LOCALHOST_RESOLVER
+    if ttl < 0:
+        raise ValueError('Host address TTL cannot be negative')
+    LOCALHOST_RESOLVER = HostResolver('localhost', ttl)
+
+def refresh_localhost_address():
+    return LOCALHOST_RESOLVER.refresh()
 
 def _add_proxies():
-    qradar_rest_proxy = os.getenv('QRADAR_REST_PROXY')
+    qradar_rest_proxy = app_qpylib.get_app_context().rest_proxy
     if qradar_rest_proxy is None:
         return {}
     return {'https': qradar_rest_proxy}
 
 def _generate_full_url(request_url):
-    return "https://{0}/{1}".format(app_qpylib.get_console_fqdn(), request_url)
+    return app_qpylib.get_console_url_prefix() + request_url
 
-def _choose_rest_function(rest_action):
+def _choose_rest_function(session, rest_action):
     return {
-        'GET': requests.get,
-        'PUT': requests.put,
-        'POST': requests.post,
-        'DELETE': requests.delete,
+        'GET': session.get,
+        'PUT': session.put,
+        'POST': session.post,
+        'DELETE': session.delete,
     }.get(rest_action.upper(), _unsupported_rest_action)
 
 def _unsupported_rest_action(*args, **kw_args):
     raise ValueError('Unsupported REST action was requested')
+
+# ==== Retries ====
+
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+
+class RetryPolicy():
+    ''' Decides whether, and after how long, a failed REST request is retried.
+          max_retries: maximum number of retries per call. 0 disables retries.
+          backoff_factor: the delay before retry n (counting from 0) is
+            backoff_factor * 2**n seconds, capped at max_backoff and
+            randomised by +/- jitter (a fraction) to spread load.
+          status_codes: response status codes which are retried.
+          max_retry_after: a Retry-After header on a retryable response is
+            used as the delay, unless it asks for more than this many seconds,
+            in which case the response is returned without retrying.
+        GET, PUT and DELETE are retried after a retryable response, a connection
+        error or a timeout. Other methods, i.e. POST, are only retried when the
+        request cannot have been processed: a 429 response or a connect timeout.
+    '''
+    def __init__(self, max_retries=3, backoff_factor=0.5, max_backoff=30, jitter=0.1,
+                 status_codes=RETRY_STATUS_CODES, max_retry_after=120):
+        if max_retries < 0:
+            raise ValueError('Maximum retries cannot be negative')
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.status_codes = tuple(status_codes)
+        self.max_retry_after = max_retry_after
+
+    def is_retryable(self, method, response=None, error=None):
+        ''' Returns True if the outcome of a method request may be retried. '''
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        if error is not None:
+            return idempotent or isinstance(error, requests.exceptions.ConnectTimeout)
+        if response.status_code not in self.status_codes:
+            return False
+        return idempotent or response.status_code == 429
+
+    def delay(self, attempt, response=None):
+        ''' Returns the number of seconds to wait before retry number attempt
+            (counting from 0), or None if the response's Retry-After is too long.
+        '''
+        if response is not None:
+            retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                return retry_after if retry_after <= self.max_retry_after else None
+        backoff = min(self.max_backoff, self.backoff_factor * 2 ** attempt)
+        return backoff * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def with_max_retries(self, max_retries):
+        ''' Returns a copy of this policy with a different max_retries. '''
+        if max_retries < 0:
+            raise ValueError('Maximum retries cannot be negative')
+        policy = copy.copy(self)
+        policy.max_retries = max_retries
+        return policy
+
+def _parse_retry_after(retry_after):
+    # Retry-After is either a number of seconds or an HTTP date.
+    if retry_after is None:
+        return None
+    try:
+        return max(0, int(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_time = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0, retry_time.timestamp() - time.time())
+
+# Retries are disabled unless configured, globally or per call.
+RETRY_POLICY = RetryPolicy(max_retries=0)
+RETRY_COUNTS_LOCK = threading.Lock()
+RETRY_COUNTS = {'retries': 0, 'retried_calls': 0, 'exhausted_calls': 0}
+
+def configure_retry_policy(policy):
+    global RETRY_POLICY
+    RETRY_POLICY = policy
+
+def get_retry_counts():
+    with RETRY_COUNTS_LOCK:
+        return dict(RETRY_COUNTS)
+
+def reset_retry_counts():
+    with RETRY_COUNTS_LOCK:
+        for key in RETRY_COUNTS:
+            RETRY_COUNTS[key] = 0
+
+def _resolve_retry_policy(retry):
+    # retry is None (use the global policy), a RetryPolicy,
+    # or a number of retries to use with the global policy settings.
+    if retry is None:
+        return RETRY_POLICY
+    if isinstance(retry, RetryPolicy):
+        return retry
+    return RETRY_POLICY.with_max_retries(retry)
+
+def _retry_delay(policy, method, attempt, response, error):
+    # Returns the delay before the next retry, or None if there is none.
+    if not policy.is_retryable(method, response, error):
+        return None
+    if attempt >= policy.max_retries:
+        if attempt > 0:
+            with RETRY_COUNTS_LOCK:
+                RETRY_COUNTS['exhausted_calls'] += 1
+        return None
+    return policy.delay(attempt, response)
+
+def _count_retry(attempt):
+    with RETRY_COUNTS_LOCK:
+        RETRY_COUNTS['retries'] += 1
+        if attempt == 1:
+            RETRY_COUNTS['retried_calls'] += 1
+
+# ==== Circuit breakers and in-flight limit ====
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    ''' Raised instead of sending a request while the circuit breaker
+        for its endpoint prefix is open.
+    '''
+
+class ConcurrencyLimitError(requests.exceptions.ConnectionError):
+    ''' Raised instead of sending a request when the in-flight request
+        limit was reached and no slot became free in time.
+    '''
+
+class CircuitBreaker(): # pylint: disable=too-many-instance-attributes
+    ''' Thread-safe circuit breaker for one endpoint prefix.
+        closed: requests are sent. After failure_threshold consecutive failures
+          (connection errors, timeouts, 5xx or 429 responses) the breaker opens.
+        open: requests fail immediately with CircuitOpenError.
+          After reset_timeout seconds the breaker becomes half-open.
+        half_open: up to half_open_max_calls trial requests are sent.
+          A success closes the breaker, a failure opens it again.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, half_open_max_calls=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._state = CircuitBreaker.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._trial_calls = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        ''' Returns the current state: closed, open or half_open. '''
+        with self._lock:
+            self._check_reset_timeout()
+            return self._state
+
+    def before_call(self):
+        ''' Raises CircuitOpenError if a request may not be sent now. '''
+        with self._lock:
+            self._check_reset_timeout()
+            if self._state == CircuitBreaker.CLOSED:
+                return
+            if self._state == CircuitBreaker.HALF_OPEN \
+                and self._trial_calls < self.half_open_max_calls:
+                self._trial_calls += 1
+                return
+        raise CircuitOpenError('Circuit breaker for {0} is open'.format(self.name))
+
+    def record_success(self):
+        with self._lock:
+            self._state = CircuitBreaker.CLOSED
+            self._failures = 0
+            self._trial_calls = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == CircuitBreaker.HALF_OPEN \
+                or self._failures >= self.failure_threshold:
+                self._state = CircuitBreaker.OPEN
+                self._opened_at = time.monotonic()
+                self._trial_calls = 0
+
+    def record_ignored(self):
+        # The call failed for a reason unrelated to the console, e.g. a bad argument.
+        with self._lock:
+            if self._state == CircuitBreaker.HALF_OPEN and self._trial_calls > 0:
+                self._trial_calls -= 1
+
+    def _check_reset_timeout(self):
+        # Must be called with the lock held.
+        if self._state == CircuitBreaker.OPEN \
+            and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = CircuitBreaker.HALF_OPEN
+            self._trial_calls = 0
+
+class CircuitBreakers():
+    ''' Circuit breakers keyed by endpoint prefix: the first prefix_segments
+        segments of the URL path, e.g. api/ariel for api/ariel/searches/123.
+        Other arguments are as for CircuitBreaker.
+    '''
+    def __init__(self, failure_threshold=5, reset_timeout=30, half_open_max_calls=1,
+                 prefix_segments=2):
+        if failure_threshold < 1:
+            raise ValueError('Circuit breaker failure threshold must be at least 1')
+        if prefix_segments < 1:
+            raise ValueError('Circuit breaker prefix segments must be at least 1')
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.prefix_segments = prefix_segments
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def breaker_for(self, url):
+        ''' Returns the circuit breaker for the endpoint prefix of url. '''
+        path = urlsplit(url).path.strip('/')
+        prefix = '/'.join(path.split('/')[:self.prefix_segments])
+        breaker = self._breakers.get(prefix)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(prefix)
+                if breaker is None:
+                    breaker = CircuitBreaker(prefix, self.failure_threshold, self.reset_timeout,
+                                             self.half_open_max_calls)
+                    self._breakers[prefix] = breaker
+        return breaker
+
+    def states(self):
+        ''' Returns a dict mapping each endpoint prefix to its breaker state. '''
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.name: breaker.state for breaker in breakers}
+
+class InFlightLimiter():
+    ''' Limits the number of requests in flight across all threads.
+        A request waits up to acquire_timeout seconds for a free slot,
+        then fails with ConcurrencyLimitError.
+    '''
+    def __init__(self, max_in_flight, acquire_timeout=5):
+        if max_in_flight < 1:
+            raise ValueError('Maximum in-flight requests must be at least 1')
+        self.max_in_flight = max_in_flight
+        self.acquire_timeout = acquire_timeout
+        self._semaphore = threading.BoundedSemaphore(max_in_flight)
+
+    @contextmanager
+    def slot(self):
+        ''' Context manager which holds an in-flight slot. '''
+        if not self._semaphore.acquire(timeout=self.acquire_timeout):
+            raise ConcurrencyLimitError('{0} REST requests already in flight'
+                                        .format(self.max_in_flight))
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+# Both are disabled unless configured.
+CIRCUIT_BREAKERS = None
+IN_FLIGHT_LIMITER = None
+
+def configure_circuit_breakers(circuit_breakers):
+    global CIRCUIT_BREAKERS
+    CIRCUIT_BREAKERS = circuit_breakers
+
+def configure_in_flight_limiter(limiter):
+    global IN_FLIGHT_LIMITER
+    IN_FLIGHT_LIMITER = limiter
+
+# ==== Session pool ====
+
+class SessionPool():
+    ''' Thread-safe pool of requests.Session objects used by rest().
+        Each session holds its own urllib3 connection pools, so TCP/TLS
+        connections to the console are kept alive and reused across calls.
+          size: maximum number of idle sessions retained by the pool.
+            Callers are never blocked: when no idle session is available
+            a new one is created, and surplus sessions are closed on release.
+          pool_connections: number of per-host connection pools per session.
+          pool_maxsize: maximum number of connections per host per session.
+          keep_alive: if False, every request is sent with "Connection: close".
+        Sessions do not persist cookies between calls, so responses for one
+        user can never leak cookies into another user's request.
+    '''
+    def __init__(self, size=10, pool_connections=10, pool_maxsize=10, keep_alive=True):
+        if size < 1:
+            raise ValueError('Session pool size must be at least 1')
+        self.size = size
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    @contextmanager
+    def session(self):
+        ''' Context manager which checks out a session and returns it to the pool. '''
+        try:
+            session = self._idle.get_nowait()
+        except queue.Empty:
+            session = self._create_session()
+        try:
+            yield session
+        finally:
+            try:
+                self._idle.put_nowait(session)
+            except queue.Full:
+                session.close()
+
+    def idle_count(self):
+        ''' Returns the number of idle sessions currently held by the pool. '''
+        return self._idle.qsize()
+
+    def close(self):
+        ''' Closes all idle sessions and their connections. '''
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _create_session(self):
+        session = EnvironmentSnapshotSession()
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+class EnvironmentSnapshotSession(requests.Session):
+    ''' requests.Session which resolves proxy and CA bundle environment variables
+        (HTTPS_PROXY, NO_PROXY, REQUESTS_CA_BUNDLE etc.) once per URL origin,
+        instead of scanning the whole environment on every request.
+        Resolved settings are discarded when the app context is refreshed.
+    '''
+    max_origins = 32
+
+    def __init__(self):
+        super().__init__()
+        self._environ_context = None
+        self._environ_settings = {}
+
+    def merge_environment_settings(self, url, proxies, stream, verify, cert):
+        if not self.trust_env:
+            return super().merge_environment_settings(url, proxies, stream, verify, cert)
+        proxies = dict(proxies or {})
+        env_proxies, env_verify = self._resolve_environ_settings(url, proxies.get('no_proxy'))
+        for key, value in env_proxies.items():
+            proxies.setdefault(key, value)
+        if verify is True or verify is None:
+            verify = env_verify or verify
+        # The environment has been applied, so only the session settings remain.
+        return {'proxies': merge_setting(proxies, self.proxies),
+                'stream': merge_setting(stream, self.stream),
+                'verify': merge_setting(verify, self.verify),
+                'cert': merge_setting(cert, self.cert)}
+
+    def _resolve_environ_settings(self, url, no_proxy):
+        app_context = app_qpylib.get_app_context()
+        if self._environ_context is not app_context \
+            or len(self._environ_settings) >= self.max_origins:
+            self._environ_context = app_context
+            self._environ_settings = {}
+        scheme, netloc = urlsplit(url)[:2]
+        key = (scheme, netloc, no_proxy)
+        settings = self._environ_settings.get(key)
+        if settings is None:
+            settings = (get_environ_proxies(url, no_proxy=no_proxy),
+                        os.environ.get('REQUESTS_CA_BUNDLE') or os.environ.get('CURL_CA_BUNDLE'))
+            self._environ_settings[key] = settings
+        return settings
+
+SESSION_POOL = SessionPool()
+
+def configure_session_pool(size=10, pool_connections=10, pool_maxsize=10, keep_alive=True):
+    global SESSION_POOL
+    old_pool = SESSION_POOL
+    SESSION_POOL = SessionPool(size, pool_connections, pool_maxsize, keep_alive)
+    old_pool.close()
+
+def reset_session_pool():
+    # Discards sessions without closing their sockets, which may still be
+    # in use by a parent process after fork.
+    global SESSION_POOL
+    old_pool = SESSION_POOL
+    SESSION_POOL = SessionPool(old_pool.size, old_pool.pool_connections,
+                               old_pool.pool_maxsize, old_pool.keep_alive)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_session_pool)
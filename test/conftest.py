@@ -0,0 +1,12 @@
+# Copyright 2019 IBM Corporation All Rights Reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import pytest
+from qpylib import app_qpylib
+
+# Tests set environment variables in fixtures, so each test
+# starts without an app context, and builds it on first use.
+@pytest.fixture(scope='function', autouse=True)
+def reset_app_context():
+    app_qpylib.Q_APP_CONTEXT = None
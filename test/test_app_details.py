@@ -2,10 +2,14 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 #
-# pylint: disable=unused-argument, redefined-outer-name, invalid-name
+# pylint: disable=unused-argument, redefined-outer-name, invalid-name, protected-access
 
 from unittest.mock import patch
+import json
 import os
+import subprocess
+import sys
+import threading
 import pytest
 from qpylib import qpylib, app_qpylib
 
@@ -55,6 +59,53 @@ def test_get_app_id_raises_error_when_env_field_contains_string(env_qradar_app_i
     with pytest.raises(ValueError, match='Environment variable QRADAR_APP_ID has non-numeric value qradar_app_id'):
         qpylib.get_app_id()
 
+# ==== app context ====
+
+def test_app_context_is_snapshot_until_refreshed(env_qradar_app_id):
+    assert qpylib.get_app_id() == 1005
+    with patch.dict(os.environ, {'QRADAR_APP_ID': '2000'}):
+        assert qpylib.get_app_id() == 1005
+        assert qpylib.refresh_app_context().app_id == 2000
+        assert qpylib.get_app_id() == 2000
+
+def test_app_context_values(env_app_root, env_qradar_console_ip):
+    with patch.dict(os.environ, {'QRADAR_CONSOLE_FQDN': 'myhost.ibm.com'}):
+        app_context = qpylib.get_app_context()
+    assert app_context.app_id == 0
+    assert app_context.root_path == '/opt/app-root'
+    assert app_context.store_path == '/opt/app-root/store'
+    assert app_context.log_path == '/opt/app-root/store/log'
+    assert app_context.console_ip == '9.123.234.101'
+    assert app_context.console_url_prefix == 'https://myhost.ibm.com/'
+    assert app_context.rest_proxy is None
+    assert qpylib.get_app_context() is app_context
+    with pytest.raises(AttributeError):
+        app_context.app_id = 1
+
+def test_app_context_picks_up_environment_set_after_import(tmpdir):
+    # Runs in a new interpreter, so there is no conftest reset between
+    # importing qpylib and the first call.
+    script = (
+        'import os\n'
+        'from qpylib import qpylib\n'
+        'os.environ["QRADAR_CONSOLE_FQDN"] = "myhost.ibm.com"\n'
+        'os.environ["APP_ROOT"] = {0!r}\n'
+        'os.environ["SEC_ADMIN_TOKEN"] = "12345678-1234"\n'
+        'app_context = qpylib.get_app_context()\n'
+        'print(qpylib.get_console_fqdn(), qpylib.get_store_path(), app_context.sec_admin_token)\n'
+        .format(tmpdir.strpath))
+    env = {key: value for key, value in os.environ.items()
+           if key not in ('QRADAR_CONSOLE_FQDN', 'APP_ROOT', 'SEC_ADMIN_TOKEN')}
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', script], env=env)
+    assert output.decode().split() == ['myhost.ibm.com',
+                                       os.path.join(tmpdir.strpath, 'store'), '12345678-1234']
+
+def test_app_context_with_non_numeric_app_id(env_qradar_app_id_string):
+    assert qpylib.get_app_context().app_id is None
+    with pytest.raises(ValueError, match='non-numeric value qradar_app_id'):
+        qpylib.get_app_id()
+
 # ==== get_app_name ====
 
 @patch(MANIFEST_JSON_ROOT_PATH, return_value=manifest_path('installed.json'))
@@ -77,6 +128,77 @@ def test_get_manifest_json_no_cache(mock_manifest):
     assert manifest_json['uuid'] == 'aaff161f-871a-435c-866b-c65b4ceca959'
     assert manifest_json['console_ip'] == '9.123.234.101'
 
+# ==== get_manifest ====
+
+@patch(MANIFEST_JSON_ROOT_PATH, return_value=manifest_path('services.json'))
+def test_get_manifest_precomputes_fields(mock_manifest):
+    manifest = qpylib.get_manifest()
+    assert manifest.name == 'ServiceJSONLD'
+    assert manifest.log_level is None
+    assert len(manifest.services) == len(manifest.json['services'])
+    assert [endpoint['name'] for endpoint in manifest.endpoints][:2] == ['endpoint1', 'ep1']
+    assert not manifest.reload_on_change
+    with pytest.raises(AttributeError):
+        manifest.name = 'changed'
+
+@patch(MANIFEST_JSON_ROOT_PATH, return_value=manifest_path('installed.json'))
+def test_get_manifest_is_loaded_once(mock_manifest):
+    manifest = qpylib.get_manifest()
+    with patch('qpylib.app_qpylib.open') as mock_open:
+        assert qpylib.get_manifest() is manifest
+        assert qpylib.get_app_name() == 'Live Manifest'
+    mock_open.assert_not_called()
+
+def write_manifest(path, name, mtime):
+    with open(path, 'w') as manifest_file:
+        json.dump({'name': name}, manifest_file)
+    os.utime(path, (mtime, mtime))
+
+@pytest.fixture(scope='function')
+def env_sdk():
+    os.environ['QRADAR_APPFW_SDK'] = 'true'
+    yield
+    del os.environ['QRADAR_APPFW_SDK']
+
+def test_get_manifest_reloads_on_mtime_change_in_sdk_mode(env_sdk, tmpdir):
+    path = os.path.join(tmpdir.strpath, 'manifest.json')
+    write_manifest(path, 'First', 1000000000)
+    with patch(MANIFEST_JSON_ROOT_PATH, return_value=path):
+        manifest = qpylib.get_manifest()
+        assert manifest.reload_on_change
+        assert qpylib.get_manifest() is manifest
+        write_manifest(path, 'Second', 1000000100)
+        assert qpylib.get_app_name() == 'Second'
+        os.remove(path)
+        assert qpylib.get_app_name() == 'Second'
+
+def test_get_manifest_ignores_mtime_change_outside_sdk_mode(tmpdir):
+    path = os.path.join(tmpdir.strpath, 'manifest.json')
+    write_manifest(path, 'First', 1000000000)
+    with patch(MANIFEST_JSON_ROOT_PATH, return_value=path):
+        assert qpylib.get_app_name() == 'First'
+        write_manifest(path, 'Second', 1000000100)
+        assert qpylib.get_app_name() == 'First'
+
+@patch(MANIFEST_JSON_ROOT_PATH, return_value=manifest_path('installed.json'))
+def test_get_manifest_loads_once_across_threads(mock_manifest):
+    manifests = []
+    threads = [threading.Thread(target=lambda: manifests.append(qpylib.get_manifest()))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(manifest is manifests[0] for manifest in manifests)
+
+@patch(MANIFEST_JSON_ROOT_PATH, return_value=manifest_path('installed.json'))
+def test_load_manifest_returns_manifest_loaded_by_another_thread(mock_manifest):
+    manifest = qpylib.get_manifest()
+    # A thread which was waiting for the lock finds the manifest already loaded.
+    with patch('qpylib.app_qpylib.open') as mock_open:
+        assert app_qpylib._load_manifest() is manifest
+    mock_open.assert_not_called()
+
 # ==== get_manifest_field_value ====
 
 @patch(MANIFEST_JSON_ROOT_PATH, return_value=manifest_path('installed.json'))
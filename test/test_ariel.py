@@ -2,10 +2,17 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import json
 import os
+import re
+import time
+from urllib.parse import parse_qs, urlparse
+from flask import Flask
 import pytest
+import requests
 import responses
-from qpylib.ariel import ArielSearch, ArielError
+from werkzeug import http
+from qpylib.ariel import ArielSearch, ArielError, AdaptivePolling, FixedPolling, PollingStrategy
 
 DUMMY_QUERY = 'select stuff from db'
 SEARCH_ID = 'fa7a12c4-a3a7-425a-82b3-67d42c33860c'
@@ -181,3 +188,367 @@ def test_search_cancel_failure():
 def test_search_cancel_success():
     responses.add('POST', CANCEL_SEARCH, status=200, json={'status': 'COMPLETED'})
     assert ArielSearch().cancel(SEARCH_ID) == 'COMPLETED'
+
+def paged_results_callback(request):
+    start, end = [int(i) for i in request.headers['Range'][len('items='):].split('-')]
+    return (200, {}, json.dumps({'events': [{'id': i} for i in range(start, end + 1)]}))
+
+@responses.activate
+def test_iter_results_pages_through_all_records():
+    responses.add_callback('GET', GET_RESULTS, callback=paged_results_callback)
+    records = list(ArielSearch().iter_results(SEARCH_ID, page_size=4, record_count=10))
+    assert [record['id'] for record in records] == list(range(10))
+    assert [call.request.headers['Range'] for call in responses.calls] == \
+        ['items=0-3', 'items=4-7', 'items=8-9']
+
+@responses.activate
+def test_iter_results_single_record_page_uses_range():
+    responses.add_callback('GET', GET_RESULTS, callback=paged_results_callback)
+    records = list(ArielSearch().iter_results(SEARCH_ID, page_size=1, record_count=2))
+    assert records == [{'id': 0}, {'id': 1}]
+    assert responses.calls[0].request.headers['Range'] == 'items=0-0'
+
+@responses.activate
+def test_iter_results_retrieves_record_count_from_status():
+    responses.add('GET', GET_SEARCH, status=200,
+                  json={'status': 'COMPLETED', 'record_count': 3})
+    responses.add_callback('GET', GET_RESULTS, callback=paged_results_callback)
+    records = list(ArielSearch().iter_results(SEARCH_ID, api_version='12'))
+    assert len(records) == 3
+    assert responses.calls[1].request.headers['Range'] == 'items=0-2'
+    assert responses.calls[1].request.headers['Version'] == '12'
+
+@responses.activate
+def test_iter_results_no_records():
+    assert not list(ArielSearch().iter_results(SEARCH_ID, record_count=0))
+    assert len(responses.calls) == 0
+
+@responses.activate
+def test_iter_results_page_failure():
+    responses.add('GET', GET_RESULTS, status=500, json={})
+    with pytest.raises(ArielError, match='Results for Ariel search {0} could not be retrieved'
+                       .format(SEARCH_ID)):
+        list(ArielSearch().iter_results(SEARCH_ID, record_count=5))
+
+@responses.activate
+def test_iter_results_accepts_list_pages():
+    responses.add('GET', GET_RESULTS, status=200, json=[{'id': 0}, {'id': 1}])
+    records = list(ArielSearch().iter_results(SEARCH_ID, record_count=2))
+    assert records == [{'id': 0}, {'id': 1}]
+
+def test_iter_results_bad_page_size():
+    with pytest.raises(ValueError, match='Invalid page size 0'):
+        list(ArielSearch().iter_results(SEARCH_ID, page_size=0, record_count=5))
+
+@responses.activate
+def test_iter_results_parallel_preserves_order():
+    def out_of_order_callback(request):
+        start = int(request.headers['Range'][len('items='):].split('-')[0])
+        # Earlier pages take longer so that later pages complete first.
+        time.sleep(0.02 if start < 6 else 0)
+        return paged_results_callback(request)
+    responses.add_callback('GET', GET_RESULTS, callback=out_of_order_callback)
+    records = list(ArielSearch().iter_results_parallel(SEARCH_ID, page_size=3, max_workers=4,
+                                                       record_count=20))
+    assert [record['id'] for record in records] == list(range(20))
+    assert len(responses.calls) == 7
+
+@responses.activate
+def test_iter_results_parallel_uses_flask_request_cookies():
+    responses.add_callback('GET', GET_RESULTS, callback=paged_results_callback)
+    app = Flask(__name__)
+    cookie = http.dump_cookie('SEC', 'seccookie-12345')
+    with app.test_request_context(headers={'COOKIE': cookie}):
+        records = list(ArielSearch().iter_results_parallel(SEARCH_ID, page_size=2,
+                                                           max_workers=2, record_count=5))
+    assert len(records) == 5
+    for call in responses.calls:
+        assert call.request.headers['SEC'] == 'seccookie-12345'
+
+@responses.activate
+def test_iter_results_parallel_page_failure():
+    responses.add('GET', GET_RESULTS, status=500, json={})
+    with pytest.raises(ArielError, match='Results for Ariel search {0} could not be retrieved'
+                       .format(SEARCH_ID)):
+        list(ArielSearch().iter_results_parallel(SEARCH_ID, record_count=5))
+
+@responses.activate
+def test_iter_results_parallel_bounds_pages_ahead():
+    responses.add_callback('GET', GET_RESULTS, callback=paged_results_callback)
+    records = ArielSearch().iter_results_parallel(SEARCH_ID, page_size=1, max_workers=1,
+                                                  record_count=10)
+    assert next(records) == {'id': 0}
+    assert len(responses.calls) <= 3
+    records.close()
+    assert len(responses.calls) <= 4
+
+def test_iter_results_parallel_bad_worker_count():
+    with pytest.raises(ValueError, match='Invalid worker count 0'):
+        list(ArielSearch().iter_results_parallel(SEARCH_ID, max_workers=0, record_count=5))
+
+# ==== Polling strategies ====
+
+def test_adaptive_polling_backs_off_exponentially():
+    polling = AdaptivePolling(initial_interval=0.1, max_interval=1, multiplier=2, jitter=0)
+    intervals = [polling.next_interval(attempt, 0, {'status': 'EXECUTE'}) for attempt in range(6)]
+    assert intervals == pytest.approx([0.1, 0.2, 0.4, 0.8, 1, 1])
+
+def test_adaptive_polling_applies_jitter():
+    polling = AdaptivePolling(initial_interval=1, jitter=0.5)
+    for _ in range(20):
+        assert 0.5 <= polling.next_interval(0, 0, {}) <= 1.5
+
+def test_adaptive_polling_uses_progress_estimate():
+    polling = AdaptivePolling(initial_interval=0.1, max_interval=10, jitter=0)
+    # 90% done after 9s: roughly 1s remaining, sooner than the backoff interval.
+    assert polling.next_interval(10, 9, {'progress': 90}) == pytest.approx(1)
+    # 10% done after 1s: estimate is longer than the backoff interval.
+    assert polling.next_interval(1, 1, {'progress': 10}) == pytest.approx(0.2)
+
+def test_adaptive_polling_polls_fast_when_completed():
+    polling = AdaptivePolling(initial_interval=0.1, jitter=0)
+    assert polling.next_interval(8, 30, {'completed': True}) == pytest.approx(0.1)
+
+def test_polling_strategy_is_abstract():
+    with pytest.raises(NotImplementedError):
+        PollingStrategy().next_interval(0, 0, {})
+
+@responses.activate
+def test_search_sync_adaptive_polling_by_default():
+    responses.add('POST', POST_SEARCH, status=201,
+                  json={'status': 'WAIT', 'search_id': SEARCH_ID})
+    responses.add('GET', GET_SEARCH, status=200,
+                  json={'status': 'EXECUTE', 'record_count': 0, 'progress': 50})
+    responses.add('GET', GET_SEARCH, status=200,
+                  json={'status': 'COMPLETED', 'record_count': 3})
+    start_time = time.time()
+    search_id, record_count = ArielSearch().search_sync(DUMMY_QUERY)
+    assert time.time() - start_time < 1
+    assert search_id == SEARCH_ID
+    assert record_count == 3
+
+class RecordingPolling(PollingStrategy):
+    def __init__(self):
+        self.calls = []
+
+    def next_interval(self, attempt, elapsed, status_json):
+        self.calls.append((attempt, status_json['progress']))
+        return 0
+
+@responses.activate
+def test_search_sync_uses_supplied_polling_strategy():
+    responses.add('POST', POST_SEARCH, status=201,
+                  json={'status': 'WAIT', 'search_id': SEARCH_ID})
+    for progress in (10, 60):
+        responses.add('GET', GET_SEARCH, status=200,
+                      json={'status': 'EXECUTE', 'record_count': 0, 'progress': progress})
+    responses.add('GET', GET_SEARCH, status=200,
+                  json={'status': 'COMPLETED', 'record_count': 5, 'progress': 100})
+    polling = RecordingPolling()
+    assert ArielSearch().search_sync(DUMMY_QUERY, polling=polling) == (SEARCH_ID, 5)
+    assert polling.calls == [(0, 10), (1, 60)]
+
+@responses.activate
+def test_search_sync_sleep_does_not_exceed_timeout():
+    responses.add('POST', POST_SEARCH, status=201,
+                  json={'status': 'WAIT', 'search_id': SEARCH_ID})
+    responses.add('GET', GET_SEARCH, status=200,
+                  json={'status': 'WAIT', 'record_count': 0})
+    start_time = time.time()
+    with pytest.raises(ArielError, match='did not complete within 1s'):
+        ArielSearch().search_sync(DUMMY_QUERY, timeout=1, sleep_interval=30)
+    assert time.time() - start_time < 2
+
+# ==== search_many ====
+
+class FakeConsole():
+    ''' Tracks searches created via callbacks. Query text "polls:N:STATUS"
+        finishes with STATUS after N status checks. Status TIMEOUT makes status
+        checks time out, query text "unreachable" fails with a connection error,
+        and cancelling search2 fails.
+    '''
+    def __init__(self):
+        self.searches = {}
+        self.active = 0
+        self.peak = 0
+        self.cancelled = []
+
+    def create(self, request):
+        query = parse_qs(urlparse(request.url).query)['query_expression'][0]
+        if query == 'bad':
+            return (422, {}, json.dumps({'message': 'Invalid AQL'}))
+        if query == 'unreachable':
+            raise requests.exceptions.ConnectionError('console unreachable')
+        search_id = 'search{0}'.format(len(self.searches))
+        _, polls, status = query.split(':')
+        self.searches[search_id] = [int(polls), status]
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        return (201, {}, json.dumps({'status': 'WAIT', 'search_id': search_id}))
+
+    def status(self, request):
+        search_id = urlparse(request.url).path.split('/')[-1]
+        search = self.searches[search_id]
+        if search[1] == 'TIMEOUT':
+            raise requests.exceptions.Timeout('read timed out')
+        if search[0] > 0:
+            search[0] -= 1
+            return (200, {}, json.dumps({'status': 'EXECUTE', 'record_count': 0,
+                                         'search_id': search_id}))
+        self.active -= 1
+        return (200, {}, json.dumps({'status': search[1], 'record_count': 7}))
+
+    def cancel(self, request):
+        search_id = urlparse(request.url).path.split('/')[-1]
+        self.cancelled.append(search_id)
+        if search_id == 'search2':
+            return (500, {}, '')
+        return (200, {}, json.dumps({'status': 'CANCELED'}))
+
+def add_fake_console(console):
+    responses.add_callback('POST', re.compile(ARIEL_URL + r'\?.*'), callback=console.create)
+    responses.add_callback('GET', re.compile(ARIEL_URL + r'/search\d+$'), callback=console.status)
+    responses.add_callback('POST', re.compile(ARIEL_URL + r'/search\d+\?status=CANCELLED$'),
+                           callback=console.cancel)
+
+@responses.activate
+def test_search_many_returns_outcome_per_query():
+    console = FakeConsole()
+    add_fake_console(console)
+    queries = ['q:3:COMPLETED', 'bad', 'q:0:COMPLETED', 'q:1:ERROR']
+    outcomes = list(ArielSearch().search_many(queries, polling=FixedPolling(0)))
+    assert [outcome[0] for outcome in outcomes] == [1, 2, 3, 0]
+    by_index = {outcome[0]: outcome[1:] for outcome in outcomes}
+    assert by_index[0] == ('search0', 7, None)
+    assert by_index[2] == ('search1', 7, None)
+    assert by_index[1][:2] == (None, None)
+    assert str(by_index[1][2]) == 'Invalid AQL'
+    assert by_index[3][0] == 'search2'
+    assert str(by_index[3][2]) == 'Ariel search search2 failed: ERROR'
+    assert by_index[3][2].aql == 'q:1:ERROR'
+
+@responses.activate
+def test_search_many_respects_max_concurrent():
+    console = FakeConsole()
+    add_fake_console(console)
+    queries = ['q:{0}:COMPLETED'.format(i % 3) for i in range(10)]
+    outcomes = list(ArielSearch().search_many(queries, max_concurrent=3,
+                                              polling=FixedPolling(0)))
+    assert sorted(outcome[0] for outcome in outcomes) == list(range(10))
+    assert all(outcome[3] is None for outcome in outcomes)
+    assert console.peak == 3
+
+@responses.activate
+def test_search_many_timeout():
+    console = FakeConsole()
+    add_fake_console(console)
+    outcomes = list(ArielSearch().search_many(['q:1000:COMPLETED'], timeout=0.2,
+                                              polling=FixedPolling(0.05)))
+    assert outcomes[0][:3] == (0, 'search0', None)
+    assert str(outcomes[0][3]) == 'Ariel search search0 did not complete within 0.2s'
+
+@responses.activate
+def test_search_many_adaptive_polling_by_default():
+    console = FakeConsole()
+    add_fake_console(console)
+    outcomes = list(ArielSearch().search_many(['q:1:COMPLETED']))
+    assert outcomes == [(0, 'search0', 7, None)]
+
+@responses.activate
+def test_search_many_status_failure():
+    responses.add('POST', re.compile(ARIEL_URL + r'\?.*'), status=201,
+                  json={'status': 'WAIT', 'search_id': SEARCH_ID})
+    responses.add('GET', GET_SEARCH, status=500, body='boom')
+    outcomes = list(ArielSearch().search_many([DUMMY_QUERY]))
+    assert outcomes[0][:3] == (0, SEARCH_ID, None)
+    assert str(outcomes[0][3]) == "Ariel search {0} could not be retrieved: b'boom'".format(SEARCH_ID)
+    assert outcomes[0][3].aql == DUMMY_QUERY
+
+@responses.activate
+def test_search_many_reports_request_errors_per_query():
+    console = FakeConsole()
+    add_fake_console(console)
+    queries = ['unreachable', 'q:0:TIMEOUT', 'q:1:COMPLETED']
+    outcomes = list(ArielSearch().search_many(queries, polling=FixedPolling(0)))
+    by_index = {outcome[0]: outcome[1:] for outcome in outcomes}
+    assert by_index[0][:2] == (None, None)
+    assert str(by_index[0][2]) == 'Ariel search could not be created: console unreachable'
+    assert by_index[0][2].aql == 'unreachable'
+    assert isinstance(by_index[0][2].__cause__, requests.exceptions.ConnectionError)
+    assert by_index[1][:2] == ('search0', None)
+    assert str(by_index[1][2]) == 'Ariel search search0 could not be retrieved: read timed out'
+    assert by_index[1][2].aql == 'q:0:TIMEOUT'
+    assert by_index[2] == ('search1', 7, None)
+    assert not console.cancelled
+
+@responses.activate
+def test_search_many_cancels_outstanding_searches_when_closed():
+    console = FakeConsole()
+    add_fake_console(console)
+    queries = ['q:1000:COMPLETED', 'q:0:COMPLETED', 'q:1000:COMPLETED', 'q:0:COMPLETED']
+    outcomes = ArielSearch().search_many(queries, max_concurrent=3, polling=FixedPolling(0.01))
+    assert next(outcomes) == (1, 'search1', 7, None)
+    outcomes.close()
+    assert sorted(console.cancelled) == ['search0', 'search2']
+
+@responses.activate
+def test_search_many_cancels_outstanding_searches_on_error():
+    class FailingPolling(PollingStrategy):
+        def next_interval(self, attempt, elapsed, status_json):
+            raise RuntimeError('polling failed')
+    console = FakeConsole()
+    add_fake_console(console)
+    with pytest.raises(RuntimeError, match='polling failed'):
+        list(ArielSearch().search_many(['q:5:COMPLETED', 'q:5:COMPLETED'],
+                                       polling=FailingPolling()))
+    assert sorted(console.cancelled) == ['search0', 'search1']
+
+class PerSearchPolling(PollingStrategy):
+    ''' Sleeps for a fixed interval per search and records the attempts seen. '''
+    def __init__(self, intervals):
+        self.intervals = intervals
+        self.attempts = {}
+
+    def next_interval(self, attempt, elapsed, status_json):
+        search_id = status_json['search_id']
+        self.attempts.setdefault(search_id, []).append(attempt)
+        return self.intervals.get(search_id, 0.01)
+
+@responses.activate
+def test_search_many_polls_only_due_searches():
+    console = FakeConsole()
+    add_fake_console(console)
+    polling = PerSearchPolling({'search0': 0.3, 'search1': 0.01})
+    outcomes = list(ArielSearch().search_many(['q:1:COMPLETED', 'q:5:COMPLETED'],
+                                              polling=polling))
+    assert [outcome[0] for outcome in outcomes] == [1, 0]
+    assert polling.attempts == {'search0': [0], 'search1': [0, 1, 2, 3, 4]}
+    assert len(responses.calls) == 2 + 2 + 6
+
+@responses.activate
+def test_search_many_keeps_attempts_per_search():
+    console = FakeConsole()
+    add_fake_console(console)
+    polling = PerSearchPolling({})
+    queries = ['q:0:COMPLETED', 'q:4:COMPLETED', 'q:3:COMPLETED']
+    outcomes = list(ArielSearch().search_many(queries, max_concurrent=2, polling=polling))
+    assert sorted(outcome[0] for outcome in outcomes) == [0, 1, 2]
+    assert polling.attempts == {'search1': [0, 1, 2, 3], 'search2': [0, 1, 2]}
+
+def test_search_many_bad_concurrency():
+    with pytest.raises(ValueError, match='Invalid concurrency 0'):
+        list(ArielSearch().search_many(['q'], max_concurrent=0))
+
+@responses.activate
+def test_stream_results_yields_records():
+    responses.add('GET', GET_RESULTS, status=200,
+                  json={'events': [{'sourceip': '10.0.0.1'}, {'sourceip': '10.0.0.2'}]})
+    records = ArielSearch().stream_results(SEARCH_ID, end=1, chunk_size=8)
+    assert list(records) == [{'sourceip': '10.0.0.1'}, {'sourceip': '10.0.0.2'}]
+    assert responses.calls[0].request.headers['Range'] == 'items=0-1'
+
+@responses.activate
+def test_stream_results_failure():
+    responses.add('GET', GET_RESULTS, status=500, json={})
+    with pytest.raises(ArielError, match='could not be retrieved'):
+        list(ArielSearch().stream_results(SEARCH_ID))
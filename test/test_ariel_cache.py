@@ -0,0 +1,222 @@
+# Copyright 2019 IBM Corporation All Rights Reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# pylint: disable=redefined-outer-name, unused-argument, invalid-name, duplicate-code
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+from unittest.mock import patch
+from flask import Flask
+import pytest
+import responses
+from werkzeug import http
+from qpylib.ariel import ArielError
+from qpylib.ariel_cache import (CachedArielSearch, DiskCacheBackend,
+                                MemoryCacheBackend, normalize_aql)
+
+SEARCH_ID = 'fa7a12c4-a3a7-425a-82b3-67d42c33860c'
+ARIEL_URL = 'https://myhost.ibm.com/api/ariel/searches'
+POST_SEARCH = '{0}?query_expression=select+stuff+from+db'.format(ARIEL_URL)
+GET_SEARCH = '{0}/{1}'.format(ARIEL_URL, SEARCH_ID)
+GET_RESULTS = '{0}/{1}/results'.format(ARIEL_URL, SEARCH_ID)
+
+@pytest.fixture(scope='module', autouse=True)
+def pre_testing_setup():
+    os.environ['QRADAR_CONSOLE_FQDN'] = 'myhost.ibm.com'
+    yield
+    del os.environ['QRADAR_CONSOLE_FQDN']
+
+def add_completed_search():
+    responses.add('POST', POST_SEARCH, status=201,
+                  json={'status': 'WAIT', 'search_id': SEARCH_ID})
+    responses.add('GET', GET_SEARCH, status=200,
+                  json={'status': 'COMPLETED', 'record_count': 3})
+
+# ==== normalize_aql ====
+
+def test_normalize_aql_collapses_whitespace():
+    assert normalize_aql('  select  *\n\tfrom events  LAST 5 MINUTES ;') == \
+        'select * from events LAST 5 MINUTES'
+
+def test_normalize_aql_preserves_quoted_literals():
+    assert normalize_aql("select * from events where x = 'a  b'  and y = \"c\t d\"") == \
+        "select * from events where x = 'a  b' and y = \"c\t d\""
+
+# ==== backends ====
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryCacheBackend(max_entries=2)
+    expires = time.time() + 60
+    backend.put(('a',), 1, expires)
+    backend.put(('b',), 2, expires)
+    assert backend.get(('a',)) == 1
+    backend.put(('c',), 3, expires)
+    assert backend.get(('b',)) is None
+    assert backend.get(('a',)) == 1
+    assert backend.get(('c',)) == 3
+
+def test_memory_backend_expires_entries():
+    backend = MemoryCacheBackend()
+    backend.put(('a',), 1, time.time() - 1)
+    assert backend.get(('a',)) is None
+
+def test_memory_backend_rejects_bad_size():
+    with pytest.raises(ValueError, match='max_entries must be at least 1'):
+        MemoryCacheBackend(max_entries=0)
+
+def test_disk_backend_persists_across_instances(tmpdir):
+    with patch('qpylib.app_qpylib.get_store_path', return_value=tmpdir.strpath):
+        DiskCacheBackend().put(('search', 'select 1', 'latest'), [SEARCH_ID, 3],
+                               time.time() + 60)
+        assert DiskCacheBackend().get(('search', 'select 1', 'latest')) == [SEARCH_ID, 3]
+
+def test_disk_backend_expires_and_evicts(tmpdir):
+    with patch('qpylib.app_qpylib.get_store_path', return_value=tmpdir.strpath):
+        backend = DiskCacheBackend(max_entries=2)
+        backend.put(('expired',), 1, time.time() - 1)
+        assert backend.get(('expired',)) is None
+        for index in range(4):
+            backend.put((index,), index, time.time() + 60)
+            os.utime(backend._entry_path((index,)), (index, index)) # pylint: disable=protected-access
+        backend.put(('latest',), 'x', time.time() + 60)
+        assert len(os.listdir(tmpdir.strpath)) == 2
+        assert backend.get(('latest',)) == 'x'
+        assert backend.get((3,)) == 3
+        backend.clear()
+        assert not os.listdir(tmpdir.strpath)
+
+# ==== CachedArielSearch ====
+
+@responses.activate
+def test_cached_search_sync_reuses_outcome_for_equivalent_query():
+    add_completed_search()
+    search = CachedArielSearch()
+    assert search.search_sync('select stuff from db') == (SEARCH_ID, 3)
+    assert search.search_sync('  select   stuff from db ;') == (SEARCH_ID, 3)
+    assert len(responses.calls) == 2
+
+@responses.activate
+def test_cached_search_sync_keys_on_api_version():
+    add_completed_search()
+    search = CachedArielSearch()
+    search.search_sync('select stuff from db')
+    search.search_sync('select stuff from db', api_version='12')
+    assert len(responses.calls) == 4
+
+@responses.activate
+def test_cached_search_sync_expires_after_ttl():
+    add_completed_search()
+    search = CachedArielSearch(ttl=0)
+    search.search_sync('select stuff from db')
+    search.search_sync('select stuff from db')
+    assert len(responses.calls) == 4
+
+@responses.activate
+def test_cached_search_sync_does_not_cache_errors():
+    responses.add('POST', POST_SEARCH, status=500, json={'message': 'Search creation failed'})
+    search = CachedArielSearch()
+    for _ in range(2):
+        with pytest.raises(ArielError, match='Search creation failed'):
+            search.search_sync('select stuff from db')
+    assert len(responses.calls) == 2
+
+@responses.activate
+def test_cached_results_reused_per_range():
+    responses.add('GET', GET_RESULTS, status=200, json={'events': [{'id': 1}]})
+    search = CachedArielSearch()
+    assert search.results(SEARCH_ID) == {'events': [{'id': 1}]}
+    assert search.results(SEARCH_ID) == {'events': [{'id': 1}]}
+    search.results(SEARCH_ID, start=0, end=1)
+    assert len(responses.calls) == 2
+    search.clear()
+    search.results(SEARCH_ID)
+    assert len(responses.calls) == 3
+
+@responses.activate
+def test_cached_search_sync_coalesces_concurrent_callers():
+    release = threading.Event()
+
+    def slow_create(request):
+        release.wait(5)
+        return (201, {}, '{"status": "WAIT", "search_id": "%s"}' % SEARCH_ID)
+
+    responses.add_callback('POST', POST_SEARCH, callback=slow_create)
+    responses.add('GET', GET_SEARCH, status=200,
+                  json={'status': 'COMPLETED', 'record_count': 3})
+    search = CachedArielSearch()
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(search.search_sync, 'select stuff from db')
+                   for _ in range(5)]
+        time.sleep(0.1)
+        release.set()
+        outcomes = [future.result() for future in futures]
+    assert outcomes == [(SEARCH_ID, 3)] * 5
+    assert len(responses.calls) == 2
+
+@responses.activate
+def test_cached_search_sync_with_disk_backend(tmpdir):
+    add_completed_search()
+    with patch('qpylib.app_qpylib.get_store_path', return_value=tmpdir.strpath):
+        CachedArielSearch(backend=DiskCacheBackend()).search_sync('select stuff from db')
+        outcome = CachedArielSearch(backend=DiskCacheBackend()).search_sync('select stuff from db')
+    assert outcome == (SEARCH_ID, 3)
+    assert len(responses.calls) == 2
+
+@responses.activate
+def test_cached_results_are_not_shared_between_users():
+    responses.add('GET', GET_RESULTS, status=200, json={'events': [{'id': 1}]})
+    search = CachedArielSearch()
+    app = Flask(__name__)
+    for sec in ('user1', 'user2', 'user1'):
+        with app.test_request_context(headers={'COOKIE': http.dump_cookie('SEC', sec)}):
+            search.results(SEARCH_ID)
+    assert len(responses.calls) == 2
+    assert responses.calls[1].request.headers['SEC'] == 'user2'
+
+@responses.activate
+def test_cached_search_sync_coalesces_only_within_one_user():
+    release = threading.Event()
+
+    def slow_create(request):
+        release.wait(5)
+        return (201, {}, '{"status": "WAIT", "search_id": "%s"}' % SEARCH_ID)
+
+    responses.add_callback('POST', POST_SEARCH, callback=slow_create)
+    responses.add('GET', GET_SEARCH, status=200,
+                  json={'status': 'COMPLETED', 'record_count': 3})
+    search = CachedArielSearch()
+    app = Flask(__name__)
+
+    def search_as(sec):
+        with app.test_request_context(headers={'COOKIE': http.dump_cookie('SEC', sec)}):
+            return search.search_sync('select stuff from db')
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(search_as, sec) for sec in ('user1', 'user2') * 2]
+        time.sleep(0.1)
+        release.set()
+        assert [future.result() for future in futures] == [(SEARCH_ID, 3)] * 4
+    assert sorted(call.request.headers['SEC'] for call in responses.calls
+                  if call.request.method == 'POST') == ['user1', 'user2']
+
+def test_disk_backend_rejects_bad_size(tmpdir):
+    with patch('qpylib.app_qpylib.get_store_path', return_value=tmpdir.strpath):
+        with pytest.raises(ValueError, match='max_entries must be at least 1'):
+            DiskCacheBackend(max_entries=0)
+
+def test_disk_backend_tolerates_files_changing_underneath(tmpdir):
+    with patch('qpylib.app_qpylib.get_store_path', return_value=tmpdir.strpath):
+        backend = DiskCacheBackend(max_entries=1)
+    backend.put(('a',), 'x', time.time() + 60)
+    with open(os.path.join(tmpdir.strpath, 'README.txt'), 'w') as other_file:
+        other_file.write('not a cache entry')
+    with patch('qpylib.ariel_cache.os.utime', side_effect=OSError('read-only')):
+        assert backend.get(('a',)) == 'x'
+    with patch('qpylib.ariel_cache.os.path.getmtime', side_effect=OSError('vanished')):
+        backend.put(('b',), 'y', time.time() + 60)
+    with patch('qpylib.ariel_cache.os.remove', side_effect=OSError('vanished')):
+        backend.put(('c',), 'z', time.time() + 60)
+    assert backend.get(('c',)) == 'z'
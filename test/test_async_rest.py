@@ -0,0 +1,131 @@
+# Copyright 2019 IBM Corporation All Rights Reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# pylint: disable=redefined-outer-name, unused-argument, invalid-name
+
+import asyncio
+import os
+import threading
+import time
+from flask import Flask
+import pytest
+import responses
+from werkzeug import http
+from qpylib import qpylib
+from qpylib.async_rest import AsyncREST
+
+TESTING_URL = 'https://myhost.ibm.com/testing_endpoint'
+
+@pytest.fixture(autouse=True)
+def env_qradar_console_fqdn():
+    os.environ['QRADAR_CONSOLE_FQDN'] = 'myhost.ibm.com'
+    yield
+    del os.environ['QRADAR_CONSOLE_FQDN']
+
+@pytest.fixture()
+def env_sec_admin_token():
+    os.environ['SEC_ADMIN_TOKEN'] = '12345-testing-12345-testing'
+    yield
+    del os.environ['SEC_ADMIN_TOKEN']
+
+def run_request(*args, **kwargs):
+    async def _run():
+        async with AsyncREST() as client:
+            return await client.request(*args, **kwargs)
+    return asyncio.run(_run())
+
+@responses.activate
+def test_async_rest_get_applies_headers(env_sec_admin_token):
+    responses.add('GET', TESTING_URL, status=200, json={'id': 1})
+    response = run_request('GET', 'testing_endpoint', version='12', headers={'Host': '127.0.0.1'})
+    assert response.status_code == 200
+    assert response.json() == {'id': 1}
+    assert responses.calls[0].request.headers['Version'] == '12'
+    assert responses.calls[0].request.headers['SEC'] == '12345-testing-12345-testing'
+
+@responses.activate
+def test_async_rest_uses_default_timeout():
+    responses.add('POST', TESTING_URL, status=201,
+                  match=[responses.matchers.request_kwargs_matcher({'timeout': 60})])
+    response = run_request('POST', 'testing_endpoint', headers={'Host': '127.0.0.1'})
+    assert response.status_code == 201
+
+@responses.activate
+def test_async_rest_uses_supplied_timeout():
+    responses.add('DELETE', TESTING_URL, status=204,
+                  match=[responses.matchers.request_kwargs_matcher({'timeout': 5})])
+    response = run_request('DELETE', 'testing_endpoint', headers={'Host': '127.0.0.1'}, timeout=5)
+    assert response.status_code == 204
+
+@responses.activate
+def test_async_rest_uses_flask_request_cookies():
+    responses.add('GET', TESTING_URL, status=200)
+    app = Flask(__name__)
+    cookie = http.dump_cookie('SEC', 'seccookie-12345')
+    with app.test_request_context(headers={'COOKIE': cookie}):
+        run_request('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'})
+    assert responses.calls[0].request.headers['SEC'] == 'seccookie-12345'
+
+def test_async_rest_rejects_unsupported_method():
+    with pytest.raises(ValueError, match='Unsupported REST action was requested'):
+        run_request('PATCH', 'testing_endpoint', headers={'Host': '127.0.0.1'})
+
+def test_async_rest_rejects_bad_concurrency():
+    with pytest.raises(ValueError, match='max_concurrency must be at least 1'):
+        AsyncREST(max_concurrency=0)
+
+@responses.activate
+def test_async_rest_limits_concurrency():
+    lock = threading.Lock()
+    counts = {'active': 0, 'peak': 0}
+
+    def slow_callback(request):
+        with lock:
+            counts['active'] += 1
+            counts['peak'] = max(counts['peak'], counts['active'])
+        time.sleep(0.05)
+        with lock:
+            counts['active'] -= 1
+        return (200, {}, '{}')
+
+    responses.add_callback('GET', TESTING_URL, callback=slow_callback)
+
+    async def _run():
+        async with AsyncREST(max_concurrency=3) as client:
+            return await asyncio.gather(
+                *[client.request('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'})
+                  for _ in range(9)])
+
+    results = asyncio.run(_run())
+    assert len(results) == 9
+    assert counts['peak'] == 3
+
+@responses.activate
+def test_async_rest_supports_response_cache():
+    responses.add('GET', TESTING_URL, status=200, json={'id': 1}, headers={'ETag': '"v1"'})
+    responses.add('GET', TESTING_URL, status=304)
+    qpylib.configure_rest_response_cache()
+    try:
+        run_request('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'}, cache_ttl=0)
+        response = run_request('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'},
+                               cache_ttl=0)
+    finally:
+        qpylib.configure_rest_response_cache()
+    assert response.from_cache
+    assert response.json() == {'id': 1}
+    assert responses.calls[1].request.headers['If-None-Match'] == '"v1"'
+
+@responses.activate
+def test_async_rest_client_reused_across_event_loops():
+    responses.add('GET', TESTING_URL, status=200)
+    client = AsyncREST(max_concurrency=2)
+
+    async def _run():
+        return await asyncio.gather(
+            *[client.request('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'})
+              for _ in range(4)])
+
+    for _ in range(2):
+        assert [response.status_code for response in asyncio.run(_run())] == [200] * 4
+    client.close()
@@ -5,11 +5,14 @@
 # pylint: disable=redefined-outer-name, unused-argument, invalid-name
 
 import json
+import multiprocessing
 import os
 import shutil
+import stat
 from unittest.mock import patch
 import pytest
-from qpylib.encdec import Encryption, EncryptionError
+from qpylib.encdec import Encryption, EncryptionError, EncryptionStore
+from qpylib.encryption import cryptoutil
 
 QUSER_DB_STORE = 'quser_e.db'
 
@@ -29,8 +32,9 @@ def patch_get_store_path():
     with patch('qpylib.qpylib.get_store_path') as mock_get_store_path:
         mock_get_store_path.return_value = QUSER_DB_STORE
         yield
-        if os.path.isfile(QUSER_DB_STORE):
-            os.remove(QUSER_DB_STORE)
+        for store_file in (QUSER_DB_STORE, QUSER_DB_STORE + '.lock'):
+            if os.path.isfile(store_file):
+                os.remove(store_file)
 
 # Use this for tests that use an actual config file from the encdec_db directory.
 def copy_dbstore(dbstore_file_name, target_dir):
@@ -235,6 +239,16 @@ def test_encrypt_raises_error_when_config_db_not_writable(uuid_env_var, tmpdir):
         with pytest.raises(EncryptionError, match='Unable to save config'):
             enc.encrypt('xyz')
 
+def test_encrypt_keeps_config_db_permissions(uuid_env_var, tmpdir):
+    db_store_path = os.path.join(tmpdir.strpath, QUSER_DB_STORE)
+    with patch('qpylib.qpylib.get_store_path', return_value=db_store_path):
+        enc = Encryption({'name': 'secret_thing', 'user': 'quser'})
+        enc.encrypt('xyz')
+        os.chmod(db_store_path, 0o600)
+        enc.encrypt('abc')
+        assert stat.S_IMODE(os.stat(db_store_path).st_mode) == 0o600
+        assert enc.decrypt() == 'abc'
+
 def test_encrypt_decrypt_null_char(uuid_env_var, patch_get_store_path):
     enc = Encryption({'name': 'secret_thing', 'user': 'quser'})
     enc.encrypt('\x00')
@@ -249,3 +263,186 @@ def test_encrypt_decrypt_whitespace(uuid_env_var, patch_get_store_path):
     enc = Encryption({'name': 'secret_thing', 'user': 'quser'})
     assert enc.encrypt('  \n \t ')
     assert enc.decrypt() == '  \n \t '
+
+# ==== Derived key cache ====
+
+@pytest.fixture()
+def empty_key_cache():
+    Encryption.clear_key_cache()
+    yield
+    Encryption.clear_key_cache()
+    Encryption.set_key_cache_size(64)
+
+def test_decrypt_reuses_cached_derived_key(uuid_env_var, patch_get_store_path, empty_key_cache):
+    enc = Encryption({'name': 'test_name', 'user': 'quser'})
+    enc.encrypt('mypassword')
+    with patch('qpylib.encryption.cryptoutil.derive_key') as mock_derive_key:
+        assert enc.decrypt() == 'mypassword'
+        assert Encryption({'name': 'test_name', 'user': 'quser'}).decrypt() == 'mypassword'
+    mock_derive_key.assert_not_called()
+    assert len(cryptoutil.KEY_CACHE) == 1
+
+def test_clear_key_cache_forces_key_derivation(uuid_env_var, patch_get_store_path, empty_key_cache):
+    enc = Encryption({'name': 'test_name', 'user': 'quser'})
+    enc.encrypt('mypassword')
+    Encryption.clear_key_cache()
+    assert len(cryptoutil.KEY_CACHE) == 0
+    with patch('qpylib.encryption.cryptoutil.derive_key',
+               wraps=cryptoutil.derive_key) as mock_derive_key:
+        assert enc.decrypt() == 'mypassword'
+    mock_derive_key.assert_called_once()
+
+def test_key_cache_size_is_bounded(uuid_env_var, patch_get_store_path, empty_key_cache):
+    Encryption.set_key_cache_size(2)
+    for index in range(4):
+        Encryption({'name': 'name{0}'.format(index), 'user': 'quser'}).encrypt('secret')
+    assert len(cryptoutil.KEY_CACHE) == 2
+    Encryption.set_key_cache_size(0)
+    assert len(cryptoutil.KEY_CACHE) == 0
+    Encryption({'name': 'another', 'user': 'quser'}).encrypt('secret')
+    assert len(cryptoutil.KEY_CACHE) == 0
+
+def test_key_cache_rejects_negative_size():
+    with pytest.raises(ValueError, match='max_entries cannot be negative'):
+        Encryption.set_key_cache_size(-1)
+
+def test_key_cache_distinguishes_key_material(empty_key_cache):
+    key_cache = cryptoutil.DerivedKeyCache()
+    first = key_cache.get_or_derive(4, b'uuid-1', b'salt', 1000, 32, lambda: b'key-1')
+    second = key_cache.get_or_derive(4, b'uuid-2', b'salt', 1000, 32, lambda: b'key-2')
+    third = key_cache.get_or_derive(3, b'uuid-1', b'salt', 1000, 32, lambda: b'key-3')
+    assert (first, second, third) == (b'key-1', b'key-2', b'key-3')
+    assert key_cache.get_or_derive(4, b'uuid-1', b'salt', 1000, 32, lambda: b'other') == b'key-1'
+
+# ==== EncryptionStore ====
+
+def test_store_init_raises_error_on_empty_user(uuid_env_var):
+    with pytest.raises(EncryptionError, match='Supplied user cannot be empty'):
+        EncryptionStore('  ')
+
+def test_store_init_raises_error_on_missing_uuid_env_var():
+    with pytest.raises(EncryptionError, match='Environment variable QRADAR_APP_UUID is missing'):
+        EncryptionStore('quser')
+
+def test_store_encrypt_many_then_decrypt_many(uuid_env_var, patch_get_store_path, empty_key_cache):
+    store = EncryptionStore('quser')
+    encrypted = store.encrypt_many({'token': 'abc', ' password ': 'xyz', 'empty': ''})
+    assert sorted(encrypted) == ['empty', 'password', 'token']
+    with open(QUSER_DB_STORE) as db_file:
+        store_json = json.load(db_file)
+    assert store_json['token']['secret'] == encrypted['token']
+    assert EncryptionStore('quser').decrypt_many(['token', 'password', 'empty']) == \
+        {'token': 'abc', 'password': 'xyz', 'empty': ''}
+
+def test_store_items_compatible_with_encryption(uuid_env_var, patch_get_store_path):
+    Encryption({'name': 'single', 'user': 'quser'}).encrypt('one')
+    store = EncryptionStore('quser')
+    store.encrypt_many({'batch': 'two'})
+    assert store.decrypt_many(['single']) == {'single': 'one'}
+    assert Encryption({'name': 'batch', 'user': 'quser'}).decrypt() == 'two'
+    assert sorted(store.names()) == ['batch', 'single']
+
+def test_store_encrypt_many_derives_one_key_and_writes_once(uuid_env_var, patch_get_store_path,
+                                                            empty_key_cache):
+    store = EncryptionStore('quser')
+    with patch('qpylib.encryption.cryptoutil.derive_key',
+               wraps=cryptoutil.derive_key) as mock_derive_key:
+        with patch('os.replace', wraps=os.replace) as mock_replace:
+            store.encrypt_many({'name{0}'.format(i): 'secret{0}'.format(i) for i in range(20)})
+    assert mock_derive_key.call_count == 1
+    assert mock_replace.call_count == 1
+    assert not [name for name in os.listdir('.') if name.endswith('.tmp')]
+
+def test_store_encrypt_many_failure_leaves_store_unchanged(uuid_env_var, patch_get_store_path):
+    store = EncryptionStore('quser')
+    store.encrypt_many({'existing': 'value'})
+    with patch('qpylib.encryption.enginev4.Enginev4.encrypt',
+               side_effect=[store.config['existing']['secret'], ValueError('failed')]):
+        with pytest.raises(EncryptionError,
+                           match='Failed to encrypt secret for name other: ValueError'):
+            store.encrypt_many({'existing': 'new value', 'other': 'value'})
+    assert EncryptionStore('quser').names() == ['existing']
+    assert EncryptionStore('quser').decrypt_many(['existing']) == {'existing': 'value'}
+
+def test_store_decrypt_many_raises_error_on_unknown_name(uuid_env_var, patch_get_store_path):
+    with pytest.raises(EncryptionError, match='No config found for name missing'):
+        EncryptionStore('quser').decrypt_many(['missing'])
+
+def test_store_decrypt_many_raises_error_on_missing_secret(uuid_env_var, patch_get_store_path):
+    store = EncryptionStore('quser')
+    store.config['nosecret'] = {'version': Encryption.latest_engine_version}
+    with pytest.raises(EncryptionError, match='No secret found for name nosecret'):
+        store.decrypt_many(['nosecret'])
+
+def test_store_decrypt_many_raises_error_on_decryption_failure(uuid_env_var, patch_get_store_path):
+    store = EncryptionStore('quser')
+    store.encrypt_many({'token': 'value'})
+    with patch('qpylib.encryption.enginev4.Enginev4.decrypt', side_effect=ValueError('bad')):
+        with pytest.raises(EncryptionError,
+                           match='Failed to decrypt secret for name token: ValueError'):
+            store.decrypt_many(['token'])
+
+def test_store_rejects_empty_item_name(uuid_env_var, patch_get_store_path):
+    with pytest.raises(EncryptionError, match='Supplied name cannot be empty'):
+        EncryptionStore('quser').encrypt_many({' ': 'value'})
+
+def test_store_decrypt_many_reencrypts_legacy_items(v2_uuid_env_var, tmpdir):
+    db_store = 'v2user_e.db'
+    copy_dbstore(db_store, tmpdir.strpath)
+    with patch('qpylib.qpylib.get_store_path') as mock_get_store_path:
+        db_store_path = os.path.join(tmpdir.strpath, db_store)
+        mock_get_store_path.return_value = db_store_path
+        assert EncryptionStore('v2user').decrypt_many(['mykey', 'mytoken']) == \
+            {'mykey': '12345678', 'mytoken': 'abcdefghij'}
+        with open(db_store_path) as db_file:
+            store_json = json.load(db_file)
+        assert store_json['mykey']['version'] == Encryption.latest_engine_version
+        assert store_json['mytoken']['version'] == Encryption.latest_engine_version
+        assert EncryptionStore('v2user').decrypt_many(['mykey', 'mytoken']) == \
+            {'mykey': '12345678', 'mytoken': 'abcdefghij'}
+
+# ==== Concurrent store updates ====
+
+def encrypt_names(store_path, worker):
+    with patch('qpylib.qpylib.get_store_path', return_value=store_path):
+        for index in range(3):
+            name = 'worker{0}_name{1}'.format(worker, index)
+            Encryption({'name': name, 'user': 'quser'}).encrypt(name + '_secret')
+
+def test_concurrent_processes_do_not_lose_updates(uuid_env_var, tmpdir):
+    store_path = os.path.join(tmpdir.strpath, QUSER_DB_STORE)
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=encrypt_names, args=(store_path, worker))
+                 for worker in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    with patch('qpylib.qpylib.get_store_path', return_value=store_path):
+        store = EncryptionStore('quser')
+        assert len(store.names()) == 12
+        decrypted = store.decrypt_many(store.names())
+    assert all(value == name + '_secret' for name, value in decrypted.items())
+    assert not [name for name in os.listdir(tmpdir.strpath) if name.endswith('.tmp')]
+
+def test_save_merges_updates_made_by_other_instances(uuid_env_var, patch_get_store_path):
+    first = Encryption({'name': 'first', 'user': 'quser'})
+    second = Encryption({'name': 'second', 'user': 'quser'})
+    store = EncryptionStore('quser')
+    first.encrypt('one')
+    second.encrypt('two')
+    store.encrypt_many({'third': 'three'})
+    assert sorted(second.config) == ['first', 'second']
+    assert EncryptionStore('quser').decrypt_many(['first', 'second', 'third']) == \
+        {'first': 'one', 'second': 'two', 'third': 'three'}
+
+def test_failed_save_removes_temp_file(uuid_env_var, tmpdir):
+    store_path = os.path.join(tmpdir.strpath, QUSER_DB_STORE)
+    with patch('qpylib.qpylib.get_store_path', return_value=store_path):
+        enc = Encryption({'name': 'secret_thing', 'user': 'quser'})
+        with patch('qpylib.encdec.os.replace', side_effect=OSError('disk full')):
+            with pytest.raises(EncryptionError, match='Unable to save config .*disk full'):
+                enc.encrypt('xyz')
+    assert not os.path.exists(store_path)
+    assert not [name for name in os.listdir(tmpdir.strpath) if name.endswith('.tmp')]
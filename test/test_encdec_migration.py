@@ -0,0 +1,118 @@
+# Copyright 2019 IBM Corporation All Rights Reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# pylint: disable=redefined-outer-name, unused-argument, invalid-name, protected-access
+
+import json
+import os
+import runpy
+import shutil
+from unittest.mock import patch
+import pytest
+from qpylib import encdec_migration
+from qpylib.encdec import Encryption, EncryptionError, EncryptionStore
+
+V2_UUID = 'a1b2c3d4-4896-11e8-842f-0ed5f89f718b'
+
+@pytest.fixture()
+def app_store(tmpdir):
+    # Worker processes inherit environment variables, not mocks, so use a real APP_ROOT.
+    store_dir = os.path.join(tmpdir.strpath, 'store')
+    os.makedirs(store_dir)
+    os.environ['APP_ROOT'] = tmpdir.strpath
+    os.environ['QRADAR_APP_UUID'] = V2_UUID
+    yield store_dir
+    del os.environ['APP_ROOT']
+    del os.environ['QRADAR_APP_UUID']
+
+def copy_dbstore(dbstore_file_name, target_dir, target_file_name):
+    dbstore_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                     'encdec_db', dbstore_file_name)
+    shutil.copy(dbstore_file_path, os.path.join(target_dir, target_file_name))
+
+def read_store(store_dir, file_name):
+    with open(os.path.join(store_dir, file_name)) as db_file:
+        return json.load(db_file)
+
+def test_migration_with_no_store_files(app_store):
+    summary = encdec_migration.migrate_legacy_secrets(max_workers=2)
+    assert summary['files'] == 0
+    assert summary['migrated'] == 0
+    assert not summary['errors']
+
+def test_migration_upgrades_all_legacy_items(app_store):
+    copy_dbstore('v2user_e.db', app_store, 'alice_e.db')
+    copy_dbstore('v2user_e.db', app_store, 'bob_e.db')
+    EncryptionStore('carol').encrypt_many({'current': 'value'})
+    progress = []
+    summary = encdec_migration.migrate_legacy_secrets(
+        max_workers=2, progress_callback=lambda *args: progress.append(args))
+    assert summary['files'] == 3
+    assert summary['migrated'] == 4
+    assert not summary['errors']
+    assert summary['items_per_second'] > 0
+    assert [entry[:2] for entry in progress] == [(1, 3), (2, 3), (3, 3)]
+    assert progress[-1][2] == 4
+    for user in ('alice', 'bob'):
+        store_json = read_store(app_store, '{0}_e.db'.format(user))
+        assert store_json['mykey']['version'] == Encryption.latest_engine_version
+        assert store_json['mytoken']['version'] == Encryption.latest_engine_version
+        assert Encryption({'name': 'mytoken', 'user': user}).decrypt() == 'abcdefghij'
+
+def test_migration_reports_failed_store_files(app_store):
+    copy_dbstore('v2user_e.db', app_store, 'good_e.db')
+    with open(os.path.join(app_store, 'broken_e.db'), 'w') as db_file:
+        db_file.write('not json')
+    summary = encdec_migration.migrate_legacy_secrets(max_workers=1)
+    assert summary['migrated'] == 2
+    assert list(summary['errors']) == [os.path.join(app_store, 'broken_e.db')]
+    assert 'Unable to load config store' in summary['errors'][os.path.join(app_store, 'broken_e.db')]
+
+def test_background_migration(app_store):
+    copy_dbstore('v2user_e.db', app_store, 'alice_e.db')
+    summaries = []
+    thread = encdec_migration.start_background_migration(max_workers=1,
+                                                         done_callback=summaries.append)
+    thread.join(30)
+    assert summaries[0]['migrated'] == 2
+
+def test_main_prints_summary(app_store, capsys):
+    copy_dbstore('v2user_e.db', app_store, 'alice_e.db')
+    assert encdec_migration.main(['--workers', '1']) == 0
+    output = capsys.readouterr().out
+    assert '1/1 store files, 2 items migrated' in output
+    assert 'Migrated 2 items in 1 store files' in output
+
+def test_migrate_store_file_keeps_concurrent_update(app_store):
+    copy_dbstore('v2user_e.db', app_store, 'alice_e.db')
+    store_path = os.path.join(app_store, 'alice_e.db')
+    stale_store = EncryptionStore('alice')
+    Encryption({'name': 'mytoken', 'user': 'alice'}).encrypt('new token')
+    assert stale_store.decrypt_many(['mytoken']) == {'mytoken': 'abcdefghij'}
+    assert Encryption({'name': 'mytoken', 'user': 'alice'}).decrypt() == 'new token'
+    assert encdec_migration._migrate_store_file(store_path) == 1
+    assert encdec_migration._migrate_store_file(store_path) == 0
+    assert EncryptionStore('alice').decrypt_many(['mykey', 'mytoken']) == \
+        {'mykey': '12345678', 'mytoken': 'new token'}
+
+def test_main_prints_errors(app_store, capsys):
+    with open(os.path.join(app_store, 'broken_e.db'), 'w') as db_file:
+        db_file.write('not json')
+    assert encdec_migration.main(['--workers', '1']) == 1
+    assert 'Failed to migrate {0}'.format(os.path.join(app_store, 'broken_e.db')) \
+        in capsys.readouterr().out
+
+def test_upgrade_failure_leaves_store_unchanged(app_store):
+    copy_dbstore('v2user_e.db', app_store, 'alice_e.db')
+    with patch('qpylib.encryption.enginev2.Enginev2.decrypt', side_effect=ValueError('bad')):
+        with pytest.raises(EncryptionError, match='Failed to decrypt secret for name my'):
+            EncryptionStore('alice').upgrade_legacy_items()
+    assert read_store(app_store, 'alice_e.db')['mykey'].get('version', 2) == 2
+
+def test_run_as_module(app_store, capsys):
+    with patch('sys.argv', ['encdec_migration', '--workers', '1']):
+        with pytest.raises(SystemExit) as exit_info:
+            runpy.run_path(encdec_migration.__file__, run_name='__main__')
+    assert exit_info.value.code == 0
+    assert 'Migrated 0 items in 0 store files' in capsys.readouterr().out
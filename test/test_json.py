@@ -75,3 +75,61 @@ def test_class_to_json_dict():
     assert new_dict['theclassname'] == 'MyClass'
     assert new_dict['version'] == 3
     assert new_dict['thing'] == 'banana'
+
+# pylint: disable=too-few-public-methods
+class ChunkedResponse():
+    def __init__(self, body, chunk_size=1, encoding=None):
+        self.body = body.encode('utf-8')
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+        self.closed = False
+        self.chunks_read = 0
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), self.chunk_size):
+            self.chunks_read += 1
+            yield self.body[start:start + self.chunk_size]
+
+    def close(self):
+        self.closed = True
+
+def test_iter_json_items_yields_array_elements_across_chunk_boundaries():
+    body = ' [1.5e3, -20, "café \\"x\\"", true, null, {"a": [1, {}]}, [], 12345] '
+    response = ChunkedResponse(body)
+    assert list(qpylib.iter_json_items(response)) == [
+        1.5e3, -20, 'café "x"', True, None, {'a': [1, {}]}, [], 12345]
+    assert response.closed
+
+def test_iter_json_items_yields_object_members():
+    response = ChunkedResponse('{"a": 1, "b": {"c": [2]}}', chunk_size=3)
+    assert list(qpylib.iter_json_items(response)) == [('a', 1), ('b', {'c': [2]})]
+
+def test_iter_json_items_expands_key():
+    response = ChunkedResponse('{"count": 2, "events": [{"id": 1}, {"id": 2}], "more": [3]}')
+    assert list(qpylib.iter_json_items(response, key='events')) == [{'id': 1}, {'id': 2}]
+
+def test_iter_json_items_is_incremental():
+    response = ChunkedResponse('[' + ', '.join(['{"id": 1}'] * 100) + ']', chunk_size=10)
+    items = qpylib.iter_json_items(response)
+    assert next(items) == {'id': 1}
+    assert response.chunks_read == 2
+    items.close()
+    assert response.closed
+
+def test_iter_json_items_empty_containers():
+    assert not list(qpylib.iter_json_items(ChunkedResponse('[ ]')))
+    assert not list(qpylib.iter_json_items(ChunkedResponse('{}')))
+
+@pytest.mark.parametrize('body, message', [
+    ('42', 'not an array or object'),
+    ('[1, 2', 'Unexpected end of JSON body'),
+    ('[1 2]', 'Expected , or ]'),
+    ('[1, tru]', 'Invalid JSON body'),
+    ('[1] x', 'Unexpected x after end'),
+    ('{1: 2}', 'Invalid JSON'),
+])
+def test_iter_json_items_rejects_invalid_json(body, message):
+    response = ChunkedResponse(body, chunk_size=2)
+    with pytest.raises(ValueError, match=message):
+        list(qpylib.iter_json_items(response))
+    assert response.closed
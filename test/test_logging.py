@@ -2,23 +2,48 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 #
-# pylint: disable=redefined-outer-name, unused-argument, invalid-name, protected-access
+# pylint: disable=redefined-outer-name, unused-argument, invalid-name, protected-access, too-many-lines
 
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
+import datetime
+import gzip
+import ipaddress
+import json
 import logging
-from logging.handlers import RotatingFileHandler, SysLogHandler
+from logging.handlers import RotatingFileHandler, SysLogHandler, TimedRotatingFileHandler
 import os
+import queue
+import socket
+import ssl
+import threading
+import time
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
 import pytest
 from qpylib import qpylib, log_qpylib, app_qpylib
 
+MANIFEST_LOG_ROTATION = log_qpylib._manifest_log_rotation
+
 @pytest.fixture(scope='function', autouse=True)
 def reset_globals():
     app_qpylib.Q_CACHED_MANIFEST = None
+    log_qpylib.stop_log_queue()
+    log_qpylib.PSEUDO_HOSTNAMES.clear()
     if log_qpylib.QLOGGER:
         log_qpylib.QLOGGER.handlers.clear()
+        log_qpylib.QLOGGER.filters.clear()
     log_qpylib.QLOGGER = None
     log_qpylib.LOG_LEVEL_TO_FUNCTION = None
 
+# Most tests have no manifest, so log rotation settings default to empty.
+@pytest.fixture(scope='function', autouse=True)
+def manifest_log_rotation():
+    with patch('qpylib.log_qpylib._manifest_log_rotation') as mock_manifest_log_rotation:
+        mock_manifest_log_rotation.return_value = {}
+        yield mock_manifest_log_rotation
+
 @pytest.fixture(scope='module', autouse=True)
 def set_env_vars():
     os.environ['QRADAR_APP_ID'] = '1001'
@@ -388,3 +413,723 @@ def test_all_log_levels_with_set_warning_threshold(info_threshold, tmpdir):
             {'level': 'DEBUG', 'text': 'hello debug'},
             {'level': 'INFO', 'text': 'hello default info'},
             {'level': 'INFO', 'text': 'hello info'}])
+
+# ==== queued logging ====
+
+def make_record(message):
+    return logging.LogRecord('test', logging.INFO, __file__, 1, message, None, None)
+
+def test_create_log_queued_uses_queue_handler(info_threshold, tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    with patch('qpylib.log_qpylib._log_file_location') as mock_log_location:
+        mock_log_location.return_value = log_path
+        qpylib.create_log(queued=True)
+    assert len(log_qpylib.QLOGGER.handlers) == 1
+    assert isinstance(log_qpylib.QLOGGER.handlers[0], log_qpylib.BoundedQueueHandler)
+    assert isinstance(log_qpylib.QUEUE_LISTENER.handlers[0], RotatingFileHandler)
+    qpylib.log('hello queued info')
+    qpylib.log('hello queued debug', 'DEBUG')
+    qpylib.log('hello \t queued warning', 'WARNING')
+    log_qpylib.stop_log_queue()
+    verify_log_file_content(log_path, [
+        {'level': 'INFO', 'text': 'hello queued info'},
+        {'level': 'WARNING', 'text': 'hello \\t queued warning'}], \
+        not_expected_lines=[{'level': 'DEBUG', 'text': 'hello queued debug'}])
+
+def test_create_log_queued_rejects_bad_policy(info_threshold):
+    with pytest.raises(ValueError, match="Unknown queue full policy: 'sometimes'"):
+        qpylib.create_log(queued=True, queue_full_policy='sometimes')
+    assert log_qpylib.QLOGGER is None
+
+def test_create_log_queued_rejects_bad_size(info_threshold):
+    with pytest.raises(ValueError, match='Log queue size must be at least 1'):
+        qpylib.create_log(queued=True, queue_size=0)
+
+def test_queue_handler_drop_policy_counts_dropped_records():
+    handler = log_qpylib._create_queue_handler(2, log_qpylib.QUEUE_FULL_DROP)
+    for index in range(5):
+        handler.handle(make_record('message {0}'.format(index)))
+    assert handler.dropped_count == 3
+    assert [handler.queue.get_nowait().msg for _ in range(2)] == ['message 0', 'message 1']
+
+def test_queue_handler_drop_oldest_policy_keeps_newest_records():
+    handler = log_qpylib._create_queue_handler(2, log_qpylib.QUEUE_FULL_DROP_OLDEST)
+    for index in range(5):
+        handler.handle(make_record('message {0}'.format(index)))
+    assert handler.dropped_count == 3
+    assert [handler.queue.get_nowait().msg for _ in range(2)] == ['message 3', 'message 4']
+
+def test_queue_handler_drop_oldest_policy_when_listener_races():
+    # The listener may empty the queue, or other producers refill it,
+    # between the failed put and the attempt to make space.
+    record_queue = MagicMock()
+    record_queue.put_nowait.side_effect = queue.Full
+    record_queue.get_nowait.side_effect = queue.Empty
+    handler = log_qpylib.BoundedQueueHandler(record_queue, log_qpylib.QUEUE_FULL_DROP_OLDEST)
+    handler.handle(make_record('message'))
+    assert handler.dropped_count == 1
+    assert record_queue.put_nowait.call_count == 2
+
+def test_get_dropped_log_count(info_threshold, tmpdir):
+    assert qpylib.get_dropped_log_count() == 0
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    with patch('qpylib.log_qpylib._log_file_location') as mock_log_location:
+        mock_log_location.return_value = log_path
+        qpylib.create_log(queued=True, queue_size=1, queue_full_policy='drop')
+    log_qpylib.QLOGGER.handlers[0].dropped_count = 7
+    assert qpylib.get_dropped_log_count() == 7
+
+# ==== lazy formatting ====
+
+def test_log_formats_args(info_threshold, tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    with patch('qpylib.log_qpylib._log_file_location') as mock_log_location:
+        mock_log_location.return_value = log_path
+        qpylib.create_log()
+        qpylib.log('offense %s has %d events', 'WARNING', args=(42, 7))
+        qpylib.log('single %s', args='value\twith tab')
+        qpylib.log('name=%(name)s', 'ERROR', args={'name': 'dict'})
+        qpylib.log('100% literal')
+    verify_log_file_content(log_path, [
+        {'level': 'WARNING', 'text': 'offense 42 has 7 events'},
+        {'level': 'INFO', 'text': 'single value\\twith tab'},
+        {'level': 'ERROR', 'text': 'name=dict'},
+        {'level': 'INFO', 'text': '100% literal'}])
+
+def test_log_below_threshold_skips_formatting(info_threshold, tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    with patch('qpylib.log_qpylib._log_file_location') as mock_log_location:
+        mock_log_location.return_value = log_path
+        qpylib.create_log()
+    with patch('qpylib.log_qpylib._sanitize') as mock_sanitize:
+        with patch.object(log_qpylib.QLOGGER, 'debug') as mock_debug:
+            qpylib.log('x=%s', 'DEBUG', args=('large payload',))
+    mock_sanitize.assert_not_called()
+    mock_debug.assert_not_called()
+
+def test_log_with_bad_level_below_threshold_raises_error(info_threshold, tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    with patch('qpylib.log_qpylib._log_file_location') as mock_log_location:
+        mock_log_location.return_value = log_path
+        qpylib.create_log()
+        with pytest.raises(ValueError, match="Unknown level: 'trace'"):
+            qpylib.log('hello', 'trace')
+
+def test_sanitized_message_defers_formatting():
+    with patch('qpylib.log_qpylib._sanitize', return_value='done') as mock_sanitize:
+        message = log_qpylib.SanitizedMessage('x=%s', (1,))
+        mock_sanitize.assert_not_called()
+        assert str(message) == 'done'
+    mock_sanitize.assert_called_once_with('x=1')
+
+# ==== batched TCP syslog ====
+
+class SyslogServer():
+    ''' Local TCP server which collects RFC 6587 octet-counted syslog frames.
+        Connections use TLS if ssl_context is supplied.
+    '''
+    def __init__(self, port=0, ssl_context=None):
+        self.ssl_context = ssl_context
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', port))
+        self.listener.listen(5)
+        self.address = self.listener.getsockname()
+        self.data = b''
+        self.connections = 0
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                return
+            if self.ssl_context is not None:
+                try:
+                    connection = self.ssl_context.wrap_socket(connection, server_side=True)
+                except OSError:
+                    connection.close()
+                    continue
+            self.connections += 1
+            with connection:
+                while True:
+                    chunk = connection.recv(65536)
+                    if not chunk:
+                        break
+                    self.data += chunk
+
+    def frames(self):
+        frames = []
+        data = self.data
+        while data:
+            length, _, rest = data.partition(b' ')
+            frames.append(rest[:int(length)].decode('utf-8'))
+            data = rest[int(length):]
+        return frames
+
+    def wait_for_frames(self, count, timeout=5):
+        end_time = time.time() + timeout
+        while time.time() < end_time:
+            if len(self.frames()) >= count:
+                break
+            time.sleep(0.01)
+        return self.frames()
+
+    def close(self):
+        self.listener.close()
+
+@pytest.fixture()
+def syslog_server():
+    server = SyslogServer()
+    yield server
+    server.close()
+
+def make_syslog_handler(address, **kwargs):
+    handler = log_qpylib.BatchedTCPSyslogHandler(address, **kwargs)
+    handler.setFormatter(logging.Formatter('1 %(message)s'))
+    return handler
+
+def test_tcp_syslog_sends_octet_counted_batches(syslog_server):
+    handler = make_syslog_handler(syslog_server.address, batch_size=3, flush_interval=60)
+    for index in range(6):
+        handler.handle(make_record('hello {0}'.format(index)))
+    frames = syslog_server.wait_for_frames(6)
+    handler.close()
+    assert frames == ['<14>1 hello {0}'.format(index) for index in range(6)]
+    assert syslog_server.connections == 1
+
+def test_tcp_syslog_flushes_on_interval(syslog_server):
+    handler = make_syslog_handler(syslog_server.address, batch_size=100, flush_interval=0.05)
+    record = make_record('warning message')
+    record.levelname = 'WARNING'
+    handler.handle(record)
+    assert syslog_server.wait_for_frames(1) == ['<12>1 warning message']
+    handler.close()
+
+def test_tcp_syslog_close_flushes_buffer(syslog_server):
+    handler = make_syslog_handler(syslog_server.address, batch_size=100, flush_interval=60)
+    handler.handle(make_record('last words'))
+    handler.close()
+    assert syslog_server.wait_for_frames(1) == ['<14>1 last words']
+
+def test_tcp_syslog_reconnects_and_keeps_buffered_records():
+    unused = socket.socket()
+    unused.bind(('127.0.0.1', 0))
+    address = unused.getsockname()
+    unused.close()
+    handler = make_syslog_handler(address, batch_size=1, flush_interval=0.02,
+                                  min_backoff=0.02, max_backoff=0.05)
+    handler.handle(make_record('while down'))
+    time.sleep(0.1)
+    server = SyslogServer(address[1])
+    try:
+        handler.handle(make_record('after restart'))
+        assert server.wait_for_frames(2) == ['<14>1 while down', '<14>1 after restart']
+    finally:
+        handler.close()
+        server.close()
+
+def test_tcp_syslog_waits_out_backoff_when_buffer_full():
+    unused = socket.socket()
+    unused.bind(('127.0.0.1', 0))
+    address = unused.getsockname()
+    unused.close()
+    handler = make_syslog_handler(address, batch_size=1, flush_interval=60, min_backoff=5)
+    handler.handle(make_record('first'))
+    end_time = time.time() + 5
+    while handler._next_connect_time == 0 and time.time() < end_time:
+        time.sleep(0.01)
+    send_buffer = handler._send_buffer
+    with patch.object(handler, '_send_buffer', wraps=send_buffer) as mock_send_buffer:
+        for index in range(5):
+            handler.handle(make_record('message {0}'.format(index)))
+        time.sleep(0.2)
+        assert mock_send_buffer.call_count == 0
+    handler._send_buffer()
+    assert len(handler._buffer) == 6
+    handler._buffer.clear()
+    handler.close()
+
+def test_tcp_syslog_drops_oldest_when_buffer_full():
+    handler = make_syslog_handler(('127.0.0.1', 9), batch_size=1000, flush_interval=60,
+                                  max_buffer=2)
+    for index in range(5):
+        handler.handle(make_record('message {0}'.format(index)))
+    assert handler.dropped_count == 3
+    assert [frame.decode('utf-8') for frame in handler._buffer] == \
+        ['15 <14>1 message 3', '15 <14>1 message 4']
+    handler.close()
+
+def test_tcp_syslog_requeue_keeps_newest_records():
+    handler = make_syslog_handler(('127.0.0.1', 9), batch_size=1000, flush_interval=60,
+                                  max_buffer=2)
+    handler.handle(make_record('newer'))
+    handler._requeue([b'older 1', b'older 2'])
+    assert list(handler._buffer) == [b'older 2', b'11 <14>1 newer']
+    assert handler.dropped_count == 1
+    handler._buffer.clear()
+    handler.close()
+
+def test_tcp_syslog_reports_format_errors_and_ignores_close_errors():
+    handler = make_syslog_handler(('127.0.0.1', 9), batch_size=1000, flush_interval=60)
+    handler.setFormatter(logging.Formatter('%(missing)s'))
+    with patch.object(handler, 'handleError') as mock_handle_error:
+        handler.handle(make_record('unformattable'))
+    assert mock_handle_error.call_count == 1
+    assert not handler._buffer
+    handler._socket = MagicMock()
+    handler._socket.close.side_effect = OSError('already closed')
+    handler.close()
+    assert handler._socket is None
+
+@pytest.fixture(scope='module')
+def tls_certificate(tmp_path_factory):
+    # Self-signed certificate for 127.0.0.1, returned as (cert path, key path).
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, '127.0.0.1')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder()
+                   .subject_name(name).issuer_name(name).public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(days=1))
+                   .not_valid_after(now + datetime.timedelta(days=1))
+                   .add_extension(x509.SubjectAlternativeName(
+                       [x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]), critical=False)
+                   .sign(key, hashes.SHA256()))
+    directory = tmp_path_factory.mktemp('tls')
+    cert_path = str(directory / 'cert.pem')
+    key_path = str(directory / 'key.pem')
+    with open(cert_path, 'wb') as cert_file:
+        cert_file.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as key_file:
+        key_file.write(key.private_bytes(serialization.Encoding.PEM,
+                                         serialization.PrivateFormat.TraditionalOpenSSL,
+                                         serialization.NoEncryption()))
+    return cert_path, key_path
+
+@pytest.fixture()
+def tls_syslog_server(tls_certificate):
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(*tls_certificate)
+    server = SyslogServer(ssl_context=server_context)
+    yield server
+    server.close()
+
+def test_tcp_syslog_sends_over_tls(tls_syslog_server, tls_certificate):
+    client_context = ssl.create_default_context(cafile=tls_certificate[0])
+    handler = make_syslog_handler(tls_syslog_server.address, batch_size=2, flush_interval=60,
+                                  ssl_context=client_context)
+    handler.handle(make_record('secret one'))
+    handler.handle(make_record('secret two'))
+    frames = tls_syslog_server.wait_for_frames(2)
+    assert isinstance(handler._socket, ssl.SSLSocket)
+    handler.close()
+    assert frames == ['<14>1 secret one', '<14>1 secret two']
+
+def test_tcp_syslog_tls_handshake_failure_backs_off(tls_syslog_server):
+    # The server certificate is not trusted by a default client context.
+    handler = make_syslog_handler(tls_syslog_server.address, batch_size=100, flush_interval=60,
+                                  ssl_context=ssl.create_default_context(), min_backoff=30)
+    handler.handle(make_record('kept'))
+    handler.flush()
+    assert handler._socket is None
+    assert handler._next_connect_time > time.monotonic()
+    assert len(handler._buffer) == 1
+    handler._buffer.clear()
+    handler.close()
+
+@patch(MANIFEST_JSON_ROOT_PATH, return_value=manifest_path('installed.json'))
+def test_create_log_tcp_syslog_handler_with_tls(mock_manifest, set_console_ip, set_app_uuid,
+                                                info_threshold, tmpdir):
+    ssl_context = ssl.create_default_context()
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    with patch('qpylib.log_qpylib._log_file_location', return_value=log_path):
+        qpylib.create_log(syslog_transport='tcp', syslog_ssl_context=ssl_context)
+    handler = log_qpylib.QLOGGER.handlers[1]
+    assert handler.ssl_context is ssl_context
+    handler._buffer.clear()
+    handler.close()
+
+def test_create_log_rejects_tls_without_tcp(info_threshold):
+    with pytest.raises(ValueError, match="syslog_ssl_context requires syslog transport 'tcp'"):
+        qpylib.create_log(syslog_ssl_context=ssl.create_default_context())
+
+@patch(MANIFEST_JSON_ROOT_PATH, return_value=manifest_path('installed.json'))
+def test_create_log_tcp_syslog_handler(mock_manifest, set_console_ip, set_app_uuid,
+                                       info_threshold, tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    with patch('qpylib.log_qpylib._log_file_location') as mock_log_location:
+        mock_log_location.return_value = log_path
+        qpylib.create_log(syslog_transport='tcp')
+    handler = log_qpylib.QLOGGER.handlers[1]
+    assert isinstance(handler, log_qpylib.BatchedTCPSyslogHandler)
+    assert handler.address == ('9.123.234.101', 514)
+    assert handler.formatter._fmt == \
+        '1 %(asctime)s 015fbd9fdd86b30e LiveManifest 1001 - - [NOT:%(ncode)s] %(message)s'
+    handler._buffer.clear()
+    handler.close()
+
+def test_create_log_rejects_bad_syslog_transport(info_threshold):
+    with pytest.raises(ValueError, match="Unknown syslog transport: 'carrier-pigeon'"):
+        qpylib.create_log(syslog_transport='carrier-pigeon')
+
+# ==== JSON log format ====
+
+def read_json_lines(log_path):
+    with open(log_path) as log_file:
+        return [json.loads(line) for line in log_file]
+
+@patch(MANIFEST_JSON_ROOT_PATH, return_value=manifest_path('installed.json'))
+def test_create_log_json_format(mock_manifest, set_app_uuid, info_threshold, tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    with patch('qpylib.log_qpylib._log_file_location') as mock_log_location:
+        mock_log_location.return_value = log_path
+        qpylib.create_log(log_format='json')
+        qpylib.log('hello\tjson %s', 'WARNING', args=('world',), fields={'offense_id': 42})
+        qpylib.log('plain')
+    records = read_json_lines(log_path)
+    assert list(records[0]) == ['app_id', 'hostname', 'app_name', 'timestamp', 'thread',
+                                'level', 'ncode', 'message', 'fields']
+    assert records[0]['app_id'] == '1001'
+    assert records[0]['hostname'] == '015fbd9fdd86b30e'
+    assert records[0]['app_name'] == 'LiveManifest'
+    assert records[0]['level'] == 'WARNING'
+    assert records[0]['ncode'] == '0000004000'
+    assert records[0]['thread'] == 'MainThread'
+    assert records[0]['message'] == 'hello\tjson world'
+    assert records[0]['fields'] == {'offense_id': 42}
+    assert records[1]['message'] == 'plain'
+    assert 'fields' not in records[1]
+
+def test_create_log_json_format_without_uuid_or_name(info_threshold, tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    with patch('qpylib.log_qpylib._log_file_location') as mock_log_location:
+        mock_log_location.return_value = log_path
+        with patch(GET_APP_NAME, side_effect=KeyError('name')):
+            qpylib.create_log(log_format='json')
+        qpylib.log('hello')
+    records = read_json_lines(log_path)
+    assert records[0]['app_id'] == '1001'
+    assert 'hostname' not in records[0]
+    assert 'app_name' not in records[0]
+
+def test_create_log_json_format_queued_with_exception(info_threshold, tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    with patch('qpylib.log_qpylib._log_file_location') as mock_log_location:
+        mock_log_location.return_value = log_path
+        with patch(GET_APP_NAME, return_value='Queued App'):
+            qpylib.create_log(queued=True, log_format='json')
+        try:
+            raise ValueError('broken')
+        except ValueError:
+            qpylib.log('failed\nbadly', 'EXCEPTION', fields={'attempt': 3})
+        log_qpylib.stop_log_queue()
+    records = read_json_lines(log_path)
+    assert records[0]['message'] == 'failed\nbadly'
+    assert records[0]['level'] == 'ERROR'
+    assert 'ValueError: broken' in records[0]['exception']
+    assert records[0]['fields'] == {'attempt': 3}
+
+def test_json_formatter_serializes_constants_once():
+    with patch('json.dumps', wraps=json.dumps) as mock_dumps:
+        formatter = log_qpylib.JsonFormatter({'app_id': '1001'})
+        assert mock_dumps.call_count == 1
+        line = formatter.format(make_record('hello'))
+    assert mock_dumps.call_count == 2
+    assert json.loads(line)['app_id'] == '1001'
+
+def test_json_formatter_without_constants_formats_exception():
+    error = ValueError('broken')
+    try:
+        raise error
+    except ValueError:
+        pass
+    record = logging.LogRecord('test', logging.ERROR, __file__, 1, 'failed', None,
+                               (ValueError, error, error.__traceback__))
+    line = log_qpylib.JsonFormatter({}).format(record)
+    assert 'ValueError: broken' in json.loads(line)['exception']
+    assert line.startswith('{"timestamp": ')
+
+def test_create_log_rejects_bad_log_format(info_threshold):
+    with pytest.raises(ValueError, match="Unknown log format: 'xml'"):
+        qpylib.create_log(log_format='xml')
+
+# ==== pseudo-hostname cache ====
+
+APP_UUID = 'd9830bbb-5958-4e42-acc8-0e7ac5182c0a'
+
+@pytest.fixture()
+def hostname_file(tmpdir):
+    location = os.path.join(tmpdir.strpath, log_qpylib.PSEUDO_HOSTNAME_FILE)
+    with patch('qpylib.log_qpylib._pseudo_hostname_location', return_value=location):
+        yield location
+
+def test_pseudo_hostname_is_stored_and_reused(hostname_file):
+    assert log_qpylib._create_pseudo_hostname('1001', APP_UUID) == '015fbd9fdd86b30e'
+    with open(hostname_file) as stored_file:
+        stored = json.load(stored_file)
+    assert stored['hostname'] == '015fbd9fdd86b30e'
+    assert APP_UUID not in json.dumps(stored)
+    log_qpylib.PSEUDO_HOSTNAMES.clear()
+    with patch('qpylib.log_qpylib.derive_key') as mock_derive_key:
+        assert log_qpylib._create_pseudo_hostname('1001', APP_UUID) == '015fbd9fdd86b30e'
+    mock_derive_key.assert_not_called()
+
+def test_pseudo_hostname_is_memoized_in_process(hostname_file):
+    log_qpylib._create_pseudo_hostname('1001', APP_UUID)
+    os.remove(hostname_file)
+    with patch('qpylib.log_qpylib.derive_key') as mock_derive_key:
+        assert log_qpylib._create_pseudo_hostname('1001', APP_UUID) == '015fbd9fdd86b30e'
+    mock_derive_key.assert_not_called()
+
+def test_pseudo_hostname_recomputed_for_different_app(hostname_file):
+    log_qpylib._create_pseudo_hostname('1001', APP_UUID)
+    log_qpylib.PSEUDO_HOSTNAMES.clear()
+    other_hostname = log_qpylib._create_pseudo_hostname('1002', APP_UUID)
+    assert other_hostname == log_qpylib._derive_pseudo_hostname('1002', APP_UUID)
+    assert other_hostname != '015fbd9fdd86b30e'
+
+def test_pseudo_hostname_ignores_corrupt_store_file(hostname_file):
+    with open(hostname_file, 'w') as stored_file:
+        stored_file.write('{"key": "x", "hostname": ')
+    assert log_qpylib._create_pseudo_hostname('1001', APP_UUID) == '015fbd9fdd86b30e'
+
+def test_pseudo_hostname_without_writable_store(tmpdir):
+    location = os.path.join(tmpdir.strpath, 'missing', log_qpylib.PSEUDO_HOSTNAME_FILE)
+    with patch('qpylib.log_qpylib._pseudo_hostname_location', return_value=location):
+        assert log_qpylib._create_pseudo_hostname('1001', APP_UUID) == '015fbd9fdd86b30e'
+
+# ==== log rotation ====
+
+@patch(MANIFEST_JSON_ROOT_PATH, return_value=manifest_path('logrotation.json'))
+def test_manifest_log_rotation_read_from_manifest(mock_manifest):
+    assert MANIFEST_LOG_ROTATION() == {'when': 'midnight', 'backup_count': 14, 'compress': True}
+
+@patch(MANIFEST_JSON_ROOT_PATH, return_value=manifest_path('installed.json'))
+def test_manifest_log_rotation_defaults_to_empty(mock_manifest):
+    assert MANIFEST_LOG_ROTATION() == {}
+
+def test_log_rotation_settings_defaults():
+    assert log_qpylib._log_rotation_settings() == log_qpylib.DEFAULT_LOG_ROTATION
+
+@pytest.mark.parametrize('log_rotation', [
+    [],
+    {'max_size': 100},
+    {'when': 'hourly'},
+    {'interval': 0},
+    {'max_bytes': '2MB'},
+    {'backup_count': -1},
+    {'backup_count': True},
+    {'compress': 'yes'}
+])
+def test_create_log_rejects_bad_log_rotation(manifest_log_rotation, info_threshold, log_rotation):
+    manifest_log_rotation.return_value = log_rotation
+    with pytest.raises(ValueError):
+        qpylib.create_log(syslog_enabled=False)
+    assert log_qpylib.QLOGGER is None
+
+def test_create_log_size_rotation_from_manifest(manifest_log_rotation, info_threshold, tmpdir):
+    manifest_log_rotation.return_value = {'max_bytes': 1000, 'backup_count': 20}
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    with patch('qpylib.log_qpylib._log_file_location', return_value=log_path):
+        qpylib.create_log(syslog_enabled=False)
+    handler = log_qpylib.QLOGGER.handlers[0]
+    assert isinstance(handler, RotatingFileHandler)
+    assert handler.rotation_filename(log_path + '.1') == log_path + '.1'
+    assert handler.maxBytes == 1000
+    assert handler.backupCount == 20
+
+def test_create_log_timed_rotation_from_manifest(manifest_log_rotation, info_threshold, tmpdir):
+    manifest_log_rotation.return_value = {'when': 'H', 'interval': 6, 'backup_count': 8}
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    with patch('qpylib.log_qpylib._log_file_location', return_value=log_path):
+        qpylib.create_log(syslog_enabled=False)
+    handler = log_qpylib.QLOGGER.handlers[0]
+    assert isinstance(handler, TimedRotatingFileHandler)
+    assert handler.rotation_filename(log_path + '.1') == log_path + '.1'
+    assert handler.when == 'H'
+    assert handler.interval == 6 * 60 * 60
+    assert handler.backupCount == 8
+
+def test_create_log_compressed_rotation(manifest_log_rotation, info_threshold, tmpdir):
+    manifest_log_rotation.return_value = {'when': 'midnight', 'compress': True}
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    with patch('qpylib.log_qpylib._log_file_location', return_value=log_path):
+        qpylib.create_log(syslog_enabled=False)
+    assert isinstance(log_qpylib.QLOGGER.handlers[0], log_qpylib.GzipTimedRotatingFileHandler)
+
+def test_gzip_rotating_file_handler_compresses_backups(tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    handler = log_qpylib.GzipRotatingFileHandler(log_path, maxBytes=1000, backupCount=2)
+    for line in ('first', 'second', 'third'):
+        handler.stream.write(line + '\n')
+        handler.doRollover()
+    handler.close()
+    assert sorted(os.listdir(tmpdir.strpath)) == ['app.log', 'app.log.1.gz', 'app.log.2.gz']
+    with gzip.open(log_path + '.1.gz', 'rt') as backup:
+        assert backup.read() == 'third\n'
+    with gzip.open(log_path + '.2.gz', 'rt') as backup:
+        assert backup.read() == 'second\n'
+
+def test_gzip_timed_rotating_file_handler_compresses_backups(tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    handler = log_qpylib.GzipTimedRotatingFileHandler(log_path, when='D', backupCount=2)
+    handler.stream.write('today\n')
+    handler.doRollover()
+    handler.close()
+    backups = [name for name in os.listdir(tmpdir.strpath) if name != 'app.log']
+    assert len(backups) == 1
+    assert handler.extMatch.match(backups[0][len('app.log.'):-len('.gz')])
+    with gzip.open(os.path.join(tmpdir.strpath, backups[0]), 'rt') as backup:
+        assert backup.read() == 'today\n'
+
+def test_gzip_timed_rotating_file_handler_keeps_backup_count(tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    gzip_file = log_qpylib._gzip_file
+    def slow_gzip_file(source, destination):
+        # Still compressing when doRollover looks for backups to delete.
+        time.sleep(0.05)
+        gzip_file(source, destination)
+    handler = log_qpylib.GzipTimedRotatingFileHandler(log_path, when='S', backupCount=2)
+    with patch('qpylib.log_qpylib._gzip_file', side_effect=slow_gzip_file):
+        for second in range(5):
+            handler.rolloverAt = 1600000000 + second
+            handler.stream.write('{0}\n'.format(second))
+            handler.doRollover()
+        handler.close()
+    backups = sorted(name for name in os.listdir(tmpdir.strpath) if name != 'app.log')
+    assert len(backups) == 2
+    for backup_name, second in zip(backups, (3, 4)):
+        with gzip.open(os.path.join(tmpdir.strpath, backup_name), 'rt') as backup:
+            assert backup.read() == '{0}\n'.format(second)
+
+def test_gzip_rollover_does_not_wait_for_compression(tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    release = threading.Event()
+    gzip_file = log_qpylib._gzip_file
+    def slow_gzip_file(source, destination):
+        release.wait(5)
+        gzip_file(source, destination)
+    handler = log_qpylib.GzipRotatingFileHandler(log_path, maxBytes=1000, backupCount=2)
+    with patch('qpylib.log_qpylib._gzip_file', side_effect=slow_gzip_file):
+        handler.stream.write('rotated\n')
+        handler.doRollover()
+        assert not os.path.exists(log_path + '.1.gz')
+        handler.stream.write('current\n')
+        release.set()
+        handler.close()
+    with gzip.open(log_path + '.1.gz', 'rt') as backup:
+        assert backup.read() == 'rotated\n'
+    with open(log_path) as log_file:
+        assert log_file.read() == 'current\n'
+
+def test_gzip_file_failure_keeps_source(tmpdir):
+    source = os.path.join(tmpdir.strpath, '.app.log.1.gz.pending')
+    with open(source, 'w') as source_file:
+        source_file.write('keep me\n')
+    log_qpylib._gzip_file(source, os.path.join(tmpdir.strpath, 'missing', 'app.log.1.gz'))
+    assert os.listdir(tmpdir.strpath) == ['.app.log.1.gz.pending']
+
+def test_gzip_file_failure_removes_partial_output(tmpdir):
+    source = os.path.join(tmpdir.strpath, '.app.log.1.gz.pending')
+    with open(source, 'w') as source_file:
+        source_file.write('keep me\n')
+    with patch('qpylib.log_qpylib.os.replace', side_effect=OSError('disk full')):
+        log_qpylib._gzip_file(source, os.path.join(tmpdir.strpath, 'app.log.1.gz'))
+    assert os.listdir(tmpdir.strpath) == ['.app.log.1.gz.pending']
+
+def test_gzip_rotate_ignores_missing_source(tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    handler = log_qpylib.GzipRotatingFileHandler(log_path, maxBytes=1000, backupCount=2)
+    handler.rotate(os.path.join(tmpdir.strpath, 'gone.log'), log_path + '.1.gz')
+    handler.close()
+    assert os.listdir(tmpdir.strpath) == ['app.log']
+
+# ==== repeated message filter ====
+
+class FakeClock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def create_log_with_repeat_filter(log_path, window=10, limit=1):
+    with patch('qpylib.log_qpylib._log_file_location', return_value=log_path):
+        qpylib.create_log(syslog_enabled=False, duplicate_window=window, duplicate_limit=limit)
+    repeat_filter = log_qpylib.QLOGGER.filters[0]
+    repeat_filter._clock = FakeClock()
+    return repeat_filter
+
+def read_log_messages(log_path):
+    with open(log_path) as log_file:
+        return [line.split('] ', 4)[-1].rstrip('\n') for line in log_file]
+
+def test_repeat_filter_suppresses_and_summarises(info_threshold, tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    repeat_filter = create_log_with_repeat_filter(log_path, limit=2)
+    for attempt in range(5):
+        qpylib.log('Console %s unreachable', 'ERROR', args=(attempt,))
+    qpylib.log('Console %s unreachable', 'WARNING', args=('w',))
+    assert read_log_messages(log_path) == ['Console 0 unreachable', 'Console 1 unreachable',
+                                           'Console w unreachable']
+    repeat_filter._clock.now += 10
+    qpylib.log('Console %s unreachable', 'ERROR', args=(5,))
+    with open(log_path) as log_file:
+        summary_line = log_file.readlines()[3]
+    assert '[ERROR]' in summary_line
+    assert '[NOT:0000003000]' in summary_line
+    assert read_log_messages(log_path)[3:] == [
+        'Message repeated 3 times in the last 10 seconds: Console %s unreachable',
+        'Console 5 unreachable']
+
+def test_repeat_filter_ends_windows_for_other_messages(info_threshold, tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    repeat_filter = create_log_with_repeat_filter(log_path)
+    qpylib.log('first', 'ERROR')
+    qpylib.log('first', 'ERROR')
+    repeat_filter._clock.now += 5
+    qpylib.log('second', 'ERROR')
+    qpylib.log('second', 'ERROR')
+    repeat_filter._clock.now += 5
+    qpylib.log('third')
+    assert read_log_messages(log_path) == [
+        'first', 'second',
+        'Message repeated 1 times in the last 10 seconds: first', 'third']
+    repeat_filter.flush()
+    assert read_log_messages(log_path)[4:] == [
+        'Message repeated 1 times in the last 10 seconds: second']
+    assert not repeat_filter._windows
+
+def test_repeat_filter_is_thread_safe(info_threshold, tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    repeat_filter = create_log_with_repeat_filter(log_path, limit=10)
+    def log_repeatedly():
+        for _ in range(500):
+            qpylib.log('hot path', 'ERROR')
+    threads = [threading.Thread(target=log_repeatedly) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    repeat_filter.flush()
+    assert read_log_messages(log_path) == ['hot path'] * 10 + [
+        'Message repeated 3990 times in the last 10 seconds: hot path']
+
+def test_repeat_filter_disabled_by_default(info_threshold, tmpdir):
+    log_path = os.path.join(tmpdir.strpath, 'app.log')
+    with patch('qpylib.log_qpylib._log_file_location', return_value=log_path):
+        qpylib.create_log(syslog_enabled=False)
+    qpylib.log('again')
+    qpylib.log('again')
+    assert read_log_messages(log_path) == ['again', 'again']
+    assert not any(isinstance(log_filter, log_qpylib.RepeatedMessageFilter)
+                   for log_filter in log_qpylib.QLOGGER.filters)
+
+@pytest.mark.parametrize('window, limit', [(-1, 1), (10, 0)])
+def test_create_log_rejects_bad_duplicate_settings(info_threshold, window, limit):
+    with pytest.raises(ValueError):
+        qpylib.create_log(syslog_enabled=False, duplicate_window=window, duplicate_limit=limit)
+    assert log_qpylib.QLOGGER is None
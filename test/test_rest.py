@@ -2,15 +2,19 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 #
-# pylint: disable=redefined-outer-name, unused-argument, invalid-name
+# pylint: disable=redefined-outer-name, unused-argument, invalid-name, protected-access
 
+from concurrent.futures import ThreadPoolExecutor
 import os
+import threading
+import time
 from unittest.mock import patch
 from flask import Flask
 import pytest
+import requests
 import responses
 from werkzeug import http
-from qpylib import qpylib, rest_qpylib
+from qpylib import app_qpylib, qpylib, rest_qpylib
 
 @pytest.fixture(scope='module', autouse=True)
 def pre_testing_setup():
@@ -129,22 +133,549 @@ def test_timeout_no_override():
     assert rest_qpylib.resolve_default_timeout() == 60
 
 def create_timeout_file(dir_path, file_content):
-    override_filepath = os.path.join(dir_path, 'rest-timeout-override')
-    with open(override_filepath, 'w') as _:
+    store_path = os.path.join(dir_path, 'store')
+    os.makedirs(store_path)
+    with open(os.path.join(store_path, 'rest-timeout-override'), 'w') as _:
         _.write(file_content)
-    return override_filepath
 
 def test_timeout_good_override(tmpdir):
-    override_filepath = create_timeout_file(tmpdir.strpath, '120\n')
-    with patch('qpylib.app_qpylib.get_store_path', return_value = override_filepath):
+    create_timeout_file(tmpdir.strpath, '120\n')
+    with patch.dict(os.environ, {'APP_ROOT': tmpdir.strpath}):
         assert rest_qpylib.resolve_default_timeout() == 120
 
 def test_timeout_good_override_with_whitespace(tmpdir):
-    override_filepath = create_timeout_file(tmpdir.strpath, '\t90   ')
-    with patch('qpylib.app_qpylib.get_store_path', return_value = override_filepath):
+    create_timeout_file(tmpdir.strpath, '\t90   ')
+    with patch.dict(os.environ, {'APP_ROOT': tmpdir.strpath}):
         assert rest_qpylib.resolve_default_timeout() == 90
 
 def test_timeout_bad_override(tmpdir):
-    override_filepath = create_timeout_file(tmpdir.strpath, 'invalid')
-    with patch('qpylib.app_qpylib.get_store_path', return_value = override_filepath):
+    create_timeout_file(tmpdir.strpath, 'invalid')
+    with patch.dict(os.environ, {'APP_ROOT': tmpdir.strpath}):
         assert rest_qpylib.resolve_default_timeout() == 60
+
+def test_timeout_override_does_not_build_app_context(tmpdir):
+    create_timeout_file(tmpdir.strpath, '120')
+    with patch.dict(os.environ, {'APP_ROOT': tmpdir.strpath}):
+        assert rest_qpylib.resolve_default_timeout() == 120
+    assert app_qpylib.Q_APP_CONTEXT is None
+
+# ==== Session pool ====
+
+@pytest.fixture()
+def default_session_pool():
+    yield
+    rest_qpylib.configure_session_pool()
+
+@responses.activate
+def test_rest_reuses_pooled_session(env_qradar_console_fqdn, default_session_pool):
+    qpylib.configure_rest_session_pool(size=2)
+    responses.add('GET', 'https://myhost.ibm.com/testing_endpoint', status=200)
+    qpylib.REST('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'})
+    assert rest_qpylib.SESSION_POOL.idle_count() == 1
+    with rest_qpylib.SESSION_POOL.session() as first_session:
+        pass
+    qpylib.REST('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'})
+    with rest_qpylib.SESSION_POOL.session() as second_session:
+        assert second_session is first_session
+    assert len(responses.calls) == 2
+
+def test_session_pool_creates_extra_sessions_when_exhausted(default_session_pool):
+    qpylib.configure_rest_session_pool(size=1)
+    with rest_qpylib.SESSION_POOL.session() as first_session:
+        with rest_qpylib.SESSION_POOL.session() as second_session:
+            assert second_session is not first_session
+    assert rest_qpylib.SESSION_POOL.idle_count() == 1
+
+def test_session_pool_applies_adapter_settings(default_session_pool):
+    qpylib.configure_rest_session_pool(pool_connections=3, pool_maxsize=7, keep_alive=False)
+    with rest_qpylib.SESSION_POOL.session() as session:
+        adapter = session.get_adapter('https://myhost.ibm.com')
+        assert adapter._pool_connections == 3
+        assert adapter._pool_maxsize == 7
+        assert session.headers['Connection'] == 'close'
+
+def test_session_pool_rejects_bad_size():
+    with pytest.raises(ValueError, match='Session pool size must be at least 1'):
+        qpylib.configure_rest_session_pool(size=0)
+
+def test_reset_session_pool_keeps_settings(default_session_pool):
+    qpylib.configure_rest_session_pool(size=4, pool_maxsize=8)
+    with rest_qpylib.SESSION_POOL.session():
+        pass
+    old_pool = rest_qpylib.SESSION_POOL
+    qpylib.reset_rest_session_pool()
+    assert rest_qpylib.SESSION_POOL is not old_pool
+    assert rest_qpylib.SESSION_POOL.idle_count() == 0
+    assert rest_qpylib.SESSION_POOL.size == 4
+    assert rest_qpylib.SESSION_POOL.pool_maxsize == 8
+
+@responses.activate
+def test_pooled_session_does_not_persist_cookies(env_qradar_console_fqdn, default_session_pool):
+    qpylib.configure_rest_session_pool(size=1)
+    responses.add('GET', 'https://myhost.ibm.com/testing_endpoint', status=200,
+                  headers={'Set-Cookie': 'SEC=leaked; Path=/'})
+    qpylib.REST('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'})
+    qpylib.REST('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'})
+    assert 'Cookie' not in responses.calls[1].request.headers
+
+# ==== Environment snapshot ====
+
+@responses.activate
+def test_rest_uses_app_context_until_refreshed(env_qradar_console_fqdn):
+    responses.add('GET', 'https://myhost.ibm.com/testing_endpoint', status=200)
+    responses.add('GET', 'https://otherhost.ibm.com/testing_endpoint', status=200)
+    qpylib.REST('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'})
+    with patch.dict(os.environ, {'QRADAR_CONSOLE_FQDN': 'otherhost.ibm.com'}):
+        qpylib.REST('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'})
+        qpylib.refresh_app_context()
+        qpylib.REST('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'})
+    assert [call.request.url for call in responses.calls] == [
+        'https://myhost.ibm.com/testing_endpoint',
+        'https://myhost.ibm.com/testing_endpoint',
+        'https://otherhost.ibm.com/testing_endpoint']
+
+def test_session_resolves_environment_once_per_origin():
+    session = rest_qpylib.EnvironmentSnapshotSession()
+    environ = {'HTTPS_PROXY': 'http://proxy.ibm.com:3128', 'REQUESTS_CA_BUNDLE': '/certs/ca.pem'}
+    with patch.dict(os.environ, environ), \
+         patch('qpylib.rest_qpylib.get_environ_proxies',
+               wraps=rest_qpylib.get_environ_proxies) as mock_environ_proxies:
+        for path in ('first', 'second'):
+            settings = session.merge_environment_settings(
+                'https://myhost.ibm.com/' + path, {}, None, True, None)
+            assert settings['proxies'] == {'https': 'http://proxy.ibm.com:3128'}
+            assert settings['verify'] == '/certs/ca.pem'
+        settings = session.merge_environment_settings(
+            'https://myhost.ibm.com/third', {'https': 'socks5h://localhost:1080'},
+            None, False, None)
+        assert settings['proxies'] == {'https': 'socks5h://localhost:1080'}
+        assert settings['verify'] is False
+        assert mock_environ_proxies.call_count == 1
+        session.merge_environment_settings('https://otherhost.ibm.com/', {}, None, True, None)
+        assert mock_environ_proxies.call_count == 2
+        qpylib.refresh_app_context()
+        session.merge_environment_settings('https://myhost.ibm.com/', {}, None, True, None)
+        assert mock_environ_proxies.call_count == 3
+
+def test_session_without_trust_env_ignores_environment():
+    session = rest_qpylib.EnvironmentSnapshotSession()
+    session.trust_env = False
+    with patch.dict(os.environ, {'HTTPS_PROXY': 'http://proxy.ibm.com:3128'}):
+        settings = session.merge_environment_settings('https://myhost.ibm.com/', {},
+                                                      None, True, None)
+    assert settings['proxies'] == {}
+
+# ==== Header construction ====
+
+@pytest.fixture()
+def default_localhost_resolver():
+    rest_qpylib.configure_localhost_resolver()
+    yield
+    rest_qpylib.configure_localhost_resolver()
+
+def test_add_headers_does_not_modify_supplied_headers(env_sec_admin_token):
+    headers = {'Host': '127.0.0.1', 'SEC': 'supplied', 'Accept': 'text/plain'}
+    rest_headers = rest_qpylib._add_headers(headers, '12.0')
+    assert headers == {'Host': '127.0.0.1', 'SEC': 'supplied', 'Accept': 'text/plain'}
+    assert rest_headers == {'Host': '127.0.0.1', 'SEC': '12345-testing-12345-testing',
+                            'Accept': 'text/plain', 'Version': '12.0'}
+    rest_headers['Accept'] = 'changed'
+    assert rest_qpylib._add_headers(headers)['Accept'] == 'text/plain'
+
+def test_add_headers_caches_localhost_address(default_localhost_resolver):
+    with patch('qpylib.rest_qpylib.gethostbyname', return_value='127.0.0.1') as mock_resolve:
+        assert rest_qpylib._add_headers(None) == {'Host': '127.0.0.1'}
+        assert rest_qpylib._add_headers({'Host': None})['Host'] == '127.0.0.1'
+        assert rest_qpylib._add_headers({'Host': '10.0.0.1'})['Host'] == '10.0.0.1'
+        assert mock_resolve.call_count == 1
+        mock_resolve.return_value = '127.0.0.2'
+        assert qpylib.refresh_rest_host_cache() == '127.0.0.2'
+        assert rest_qpylib._add_headers(None) == {'Host': '127.0.0.2'}
+        assert mock_resolve.call_count == 2
+
+def test_add_headers_resolves_localhost_after_ttl(default_localhost_resolver):
+    qpylib.configure_rest_host_cache(ttl=0)
+    with patch('qpylib.rest_qpylib.gethostbyname', return_value='127.0.0.1') as mock_resolve:
+        rest_qpylib._add_headers(None)
+        rest_qpylib._add_headers(None)
+    assert mock_resolve.call_count == 2
+
+def test_localhost_resolved_once_by_concurrent_callers(default_localhost_resolver):
+    def slow_resolve(hostname):
+        time.sleep(0.05)
+        return '127.0.0.1'
+    with patch('qpylib.rest_qpylib.gethostbyname', side_effect=slow_resolve) as mock_resolve:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            addresses = list(executor.map(lambda _: rest_qpylib.LOCALHOST_RESOLVER.address(),
+                                          range(4)))
+    assert addresses == ['127.0.0.1'] * 4
+    assert mock_resolve.call_count == 1
+
+def test_header_templates_are_bounded():
+    for index in range(20):
+        host = '10.0.0.{0}'.format(index)
+        assert rest_qpylib._header_template(host) == {'Host': host}
+        assert len(rest_qpylib.HEADER_TEMPLATES) <= 8
+
+def test_configure_rest_host_cache_rejects_negative_ttl():
+    with pytest.raises(ValueError, match='Host address TTL cannot be negative'):
+        qpylib.configure_rest_host_cache(ttl=-1)
+
+def test_add_headers_sec_cookie_does_not_override_supplied_sec():
+    cookie = http.dump_cookie('SEC', 'cookie-sec')
+    app = Flask(__name__)
+    with app.test_request_context(headers={'COOKIE': cookie}):
+        assert rest_qpylib._add_headers({'Host': '127.0.0.1'})['SEC'] == 'cookie-sec'
+        assert rest_qpylib._add_headers({'Host': '127.0.0.1', 'SEC': 'supplied'})['SEC'] == 'supplied'
+
+# ==== Retries ====
+
+TESTING_URL = 'https://myhost.ibm.com/testing_endpoint'
+
+@pytest.fixture()
+def retries_enabled():
+    qpylib.configure_rest_retries(max_retries=2, backoff_factor=0.5, jitter=0)
+    qpylib.reset_rest_retry_counts()
+    with patch('qpylib.rest_qpylib.time.sleep') as mock_sleep:
+        yield mock_sleep
+    rest_qpylib.configure_retry_policy(rest_qpylib.RetryPolicy(max_retries=0))
+
+@responses.activate
+def test_rest_does_not_retry_by_default(env_qradar_console_fqdn):
+    responses.add('GET', TESTING_URL, status=503)
+    assert qpylib.REST('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'}).status_code == 503
+    assert len(responses.calls) == 1
+
+@responses.activate
+def test_rest_retries_get_with_backoff(env_qradar_console_fqdn, retries_enabled):
+    responses.add('GET', TESTING_URL, status=503)
+    responses.add('GET', TESTING_URL, status=502)
+    responses.add('GET', TESTING_URL, status=200)
+    assert qpylib.REST('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'}).status_code == 200
+    assert len(responses.calls) == 3
+    assert [call.args[0] for call in retries_enabled.call_args_list] == [0.5, 1.0]
+    assert qpylib.get_rest_retry_counts() == {'retries': 2, 'retried_calls': 1,
+                                              'exhausted_calls': 0}
+
+@responses.activate
+def test_rest_returns_last_response_when_retries_exhausted(env_qradar_console_fqdn,
+                                                           retries_enabled):
+    responses.add('DELETE', TESTING_URL, status=503)
+    assert qpylib.REST('DELETE', 'testing_endpoint',
+                       headers={'Host': '127.0.0.1'}).status_code == 503
+    assert len(responses.calls) == 3
+    assert qpylib.get_rest_retry_counts() == {'retries': 2, 'retried_calls': 1,
+                                              'exhausted_calls': 1}
+
+@responses.activate
+def test_rest_honours_retry_after(env_qradar_console_fqdn, retries_enabled):
+    responses.add('GET', TESTING_URL, status=429, headers={'Retry-After': '7'})
+    responses.add('GET', TESTING_URL, status=200)
+    qpylib.REST('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'})
+    retries_enabled.assert_called_once_with(7)
+
+@responses.activate
+def test_rest_does_not_retry_when_retry_after_too_long(env_qradar_console_fqdn, retries_enabled):
+    responses.add('GET', TESTING_URL, status=503, headers={'Retry-After': '3600'})
+    assert qpylib.REST('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'}).status_code == 503
+    assert len(responses.calls) == 1
+
+@responses.activate
+def test_rest_retries_post_only_when_not_processed(env_qradar_console_fqdn, retries_enabled):
+    responses.add('POST', TESTING_URL, status=503)
+    assert qpylib.REST('POST', 'testing_endpoint', headers={'Host': '127.0.0.1'}).status_code == 503
+    assert len(responses.calls) == 1
+    responses.replace('POST', TESTING_URL, status=429)
+    qpylib.REST('POST', 'testing_endpoint', headers={'Host': '127.0.0.1'})
+    assert len(responses.calls) == 4
+
+@responses.activate
+def test_rest_retries_connection_errors(env_qradar_console_fqdn, retries_enabled):
+    responses.add('GET', TESTING_URL, body=requests.exceptions.ConnectionError('reset'))
+    responses.add('GET', TESTING_URL, status=200)
+    assert qpylib.REST('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'}).status_code == 200
+    responses.add('POST', TESTING_URL, body=requests.exceptions.ReadTimeout('slow'))
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        qpylib.REST('POST', 'testing_endpoint', headers={'Host': '127.0.0.1'})
+    assert qpylib.get_rest_retry_counts()['retries'] == 1
+
+@responses.activate
+def test_rest_per_call_retry_setting(env_qradar_console_fqdn, retries_enabled):
+    responses.add('GET', TESTING_URL, status=503)
+    qpylib.REST('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'}, retry=0)
+    assert len(responses.calls) == 1
+    qpylib.REST('GET', 'testing_endpoint', headers={'Host': '127.0.0.1'},
+                retry=rest_qpylib.RetryPolicy(max_retries=1, status_codes=(503,)))
+    assert len(responses.calls) == 3
+
+def test_retry_policy_delay_is_capped_and_jittered():
+    policy = rest_qpylib.RetryPolicy(backoff_factor=1, max_backoff=5, jitter=0.1)
+    assert 0.9 <= policy.delay(0) <= 1.1
+    assert 4.5 <= policy.delay(10) <= 5.5
+
+def test_parse_retry_after_http_date():
+    with patch('qpylib.rest_qpylib.time.time', return_value=784111767):
+        assert rest_qpylib._parse_retry_after('Sun, 06 Nov 1994 08:49:37 GMT') == 10
+    assert rest_qpylib._parse_retry_after('soon') is None
+
+def test_configure_rest_retries_rejects_negative_retries():
+    with pytest.raises(ValueError, match='Maximum retries cannot be negative'):
+        qpylib.configure_rest_retries(max_retries=-1)
+
+def test_rest_rejects_negative_per_call_retries(env_qradar_console_fqdn):
+    with pytest.raises(ValueError, match='Maximum retries cannot be negative'):
+        qpylib.REST('GET', 'api/help/versions', headers={'Host': '127.0.0.1'}, retry=-1)
+
+# ==== Circuit breakers and in-flight limit ====
+
+@pytest.fixture()
+def circuit_breaker():
+    qpylib.configure_rest_circuit_breaker(failure_threshold=2, reset_timeout=30)
+    yield
+    qpylib.configure_rest_circuit_breaker(failure_threshold=0)
+
+@pytest.fixture()
+def concurrency_limit():
+    yield
+    qpylib.configure_rest_concurrency_limit(0)
+
+ARIEL_URL = 'https://myhost.ibm.com/api/ariel/searches'
+HELP_URL = 'https://myhost.ibm.com/api/help/versions'
+
+@responses.activate
+def test_circuit_breaker_opens_per_endpoint_prefix(env_qradar_console_fqdn, circuit_breaker):
+    responses.add('GET', ARIEL_URL, status=503)
+    responses.add('GET', HELP_URL, status=200)
+    for _ in range(2):
+        qpylib.REST('GET', 'api/ariel/searches', headers={'Host': '127.0.0.1'})
+    with pytest.raises(rest_qpylib.CircuitOpenError, match='api/ariel'):
+        qpylib.REST('GET', 'api/ariel/searches', headers={'Host': '127.0.0.1'})
+    with pytest.raises(requests.exceptions.ConnectionError):
+        qpylib.REST('GET', 'api/ariel/searches', headers={'Host': '127.0.0.1'})
+    assert qpylib.REST('GET', 'api/help/versions', headers={'Host': '127.0.0.1'}).status_code == 200
+    assert len(responses.calls) == 3
+    assert qpylib.get_rest_circuit_states() == {'api/ariel': 'open', 'api/help': 'closed'}
+
+@responses.activate
+def test_circuit_breaker_half_open_trial(env_qradar_console_fqdn, circuit_breaker):
+    responses.add('GET', ARIEL_URL, body=requests.exceptions.ConnectionError('refused'))
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            qpylib.REST('GET', 'api/ariel/searches', headers={'Host': '127.0.0.1'})
+    breaker = rest_qpylib.CIRCUIT_BREAKERS.breaker_for(ARIEL_URL)
+    assert breaker.state == 'open'
+    breaker._opened_at -= 30
+    assert breaker.state == 'half_open'
+    breaker.before_call()
+    with pytest.raises(rest_qpylib.CircuitOpenError):
+        breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    breaker._opened_at -= 30
+    responses.replace('GET', ARIEL_URL, status=200)
+    assert qpylib.REST('GET', 'api/ariel/searches', headers={'Host': '127.0.0.1'}).status_code == 200
+    assert breaker.state == 'closed'
+
+def test_circuit_breaker_success_resets_failures():
+    breaker = rest_qpylib.CircuitBreaker('api/ariel', failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+
+def test_circuit_breaker_releases_trial_for_ignored_errors():
+    breaker = rest_qpylib.CircuitBreaker('api/ariel', failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_ignored()
+    breaker.before_call()
+
+def test_configure_rest_circuit_breaker_rejects_negative_threshold():
+    with pytest.raises(ValueError, match='failure threshold must be at least 1'):
+        qpylib.configure_rest_circuit_breaker(failure_threshold=-1)
+
+def test_configure_rest_circuit_breaker_rejects_bad_prefix_segments():
+    with pytest.raises(ValueError, match='prefix segments must be at least 1'):
+        qpylib.configure_rest_circuit_breaker(prefix_segments=0)
+
+@responses.activate
+def test_concurrency_limit_fails_fast_when_full(env_qradar_console_fqdn, concurrency_limit):
+    qpylib.configure_rest_concurrency_limit(1, acquire_timeout=0.01)
+    responses.add('GET', HELP_URL, status=200)
+    with rest_qpylib.IN_FLIGHT_LIMITER.slot():
+        with pytest.raises(rest_qpylib.ConcurrencyLimitError, match='1 REST requests'):
+            qpylib.REST('GET', 'api/help/versions', headers={'Host': '127.0.0.1'})
+    assert qpylib.REST('GET', 'api/help/versions', headers={'Host': '127.0.0.1'}).status_code == 200
+
+def test_concurrency_limit_bounds_in_flight_calls(env_qradar_console_fqdn, concurrency_limit):
+    qpylib.configure_rest_concurrency_limit(2, acquire_timeout=5)
+    lock = threading.Lock()
+    in_flight = [0, 0]
+    def slow_response(request):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+        return (200, {}, '')
+    with responses.RequestsMock() as mock:
+        mock.add_callback('GET', HELP_URL, callback=slow_response)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(qpylib.REST, 'GET', 'api/help/versions',
+                                       headers={'Host': '127.0.0.1'}) for _ in range(8)]
+        assert [future.result().status_code for future in futures] == [200] * 8
+    assert in_flight[1] == 2
+
+@responses.activate
+def test_concurrency_limit_slot_released_during_retry_backoff(env_qradar_console_fqdn,
+                                                              concurrency_limit, retries_enabled):
+    qpylib.configure_rest_concurrency_limit(1, acquire_timeout=0.01)
+    responses.add('GET', HELP_URL, status=503)
+    responses.add('GET', HELP_URL, status=200)
+    def sleep(delay):
+        # Another caller can use the only slot while this call backs off.
+        with rest_qpylib.IN_FLIGHT_LIMITER.slot():
+            pass
+    with patch('qpylib.rest_qpylib.time.sleep', side_effect=sleep) as mock_sleep:
+        assert qpylib.REST('GET', 'api/help/versions', headers={'Host': '127.0.0.1'}).status_code == 200
+    assert mock_sleep.call_count == 1
+
+@responses.activate
+def test_concurrency_limit_errors_do_not_open_circuit(env_qradar_console_fqdn, concurrency_limit,
+                                                      circuit_breaker):
+    qpylib.configure_rest_concurrency_limit(1, acquire_timeout=0.01)
+    with rest_qpylib.IN_FLIGHT_LIMITER.slot():
+        for _ in range(3):
+            with pytest.raises(rest_qpylib.ConcurrencyLimitError):
+                qpylib.REST('GET', 'api/help/versions', headers={'Host': '127.0.0.1'})
+    assert qpylib.get_rest_circuit_states() == {'api/help': 'closed'}
+
+def test_circuit_breaker_ignores_other_errors(env_qradar_console_fqdn, circuit_breaker):
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            qpylib.REST('PATCH', 'api/help/versions', headers={'Host': '127.0.0.1'})
+    assert qpylib.get_rest_circuit_states() == {'api/help': 'closed'}
+
+def test_configure_rest_concurrency_limit_rejects_negative():
+    with pytest.raises(ValueError, match='must be at least 1'):
+        qpylib.configure_rest_concurrency_limit(-1)
+
+# ==== Response cache ====
+
+@pytest.fixture()
+def response_cache():
+    qpylib.configure_rest_response_cache()
+    yield
+    qpylib.configure_rest_response_cache()
+
+OFFENSE_URL = 'https://myhost.ibm.com/api/siem/offenses/42'
+
+@responses.activate
+def test_rest_does_not_cache_by_default(env_qradar_console_fqdn, response_cache):
+    responses.add('GET', OFFENSE_URL, json={'id': 42}, headers={'ETag': '"v1"'})
+    for _ in range(2):
+        qpylib.REST('GET', 'api/siem/offenses/42', headers={'Host': '127.0.0.1'})
+    assert len(responses.calls) == 2
+    assert 'If-None-Match' not in responses.calls[1].request.headers
+    assert qpylib.get_rest_response_cache_counts()['entries'] == 0
+
+@responses.activate
+def test_rest_cache_revalidates_with_etag(env_qradar_console_fqdn, response_cache):
+    responses.add('GET', OFFENSE_URL, json={'id': 42}, headers={'ETag': '"v1"'})
+    responses.add('GET', OFFENSE_URL, status=304, headers={'ETag': '"v1"'})
+    first = qpylib.REST('GET', 'api/siem/offenses/42', headers={'Host': '127.0.0.1'}, cache_ttl=0)
+    second = qpylib.REST('GET', 'api/siem/offenses/42', headers={'Host': '127.0.0.1'}, cache_ttl=0)
+    assert responses.calls[1].request.headers['If-None-Match'] == '"v1"'
+    assert second.status_code == 200
+    assert second.json() == first.json() == {'id': 42}
+    assert second.from_cache
+    counts = qpylib.get_rest_response_cache_counts()
+    assert (counts['misses'], counts['revalidated'], counts['hits']) == (1, 1, 0)
+
+@responses.activate
+def test_rest_cache_revalidates_with_last_modified(env_qradar_console_fqdn, response_cache):
+    last_modified = 'Wed, 21 Oct 2015 07:28:00 GMT'
+    responses.add('GET', OFFENSE_URL, json={'id': 42}, headers={'Last-Modified': last_modified})
+    responses.add('GET', OFFENSE_URL, json={'id': 42, 'status': 'CLOSED'},
+                  headers={'Last-Modified': 'Thu, 22 Oct 2015 07:28:00 GMT'})
+    qpylib.REST('GET', 'api/siem/offenses/42', headers={'Host': '127.0.0.1'}, cache_ttl=0)
+    response = qpylib.REST('GET', 'api/siem/offenses/42', headers={'Host': '127.0.0.1'}, cache_ttl=0)
+    assert responses.calls[1].request.headers['If-Modified-Since'] == last_modified
+    assert response.json()['status'] == 'CLOSED'
+    assert not getattr(response, 'from_cache', False)
+
+@responses.activate
+def test_rest_cache_ttl_mode_without_validators(env_qradar_console_fqdn, response_cache):
+    responses.add('GET', OFFENSE_URL, json={'id': 42})
+    for _ in range(3):
+        response = qpylib.REST('GET', 'api/siem/offenses/42', headers={'Host': '127.0.0.1'},
+                               cache_ttl=60)
+    assert len(responses.calls) == 1
+    assert response.from_cache
+    qpylib.REST('GET', 'api/siem/offenses/42', headers={'Host': '127.0.0.1'}, cache_ttl=0)
+    assert len(responses.calls) == 2
+
+@responses.activate
+def test_rest_cache_is_keyed_on_sec_and_csrf(env_qradar_console_fqdn, response_cache):
+    responses.add('GET', OFFENSE_URL, json={'id': 42})
+    for sec, csrf in (('user1', 'csrf1'), ('user2', 'csrf1'), ('user1', 'csrf2'), ('user1', 'csrf1')):
+        qpylib.REST('GET', 'api/siem/offenses/42', cache_ttl=60,
+                    headers={'Host': '127.0.0.1', 'SEC': sec, 'QRadarCSRF': csrf})
+    assert len(responses.calls) == 3
+
+@responses.activate
+def test_rest_cache_skips_no_store_and_other_methods(env_qradar_console_fqdn, response_cache):
+    responses.add('GET', OFFENSE_URL, json={'id': 42}, headers={'Cache-Control': 'no-store'})
+    responses.add('POST', OFFENSE_URL, json={'id': 42})
+    for _ in range(2):
+        qpylib.REST('GET', 'api/siem/offenses/42', headers={'Host': '127.0.0.1'}, cache_ttl=60)
+        qpylib.REST('POST', 'api/siem/offenses/42', headers={'Host': '127.0.0.1'}, cache_ttl=60)
+    assert len(responses.calls) == 4
+
+@responses.activate
+def test_rest_cache_skips_calls_with_other_credentials(env_qradar_console_fqdn, response_cache):
+    responses.add('GET', OFFENSE_URL, json={'id': 42})
+    for credentials in ({'cookies': {'SEC': 'user1'}}, {'cookies': {'SEC': 'user2'}},
+                        {'auth': ('user1', 'secret')}, {'auth': ('user2', 'secret')},
+                        {'cert': '/user1.pem'}):
+        response = qpylib.REST('GET', 'api/siem/offenses/42', headers={'Host': '127.0.0.1'},
+                               cache_ttl=60, **credentials)
+        assert not getattr(response, 'from_cache', False)
+    assert len(responses.calls) == 5
+    assert qpylib.get_rest_response_cache_counts()['entries'] == 0
+
+@responses.activate
+def test_clear_rest_response_cache(env_qradar_console_fqdn, response_cache):
+    responses.add('GET', OFFENSE_URL, json={'id': 42})
+    qpylib.REST('GET', 'api/siem/offenses/42', headers={'Host': '127.0.0.1'}, cache_ttl=60)
+    assert len(rest_qpylib.rest_cache.RESPONSE_CACHE) == 1
+    qpylib.clear_rest_response_cache()
+    assert len(rest_qpylib.rest_cache.RESPONSE_CACHE) == 0
+    qpylib.REST('GET', 'api/siem/offenses/42', headers={'Host': '127.0.0.1'}, cache_ttl=60)
+    assert len(responses.calls) == 2
+
+def test_configure_rest_response_cache_rejects_bad_bounds():
+    with pytest.raises(ValueError, match='max_entries must be at least 1'):
+        qpylib.configure_rest_response_cache(max_entries=0)
+    with pytest.raises(ValueError, match='max_bytes must be at least 1'):
+        qpylib.configure_rest_response_cache(max_bytes=0)
+
+def test_response_cache_bounds_entries_and_bytes():
+    cache = rest_qpylib.rest_cache.ResponseCache(max_entries=2, max_bytes=100)
+    entries = {}
+    for key, size in (('a', 30), ('b', 30), ('c', 30), ('d', 80), ('e', 200)):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'x' * size
+        entries[key] = rest_qpylib.rest_cache.CachedResponse(response)
+        cache.put(key, entries[key])
+    assert cache.get('a') is None
+    assert cache.get('b') is None and cache.get('c') is None
+    assert cache.get('d') is entries['d']
+    assert cache.get('e') is None
+    assert cache.counts()['bytes'] == 80
+
+def test_rest_rejects_negative_cache_ttl(env_qradar_console_fqdn):
+    with pytest.raises(ValueError, match='cache_ttl cannot be negative'):
+        qpylib.REST('GET', 'api/siem/offenses/42', headers={'Host': '127.0.0.1'}, cache_ttl=-1)